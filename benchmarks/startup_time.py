@@ -0,0 +1,76 @@
+# coding: utf-8
+"""
+Startup Time Benchmark
+Measures how long each stage script takes to import and to answer --help, in fresh interpreters.
+
+Usage:
+    python benchmarks/startup_time.py
+    python benchmarks/startup_time.py --repeat 10
+
+Importing a stage module must not load LangChain; the benchmark also reports whether it did.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+SCRIPTS = [
+    "step1_caption_generation and refinement/caption_generation.py",
+    "step1_caption_generation and refinement/caption_judge_optimize.py",
+    "step1_caption_generation and refinement/caption_pipeline.py",
+    "step2_vqa_generation/diagnosis_vqa.py",
+    "step2_vqa_generation/knowledge_qa_vqa.py",
+    "step2_vqa_generation/vqa_runner.py",
+    "step3_answer_selection/diagnosis_judge.py",
+    "step3_answer_selection/knowledge_qa_judge.py",
+]
+
+# Imports the script as a module (with its directory on sys.path, as when it is run) and reports
+# whether any LangChain module was loaded
+IMPORT_SNIPPET = """
+import importlib.util, os, sys
+sys.path.insert(0, os.path.dirname(sys.argv[1]))
+spec = importlib.util.spec_from_file_location("stage", sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+print(any(name.startswith("langchain") for name in sys.modules))
+"""
+
+
+def time_command(command, repeat):
+    """Run command `repeat` times, returns (median seconds, stdout of the last run)"""
+    timings = []
+    output = ""
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run(command, cwd=REPO_ROOT, capture_output=True, text=True)
+        timings.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            raise RuntimeError(f"{' '.join(command)} failed:\n{result.stderr}")
+        output = result.stdout
+    return statistics.median(timings), output
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark import and --help startup time of the stage scripts")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per measurement, the median is reported (default: 5)")
+    args = parser.parse_args(argv)
+
+    baseline, _ = time_command([sys.executable, "-c", "pass"], args.repeat)
+    print(f"Interpreter startup: {baseline * 1000:.0f} ms (included in the numbers below)\n")
+    print(f"{'script':<45} {'import':>10} {'--help':>10}  langchain on import")
+
+    for script in SCRIPTS:
+        path = os.path.join(REPO_ROOT, script)
+        import_time, loaded = time_command([sys.executable, "-c", IMPORT_SNIPPET, path], args.repeat)
+        help_time, _ = time_command([sys.executable, path, "--help"], args.repeat)
+        print(f"{os.path.basename(script):<45} {import_time * 1000:>8.0f}ms {help_time * 1000:>8.0f}ms  {loaded.strip()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,6 @@
+"""
+Shared helpers for the CPJ pipeline scripts.
+
+The stage scripts live in directories that are not importable packages, so each
+script adds the repository root to ``sys.path`` before importing from here.
+"""
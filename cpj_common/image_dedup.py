@@ -0,0 +1,132 @@
+"""
+Perceptual-hash deduplication of near-identical images.
+
+Field datasets contain burst shots and re-uploads of the same leaf. Each image
+gets a 64-bit DCT perceptual hash; images are then clustered in input order so
+that every image within ``threshold`` differing bits of an earlier cluster
+representative joins that cluster. Only representatives need to be captioned.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageOps
+
+HASH_SIZE = 8          # 8x8 low-frequency DCT coefficients -> 64-bit hash
+SAMPLE_SIZE = 32       # images are reduced to 32x32 grayscale before the DCT
+
+
+def _dct_matrix(n):
+    """Orthonormal DCT-II basis, so the 2-D DCT of x is M @ x @ M.T"""
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+
+_DCT = _dct_matrix(SAMPLE_SIZE)
+
+
+def perceptual_hash(image):
+    """64-bit pHash of a PIL image: sign of the low DCT frequencies against their median"""
+    image = ImageOps.exif_transpose(image).convert("L").resize((SAMPLE_SIZE, SAMPLE_SIZE), Image.LANCZOS)
+    pixels = np.asarray(image, dtype=np.float64)
+    low = (_DCT @ pixels @ _DCT.T)[:HASH_SIZE, :HASH_SIZE].flatten()
+    # The DC term only reflects overall brightness, leave it out of the median
+    bits = low > np.median(low[1:])
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+def hash_file(path):
+    """pHash of an image file, None if it cannot be read"""
+    try:
+        with Image.open(path) as image:
+            return perceptual_hash(image)
+    except Exception:
+        return None
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class ImageDeduplicator:
+    """Cluster images whose perceptual hashes differ by at most `threshold` bits
+
+    Clusters are formed in input order: the first image of a cluster is its
+    representative and every later member is within `threshold` bits of it.
+    """
+
+    def __init__(self, threshold=6, workers=8):
+        if not 0 <= threshold < HASH_SIZE * HASH_SIZE:
+            raise ValueError(f"threshold must be between 0 and {HASH_SIZE * HASH_SIZE - 1}, got {threshold}")
+        self.threshold = threshold
+        self.workers = workers
+
+        self.images = 0
+        self.unreadable = 0
+        self.clusters = 0
+        self.duplicates = 0
+        self.hash_time = 0.0
+
+    def _bands(self, value):
+        """Split a hash into threshold + 1 bands; two hashes within `threshold` bits share at least one band"""
+        count = self.threshold + 1
+        bits = HASH_SIZE * HASH_SIZE
+        bands = []
+        for band in range(count):
+            start = band * bits // count
+            stop = (band + 1) * bits // count
+            bands.append((band, (value >> start) & ((1 << (stop - start)) - 1)))
+        return bands
+
+    def find_duplicates(self, paths):
+        """Return {path: representative_path} for every path that duplicates an earlier one"""
+        unique_paths = list(dict.fromkeys(path for path in paths if path))
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            hashes = list(executor.map(hash_file, unique_paths))
+        self.hash_time += time.perf_counter() - start
+
+        buckets = {}
+        leaders = []
+        duplicates = {}
+        for path, value in zip(unique_paths, hashes):
+            self.images += 1
+            if value is None:
+                self.unreadable += 1
+                continue
+
+            bands = self._bands(value)
+            candidates = set()
+            for band in bands:
+                candidates.update(buckets.get(band, ()))
+
+            # Earliest representative within the threshold wins
+            representative = None
+            for leader in sorted(candidates):
+                if hamming(value, leaders[leader][1]) <= self.threshold:
+                    representative = leaders[leader][0]
+                    break
+
+            if representative is not None:
+                duplicates[path] = representative
+                self.duplicates += 1
+                continue
+
+            for band in bands:
+                buckets.setdefault(band, []).append(len(leaders))
+            leaders.append((path, value))
+            self.clusters += 1
+
+        return duplicates
+
+    def summary(self):
+        return (f"{self.images} images in {self.clusters} clusters (threshold {self.threshold} bits), "
+                f"{self.duplicates} near-duplicates, {self.unreadable} unreadable, "
+                f"hashing took {self.hash_time:.2f}s")
@@ -0,0 +1,202 @@
+"""
+Image payload optimizer applied before base64 encoding.
+
+Field photos are often multi-megapixel JPEGs with EXIF blocks, which inflates
+request size, upload time and image-token cost. The optimizer detects the real
+MIME type, downsizes to a maximum edge, re-encodes to JPEG/WebP without
+metadata and keeps per-image byte statistics. An image that needed no resize
+and would not shrink is sent as the original file instead (JPEG metadata
+stripped losslessly), so already compressed photos never grow or go through a
+second lossy pass.
+"""
+
+import base64
+import io
+import mimetypes
+import threading
+from collections import namedtuple
+
+from PIL import Image, ImageOps
+
+ImagePayload = namedtuple("ImagePayload", ["data", "mime", "original_size", "payload_size"])
+
+OUTPUT_FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+}
+
+EXIF_ORIENTATION = 0x0112
+
+# Formats every VLM endpoint accepts as-is, so an original file in one of them can be sent unchanged
+PASSTHROUGH_MIMES = ("image/jpeg", "image/png", "image/webp")
+
+# JPEG segments dropped by strip_jpeg_metadata: APP1 (EXIF, XMP), APP13 (IPTC) and comments.
+# APP0 (JFIF), APP2 (ICC profile) and APP14 (Adobe color transform) affect decoding and are kept.
+_JPEG_METADATA_MARKERS = (0xE1, 0xED, 0xFE)
+
+
+# ========== MIME Detection ==========
+def detect_mime(image_bytes, image_path=None):
+    """Detect the MIME type from the image content, falling back to the file extension"""
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            mime = Image.MIME.get(img.format)
+            if mime:
+                return mime
+    except Exception:
+        pass
+
+    if image_path:
+        guessed, _ = mimetypes.guess_type(image_path)
+        if guessed and guessed.startswith("image/"):
+            return guessed
+    return "image/jpeg"
+
+
+def strip_jpeg_metadata(jpeg_bytes):
+    """Drop EXIF/XMP/IPTC and comment segments from a JPEG without re-encoding it
+
+    Returns the input unchanged if it is not a well-formed JPEG.
+    """
+    if not jpeg_bytes.startswith(b"\xff\xd8"):
+        return jpeg_bytes
+    output = [jpeg_bytes[:2]]
+    position = 2
+    while position + 4 <= len(jpeg_bytes):
+        if jpeg_bytes[position] != 0xFF:
+            return jpeg_bytes
+        marker = jpeg_bytes[position + 1]
+        if marker == 0xFF:
+            # Fill byte before a marker
+            position += 1
+            continue
+        if marker == 0xDA:
+            # Start of scan: the entropy-coded data and the rest of the file are kept as they are
+            output.append(jpeg_bytes[position:])
+            return b"".join(output)
+        length = int.from_bytes(jpeg_bytes[position + 2:position + 4], "big")
+        end = position + 2 + length
+        if length < 2 or end > len(jpeg_bytes):
+            return jpeg_bytes
+        if marker not in _JPEG_METADATA_MARKERS:
+            output.append(jpeg_bytes[position:end])
+        position = end
+    return jpeg_bytes
+
+
+# ========== Payload Optimizer ==========
+class ImagePayloadOptimizer:
+    """Downsize, re-encode and strip metadata from images before they are sent to a VLM"""
+
+    def __init__(self, max_edge=1536, image_format="jpeg", quality=85):
+        if image_format not in OUTPUT_FORMATS and image_format != "original":
+            raise ValueError(f"Unsupported image format: {image_format}")
+        self.max_edge = max_edge
+        self.image_format = image_format
+        self.quality = quality
+
+        self._lock = threading.Lock()
+        self.images = 0
+        self.original_bytes = 0
+        self.payload_bytes = 0
+
+    def fingerprint(self):
+        """Stable description of the optimizer settings"""
+        # "keep" marks payloads that may be the original file, so stores written before that are not reused
+        return f"{self.image_format}:{self.max_edge}:{self.quality}:keep"
+
+    def optimize(self, image_bytes, image_path=None):
+        """Return (payload_bytes, mime) for the raw image bytes"""
+        if self.image_format == "original":
+            return image_bytes, detect_mime(image_bytes, image_path)
+
+        pil_format, mime = OUTPUT_FORMATS[self.image_format]
+        try:
+            with Image.open(io.BytesIO(image_bytes)) as img:
+                original_mime = Image.MIME.get(img.format)
+                changed = img.getexif().get(EXIF_ORIENTATION, 1) != 1
+                # Apply the EXIF orientation before the metadata is dropped
+                img = ImageOps.exif_transpose(img)
+                if self.max_edge and max(img.size) > self.max_edge:
+                    img.thumbnail((self.max_edge, self.max_edge), Image.LANCZOS)
+                    changed = True
+
+                if pil_format == "JPEG" and img.mode != "RGB":
+                    img = img.convert("RGB")
+                elif pil_format == "WEBP" and img.mode not in ("RGB", "RGBA"):
+                    img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+
+                buffer = io.BytesIO()
+                img.save(buffer, format=pil_format, quality=self.quality, optimize=True)
+                encoded = buffer.getvalue()
+
+                # Not resized or rotated: keep the original file unless the re-encode is actually smaller
+                if not changed and original_mime in PASSTHROUGH_MIMES:
+                    original = strip_jpeg_metadata(image_bytes) if original_mime == "image/jpeg" else image_bytes
+                    if len(original) <= len(encoded):
+                        return original, original_mime
+                return encoded, mime
+        except Exception as e:
+            # Unreadable by Pillow: send the bytes untouched with their best-guess MIME type
+            print(f"[WARNING] Image optimization skipped for {image_path}: {e}")
+            return image_bytes, detect_mime(image_bytes, image_path)
+
+    def account(self, original_size, payload_size):
+        """Add one sent image to the byte statistics"""
+        with self._lock:
+            self.images += 1
+            self.original_bytes += original_size
+            self.payload_bytes += payload_size
+
+    def encode(self, image_bytes, image_path=None):
+        """Optimize raw image bytes and return an ImagePayload with base64 data"""
+        payload, mime = self.optimize(image_bytes, image_path)
+        self.account(len(image_bytes), len(payload))
+        return ImagePayload(base64.b64encode(payload).decode("utf-8"), mime, len(image_bytes), len(payload))
+
+    def load(self, image_path):
+        """Read an image from disk and return its optimized ImagePayload"""
+        with open(image_path, "rb") as f:
+            return self.encode(f.read(), image_path)
+
+    def stats(self):
+        """Return aggregate byte statistics"""
+        with self._lock:
+            saved = self.original_bytes - self.payload_bytes
+            return {
+                "images": self.images,
+                "original_bytes": self.original_bytes,
+                "payload_bytes": self.payload_bytes,
+                "saved_bytes": saved,
+                "saved_ratio": saved / self.original_bytes if self.original_bytes else 0.0,
+            }
+
+
+# ========== Reporting Helpers ==========
+def data_uri(payload):
+    """Build a data URI for an ImagePayload"""
+    return f"data:{payload.mime};base64,{payload.data}"
+
+
+def describe_savings(payload):
+    """One-line description of the bytes saved for a single image"""
+    saved = payload.original_size - payload.payload_size
+    ratio = saved / payload.original_size * 100 if payload.original_size else 0.0
+    return f"{payload.original_size} -> {payload.payload_size} bytes (saved {saved}, {ratio:.1f}%)"
+
+
+def add_image_arguments(parser):
+    """Register the shared image optimization options on an argparse parser"""
+    from .payload_store import DEFAULT_PAYLOAD_STORE
+
+    parser.add_argument("--max-image-edge", type=int, default=1536,
+                        help="Downsize images so the longest edge is at most this many pixels, 0 disables (default: 1536)")
+    parser.add_argument("--image-format", type=str, default="jpeg", choices=["jpeg", "webp", "original"],
+                        help="Re-encode images to this format, 'original' sends the file bytes as-is (default: jpeg)")
+    parser.add_argument("--image-quality", type=int, default=85,
+                        help="JPEG/WebP encoding quality (default: 85)")
+    parser.add_argument("--payload-store", type=str, nargs="?", const=DEFAULT_PAYLOAD_STORE, default=None,
+                        help="Reuse encoded images from a store shared by all stages; without a value the store is "
+                             "<repo>/.payload_store (default: disabled)")
+    parser.add_argument("--payload-store-max-size-mb", type=float, default=2048,
+                        help="Evict least-recently used payloads beyond this size (default: 2048)")
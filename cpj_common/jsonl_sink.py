@@ -0,0 +1,92 @@
+"""
+Append-only JSONL checkpointing.
+
+Every finished record is appended as one line and flushed, so checkpoint I/O is
+linear in the dataset size and a crash loses at most the records that were
+still in flight. Out-of-order completions (concurrent workers) are held in a
+small reorder buffer so the file always follows input order.
+"""
+
+import json
+import os
+
+
+# ========== JSONL Sink ==========
+class JsonlSink:
+    """Append records to a JSONL file in input order, with optional fsync batching"""
+
+    def __init__(self, path, fsync_every=0, append=False):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.fsync_every = fsync_every
+        self.written = 0
+
+        self._file = open(path, "a" if append else "w", encoding="utf-8")
+        self._next_position = 0
+        self._pending = {}
+        self._unsynced = 0
+
+    def write(self, record):
+        """Append a record immediately"""
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+        self.written += 1
+
+        self._unsynced += 1
+        if self.fsync_every and self._unsynced >= self.fsync_every:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    def write_at(self, position, record):
+        """Append a record once every record before `position` has been written"""
+        self._pending[position] = record
+        while self._next_position in self._pending:
+            self.write(self._pending.pop(self._next_position))
+            self._next_position += 1
+
+    def close(self):
+        """Flush buffered records, fsync and close the file"""
+        for position in sorted(self._pending):
+            self.write(self._pending[position])
+        self._pending.clear()
+
+        self._file.flush()
+        if self.fsync_every:
+            os.fsync(self._file.fileno())
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+# ========== Readers and Converters ==========
+def iter_jsonl(path):
+    """Yield records from a JSONL file, ignoring a truncated trailing line"""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # A crash mid-write leaves at most one partial line at the end
+                continue
+
+
+def jsonl_to_json(jsonl_path, json_path, indent=2):
+    """Stream a JSONL file into a JSON array formatted like json.dump(records, indent=indent)"""
+    pad = " " * indent
+    count = 0
+    with open(json_path, "w", encoding="utf-8") as out:
+        for record in iter_jsonl(jsonl_path):
+            out.write("[\n" if count == 0 else ",\n")
+            text = json.dumps(record, ensure_ascii=False, indent=indent)
+            out.write("\n".join(pad + line for line in text.split("\n")))
+            count += 1
+        out.write("\n]" if count else "[]")
+    return count
@@ -0,0 +1,190 @@
+"""
+Persistent store of encoded image payloads shared by all stages.
+
+Step 1 and step 2 send the same images, and step 2 sends each image once per
+question; without the store every send re-reads, re-encodes and re-base64s the
+file. Payloads are stored as ready-to-send data URIs, one file per payload,
+named by a SHA-256 of the image bytes and the optimizer settings. Files are
+written atomically and read through ``mmap``, so any number of stages and
+worker processes can share one store directory. A second, tiny index maps
+(path, size, mtime) to the content key, so a hit does not even read the image.
+The store is bounded in size and evicts least-recently used payloads.
+"""
+
+import json
+import mmap
+import os
+import tempfile
+import threading
+
+from .image_payload import ImagePayload, data_uri
+from .response_cache import hash_parts
+
+DEFAULT_PAYLOAD_STORE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".payload_store")
+
+
+class PayloadStore:
+    """Content-addressed, file-backed cache of ImagePayloads in front of an ImagePayloadOptimizer
+
+    ``load(path)`` has the same signature as ``ImagePayloadOptimizer.load``, so it can be handed to an
+    ImagePrefetcher unchanged.
+    """
+
+    def __init__(self, store_dir, optimizer, max_size_mb=2048):
+        self.store_dir = store_dir
+        self.optimizer = optimizer
+        self.max_bytes = int(max_size_mb * 1024 * 1024) if max_size_mb else None
+        self._fingerprint = optimizer.fingerprint()
+        self._payload_dir = os.path.join(store_dir, "payloads")
+        self._path_dir = os.path.join(store_dir, "paths")
+        os.makedirs(self._payload_dir, exist_ok=True)
+        os.makedirs(self._path_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.path_hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    # ========== File Layout ==========
+    @staticmethod
+    def _shard(directory, key):
+        return os.path.join(directory, key[:2], key)
+
+    def _write_atomic(self, path, data):
+        """Write via a temporary file and rename, so readers never see a partial file"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def _read_payload(self, key):
+        """Memory-map a stored payload, None if it is missing or unreadable"""
+        path = self._shard(self._payload_dir, key)
+        try:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                newline = mapped.find(b"\n")
+                header = json.loads(mapped[:newline])
+                uri = mapped[newline + 1:].decode("ascii")
+            mime, data = uri[len("data:"):].split(";base64,", 1)
+            # The modification time doubles as the last access time for eviction
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return ImagePayload(data, mime, header["original_size"], header["payload_size"])
+
+    def _write_payload(self, key, payload):
+        header = json.dumps({"original_size": payload.original_size, "payload_size": payload.payload_size})
+        self._write_atomic(self._shard(self._payload_dir, key), f"{header}\n{data_uri(payload)}".encode("ascii"))
+
+    # ========== Lookup ==========
+    def load(self, image_path):
+        """Return the ImagePayload of an image, encoding and storing it on a miss"""
+        stat = os.stat(image_path)
+        path_key = hash_parts(os.path.realpath(image_path), str(stat.st_size), str(stat.st_mtime_ns), self._fingerprint)
+        path_file = self._shard(self._path_dir, path_key)
+
+        # Known (path, size, mtime): no need to read the image at all
+        try:
+            with open(path_file, "r", encoding="ascii") as f:
+                payload = self._read_payload(f.read().strip())
+        except OSError:
+            payload = None
+        if payload is not None:
+            self.optimizer.account(payload.original_size, payload.payload_size)
+            with self._lock:
+                self.hits += 1
+                self.path_hits += 1
+            return payload
+
+        with open(image_path, "rb") as f:
+            image_bytes = f.read()
+        key = hash_parts(image_bytes, self._fingerprint)
+        payload = self._read_payload(key)
+        if payload is not None:
+            # Same content under another path (copy, re-upload) or a touched file
+            self.optimizer.account(payload.original_size, payload.payload_size)
+            with self._lock:
+                self.hits += 1
+        else:
+            payload = self.optimizer.encode(image_bytes, image_path)
+            self._write_payload(key, payload)
+            with self._lock:
+                self.misses += 1
+        self._write_atomic(path_file, key.encode("ascii"))
+        return payload
+
+    # ========== Size Bound ==========
+    def _payload_files(self):
+        """[(mtime, size, path)] of every stored payload"""
+        files = []
+        for shard in os.scandir(self._payload_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.startswith(".tmp-"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        return files
+
+    def size(self):
+        """Total bytes of stored payloads"""
+        return sum(size for _, size, _ in self._payload_files())
+
+    def evict(self):
+        """Remove least-recently used payloads until the store is under its size budget"""
+        if not self.max_bytes:
+            return 0
+        files = self._payload_files()
+        excess = sum(size for _, size, _ in files) - self.max_bytes
+        removed = 0
+        for _, size, path in sorted(files):
+            if excess <= 0:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            excess -= size
+            removed += 1
+        # Path index entries of removed payloads are left behind; a lookup through them is a miss
+        self.evicted += removed
+        return removed
+
+    def stats(self):
+        """Return hit/miss counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "path_hits": self.path_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evicted": self.evicted,
+            }
+
+    def summary(self):
+        stats = self.stats()
+        budget = f" of {self.max_bytes / 1024 / 1024:.0f} MB" if self.max_bytes else ""
+        return (f"{stats['hits']} hits ({stats['path_hits']} without reading the image), {stats['misses']} misses "
+                f"({stats['hit_rate'] * 100:.1f}% hit rate), {self.size() / 1024 / 1024:.1f} MB stored{budget}, "
+                f"evicted {stats['evicted']} payloads")
+
+
+def create_image_loader(optimizer, store_dir=None, max_size_mb=2048):
+    """Return (load_fn, store): the payload store's loader when store_dir is set, else the optimizer's"""
+    if not store_dir:
+        return optimizer.load, None
+    store = PayloadStore(store_dir, optimizer, max_size_mb=max_size_mb)
+    store.evict()
+    return store.load, store
@@ -0,0 +1,96 @@
+"""
+Local pre-judge for answer pairs that do not need an LLM judge.
+
+Both generated answers are often identical or differ only in punctuation,
+case or a word or two; the judge then spends a full few-shot call to report
+that "both answers are identical". The pre-judge normalizes both answers and
+scores their similarity as the Jaccard index of their word and word-pair sets
+(pairs keep "is" and "is not" apart). At or above the threshold answer 1 is
+selected without a judge call. Pairs with an empty answer or a step 2 failure
+message ("API call failed: ...", "No response generated") always go to the
+judge: two identical errors are not two identical answers.
+"""
+
+import re
+import threading
+import unicodedata
+
+_WORD = re.compile(r"\w+")
+
+# Answers step 2 writes instead of a model answer (see FAILED_ANSWER_PREFIXES in the step 2 scripts)
+FAILED_ANSWER_PREFIXES = ("API call failed:", "Failed to read image", "Failed to build prompt:")
+FAILED_ANSWERS = ("No response generated", "Missing required fields")
+
+
+def normalize_answer(text):
+    """Lower-case NFKC text with punctuation dropped and whitespace collapsed"""
+    return " ".join(_WORD.findall(unicodedata.normalize("NFKC", str(text)).lower()))
+
+
+def is_unusable_answer(text):
+    """Whether an answer is empty or a step 2 failure message rather than a model answer"""
+    text = str(text).strip()
+    return not normalize_answer(text) or text in FAILED_ANSWERS or text.startswith(FAILED_ANSWER_PREFIXES)
+
+
+def shingles(normalized):
+    words = normalized.split()
+    return set(words) | {f"{a} {b}" for a, b in zip(words, words[1:])}
+
+
+def answer_similarity(answer1, answer2):
+    """1.0 for answers that are equal after normalization, else the Jaccard index of their word shingles"""
+    normalized1, normalized2 = normalize_answer(answer1), normalize_answer(answer2)
+    if normalized1 == normalized2:
+        return 1.0
+    set1, set2 = shingles(normalized1), shingles(normalized2)
+    union = set1 | set2
+    return len(set1 & set2) / len(union) if union else 0.0
+
+
+class PreJudge:
+    """Selects answer 1 locally when both answers are at least `threshold` similar"""
+
+    def __init__(self, threshold=0.9):
+        if not 0 < threshold <= 1:
+            raise ValueError(f"threshold must be in (0, 1], got {threshold}")
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self.checked = 0
+        self.selected = 0
+        self.identical = 0
+        self.unusable = 0
+
+    def check(self, answer1, answer2):
+        """Return the similarity if the pair can be settled without the judge, else None
+
+        Empty and failed answers are never settled locally.
+        """
+        if is_unusable_answer(answer1) or is_unusable_answer(answer2):
+            with self._lock:
+                self.checked += 1
+                self.unusable += 1
+            return None
+        similarity = answer_similarity(answer1, answer2)
+        with self._lock:
+            self.checked += 1
+            if similarity < self.threshold:
+                return None
+            self.selected += 1
+            if similarity == 1.0:
+                self.identical += 1
+        return similarity
+
+    @staticmethod
+    def reason(similarity):
+        """evaluation_reason of an auto-selected record"""
+        if similarity == 1.0:
+            return "Auto-selected: both answers are identical after normalization; Answer 1 selected without a judge call."
+        return (f"Auto-selected: answers are near-identical (similarity {similarity:.2f}); "
+                f"Answer 1 selected without a judge call.")
+
+    def summary(self):
+        share = self.selected / self.checked * 100 if self.checked else 0.0
+        return (f"{self.selected}/{self.checked} answer pairs auto-selected ({self.identical} identical, "
+                f"threshold {self.threshold}), {share:.1f}% of judge calls avoided, {self.unusable} pairs with an "
+                f"empty or failed answer sent to the judge")
@@ -0,0 +1,129 @@
+"""
+Prefetching image loader.
+
+Reading an image from (network) storage and base64-encoding it used to happen
+inline, right before the blocking API call. ``ImagePrefetcher`` keeps the next
+K images loading on a background thread pool while the current request is in
+flight, and records queue-depth and stall-time counters so K can be sized.
+"""
+
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ImagePrefetcher:
+    """Load images ahead of consumption with a bounded look-ahead queue
+
+    Iterating (or awaiting ``next_async``) yields ``(payload, error)`` pairs in
+    the order of ``paths``; a ``None`` path yields ``(None, None)`` without
+    loading anything.
+    """
+
+    def __init__(self, load_fn, paths, lookahead=4, workers=None):
+        self.load_fn = load_fn
+        self.lookahead = max(1, lookahead)
+        self._paths = iter(paths)
+        self._queue = deque()
+        self._executor = ThreadPoolExecutor(max_workers=workers or self.lookahead,
+                                            thread_name_prefix="image-prefetch")
+        self._lock = threading.Lock()
+
+        self.items = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+        self.depth_total = 0
+        self.max_depth = 0
+
+    def _load(self, path):
+        if path is None:
+            return None, None
+        try:
+            return self.load_fn(path), None
+        except Exception as e:
+            return None, e
+
+    def _fill(self):
+        """Keep up to `lookahead` loads submitted ahead of the consumer"""
+        while len(self._queue) < self.lookahead:
+            try:
+                path = next(self._paths)
+            except StopIteration:
+                break
+            self._queue.append(self._executor.submit(self._load, path))
+
+    def _pop(self):
+        """Take the next future and record how many loads were already finished"""
+        with self._lock:
+            self._fill()
+            if not self._queue:
+                raise StopIteration
+            depth = sum(1 for future in self._queue if future.done())
+            self.items += 1
+            self.depth_total += depth
+            self.max_depth = max(self.max_depth, depth)
+            future = self._queue.popleft()
+            self._fill()
+            return future
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        future = self._pop()
+        if not future.done():
+            stall_start = time.perf_counter()
+            result = future.result()
+            self._record_stall(time.perf_counter() - stall_start)
+            return result
+        return future.result()
+
+    async def next_async(self):
+        """Await the next (payload, error) pair without blocking the event loop"""
+        try:
+            future = self._pop()
+        except StopIteration:
+            raise StopAsyncIteration
+        if not future.done():
+            stall_start = time.perf_counter()
+            result = await asyncio.wrap_future(future)
+            self._record_stall(time.perf_counter() - stall_start)
+            return result
+        return future.result()
+
+    def _record_stall(self, seconds):
+        with self._lock:
+            self.stalls += 1
+            self.stall_time += seconds
+
+    def stats(self):
+        """Queue-depth and stall counters"""
+        with self._lock:
+            return {
+                "items": self.items,
+                "lookahead": self.lookahead,
+                "stalls": self.stalls,
+                "stall_time": self.stall_time,
+                "avg_queue_depth": self.depth_total / self.items if self.items else 0.0,
+                "max_queue_depth": self.max_depth,
+            }
+
+    def summary(self):
+        """One-line summary of the prefetch counters"""
+        stats = self.stats()
+        return (f"look-ahead {stats['lookahead']}, {stats['items']} items, "
+                f"avg ready queue depth {stats['avg_queue_depth']:.2f} (max {stats['max_queue_depth']}), "
+                f"{stats['stalls']} stalls totalling {stats['stall_time']:.2f}s")
+
+    def close(self):
+        for future in self._queue:
+            future.cancel()
+        self._executor.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
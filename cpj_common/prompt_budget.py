@@ -0,0 +1,81 @@
+"""
+Per-record prompt token budget with few-shot fallback.
+
+Every step 2 request carries the full few-shot prompt, however long the
+caption and question of the record are. A ``PromptBudget`` precompiles the
+prompt in every size from all few-shot examples down to the zero-shot
+template, counts each record's prompt tokens locally (the same estimate the
+rate limiter uses, images included) and sends the largest variant that fits
+``max_prompt_tokens``: examples are dropped from the end one at a time, and
+the zero-shot template is the last resort. Records that do not fit even
+zero-shot are sent zero-shot and counted as over budget.
+"""
+
+from collections import Counter
+
+from langchain.prompts.chat import ChatPromptTemplate
+
+from .prompt_prefix import PromptPrefix
+from .rate_limit import estimate_tokens
+
+FULL_PROMPT = "few_shot"
+
+
+class PromptBudget:
+    """Prompt variants of a few-shot chat prompt, largest first, picked per record to fit a token cap
+
+    The chat prompt is a system message, example human/AI message pairs and the per-record human template.
+    Variants are named ``few_shot`` (all examples), ``few_shot_<k>`` (first k examples) and ``zero_shot``.
+    With ``max_prompt_tokens=None`` the full prompt is always used.
+    """
+
+    def __init__(self, chat_prompt, zero_shot_prompt=None, max_prompt_tokens=None, **prefix_variables):
+        templates = list(chat_prompt.messages)
+        system, example_messages, final = templates[0], templates[1:-1], templates[-1]
+        self.max_prompt_tokens = max_prompt_tokens
+
+        self.variants = [(FULL_PROMPT, PromptPrefix(chat_prompt, **prefix_variables))]
+        for count in range(len(example_messages) // 2 - 1, 0, -1):
+            prompt = ChatPromptTemplate.from_messages([system] + example_messages[:2 * count] + [final])
+            self.variants.append((f"few_shot_{count}", PromptPrefix(prompt, **prefix_variables)))
+        if zero_shot_prompt is None:
+            zero_shot_prompt = ChatPromptTemplate.from_messages([system, final])
+        self.variants.append(("zero_shot", PromptPrefix(zero_shot_prompt, **prefix_variables)))
+        self.prefix_tokens = [estimate_tokens(prefix.messages) for _, prefix in self.variants]
+
+        self.used = Counter()
+        self.over_budget = 0
+        self.saved_tokens = 0
+
+    @property
+    def enabled(self):
+        return bool(self.max_prompt_tokens)
+
+    @property
+    def full(self):
+        """PromptPrefix of the full few-shot prompt"""
+        return self.variants[0][1]
+
+    def fit(self, final_message):
+        """Return (variant name, messages): the largest prefix that fits the cap, followed by final_message"""
+        chosen = 0
+        if self.enabled:
+            final_tokens = estimate_tokens([final_message])
+            fitting = [position for position, tokens in enumerate(self.prefix_tokens)
+                       if tokens + final_tokens <= self.max_prompt_tokens]
+            if fitting:
+                chosen = fitting[0]
+            else:
+                chosen = len(self.variants) - 1
+                self.over_budget += 1
+            self.saved_tokens += self.prefix_tokens[0] - self.prefix_tokens[chosen]
+        name, prefix = self.variants[chosen]
+        self.used[name] += 1
+        return name, list(prefix.messages) + [final_message]
+
+    def summary(self):
+        order = [name for name, _ in self.variants]
+        used = ", ".join(f"{self.used[name]} {name}" for name in order if self.used[name])
+        return (f"{used or '0 requests'} (cap {self.max_prompt_tokens} tokens, full prompt prefix "
+                f"~{self.prefix_tokens[0]} tokens), ~{self.saved_tokens} prompt tokens saved, "
+                f"{self.over_budget} over budget even zero-shot")
@@ -0,0 +1,29 @@
+"""
+Precompiled few-shot prompts.
+
+The system prompt and few-shot examples of every stage are invariant, yet
+``chat_prompt.format_messages(...)`` re-renders them for each record. A
+``PromptPrefix`` renders them once into an immutable tuple of messages and only
+formats the final human message per record, so the prefix sent to the provider
+is byte-identical across calls and provider-side prefix caching can hit.
+"""
+
+from langchain.prompts.chat import ChatPromptTemplate
+
+
+class PromptPrefix:
+    """A chat prompt split into a pre-rendered prefix and a per-record suffix template"""
+
+    def __init__(self, chat_prompt, **prefix_variables):
+        templates = list(chat_prompt.messages)
+        self.prefix_variables = prefix_variables
+        self.messages = tuple(ChatPromptTemplate.from_messages(templates[:-1]).format_messages(**prefix_variables))
+        self.suffix_template = templates[-1]
+
+    def suffix(self, **variables):
+        """Render only the per-record message"""
+        return self.suffix_template.format(**{**self.prefix_variables, **variables})
+
+    def build(self, **variables):
+        """Return the full message list: the shared prefix followed by the rendered suffix"""
+        return list(self.messages) + [self.suffix(**variables)]
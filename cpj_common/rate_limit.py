@@ -0,0 +1,142 @@
+"""
+Client-side request and token rate limiting.
+
+Providers enforce quotas as requests per minute (RPM) and tokens per minute
+(TPM). Running more concurrent requests than the quota allows only produces
+429 responses and retries, so each request first takes one request and its
+estimated tokens from two token buckets, each of which refills continuously
+at its per-minute rate. Image tokens are estimated the way vision models bill
+them (85 base tokens plus 170 per 512-pixel tile after scaling), so requests
+with large images are paced accordingly.
+"""
+
+import asyncio
+import base64
+import io
+import math
+import time
+
+from PIL import Image
+
+CHARS_PER_TOKEN = 4            # rough average for English prompts
+MESSAGE_OVERHEAD_TOKENS = 4    # role and separators per chat message
+IMAGE_BASE_TOKENS = 85
+IMAGE_TILE_TOKENS = 170
+
+
+# ========== Token Estimation ==========
+def image_tokens(width, height):
+    """Billed tokens of a high-detail image: scaled into 2048x2048, shortest side to 768, then 512px tiles"""
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return IMAGE_BASE_TOKENS + IMAGE_TILE_TOKENS * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def data_uri_tokens(url):
+    """Estimated tokens of a base64 data URI image, the maximum for an image that cannot be decoded"""
+    try:
+        encoded = url.split(";base64,", 1)[1]
+        with Image.open(io.BytesIO(base64.b64decode(encoded))) as image:
+            return image_tokens(*image.size)
+    except Exception:
+        return image_tokens(2048, 2048)
+
+
+def estimate_tokens(messages, completion_tokens=0):
+    """Estimated prompt tokens of chat messages (text and data URI images) plus the expected completion"""
+    tokens = completion_tokens
+    for message in messages:
+        tokens += MESSAGE_OVERHEAD_TOKENS
+        content = message.content
+        if isinstance(content, str):
+            tokens += len(content) // CHARS_PER_TOKEN
+            continue
+        for part in content:
+            if part.get("type") == "text":
+                tokens += len(part["text"]) // CHARS_PER_TOKEN
+            elif part.get("type") == "image_url":
+                tokens += data_uri_tokens(part["image_url"]["url"])
+    return tokens
+
+
+# ========== Token Buckets ==========
+class TokenBucket:
+    """Holds up to `per_minute` units and refills continuously at `per_minute` units per minute"""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until `amount` units are available (a request above capacity only needs a full bucket)"""
+        self._refill()
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount):
+        self.level -= min(amount, self.capacity)
+
+
+class RateLimiter:
+    """Pace requests to stay within requests-per-minute and estimated tokens-per-minute quotas
+
+    Either limit may be None. Waiting requests are served in arrival order.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._lock = None
+
+        self.acquired = 0
+        self.estimated_tokens = 0
+        self.waits = 0
+        self.wait_time = 0.0
+
+    @property
+    def enabled(self):
+        return self.requests is not None or self.tokens is not None
+
+    async def acquire(self, tokens=0):
+        """Wait until one request carrying `tokens` estimated tokens fits in both quotas"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            waited = 0.0
+            while True:
+                delay = max(
+                    self.requests.wait_time(1) if self.requests is not None else 0.0,
+                    self.tokens.wait_time(tokens) if self.tokens is not None else 0.0,
+                )
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+                waited += delay
+
+            if self.requests is not None:
+                self.requests.take(1)
+            if self.tokens is not None:
+                self.tokens.take(tokens)
+            self.acquired += 1
+            self.estimated_tokens += tokens
+            if waited:
+                self.waits += 1
+                self.wait_time += waited
+
+    def summary(self):
+        limits = []
+        if self.requests is not None:
+            limits.append(f"{self.requests.capacity:.0f} requests/min")
+        if self.tokens is not None:
+            limits.append(f"{self.tokens.capacity:.0f} tokens/min")
+        return (f"{self.acquired} requests, ~{self.estimated_tokens} estimated tokens, {self.waits} waited "
+                f"{self.wait_time:.2f}s in total (limits: {', '.join(limits) or 'none'})")
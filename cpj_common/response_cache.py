@@ -0,0 +1,129 @@
+"""
+Content-addressed on-disk cache for model responses.
+
+Responses are stored in a single SQLite file keyed by a SHA-256 digest of
+everything that determines the output (image bytes, rendered prompt and model
+parameters). Entries are evicted by age and, once the cache grows beyond its
+size budget, by least-recent access.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+# ========== Key Helpers ==========
+def hash_parts(*parts):
+    """Hash bytes/str parts into a hex digest (length-prefixed so parts cannot collide)"""
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def render_messages(messages):
+    """Render a list of chat messages into a stable string for hashing"""
+    return json.dumps(
+        [[msg.type, msg.content] for msg in messages],
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+
+
+def model_fingerprint(model, fields=("model_name", "temperature", "max_tokens", "top_p",
+                                     "frequency_penalty", "presence_penalty", "model_kwargs")):
+    """Collect the generation settings of a chat model into a stable string"""
+    params = {}
+    for field in fields:
+        value = getattr(model, field, None)
+        if value is not None:
+            params[field] = value
+    return json.dumps(params, sort_keys=True, default=str)
+
+
+# ========== Response Cache ==========
+class ResponseCache:
+    """SQLite-backed response cache with size/age-based eviction"""
+
+    def __init__(self, cache_dir, max_size_mb=1024, max_age_days=30, filename="responses.sqlite"):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, filename)
+        self.max_bytes = int(max_size_mb * 1024 * 1024) if max_size_mb else None
+        self.max_age = max_age_days * 86400 if max_age_days else None
+        self.hits = 0
+        self.misses = 0
+
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_accessed ON responses (accessed)")
+        self._conn.commit()
+
+    def get(self, key):
+        """Return the cached value for key, or None on a miss or expired entry"""
+        row = self._conn.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row is None or (self.max_age and now - row[1] > self.max_age):
+            self.misses += 1
+            return None
+
+        self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        self._conn.commit()
+        self.hits += 1
+        return row[0]
+
+    def put(self, key, value):
+        """Store value under key"""
+        now = time.time()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO responses (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+            (key, value, len(value.encode("utf-8")), now, now),
+        )
+        self._conn.commit()
+
+    def evict(self):
+        """Drop expired entries, then least-recently accessed ones until under the size budget"""
+        removed = 0
+        if self.max_age:
+            cursor = self._conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,))
+            removed += cursor.rowcount
+
+        if self.max_bytes:
+            total_size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total_size > self.max_bytes:
+                excess = total_size - self.max_bytes
+                stale_keys = []
+                for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY accessed"):
+                    if excess <= 0:
+                        break
+                    stale_keys.append((key,))
+                    excess -= size
+                self._conn.executemany("DELETE FROM responses WHERE key = ?", stale_keys)
+                removed += len(stale_keys)
+
+        self._conn.commit()
+        return removed
+
+    def stats(self):
+        """Return hit/miss counters"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,119 @@
+"""
+Resume support for the stage scripts.
+
+A resumed run reads whatever the interrupted run left behind (the final output
+and the JSONL checkpoint), indexes the successful records by key and only
+sends the missing or failed ones to the model. Completed records are
+snapshotted to ``<checkpoint>.prev`` before the new run truncates its
+checkpoint, so a crash during a resumed run loses nothing either.
+"""
+
+import json
+import os
+
+from .jsonl_sink import iter_jsonl
+
+
+# ========== Record Keys ==========
+def question_key(record, position):
+    """Key a record by question_id, falling back to its input position, image and question text
+
+    Without a question_id the same question asked twice about one image is still two records,
+    so the position keeps their answers apart.
+    """
+    if record.get("question_id") is not None:
+        return str(record["question_id"])
+    if "image" in record or "question" in record:
+        return f"{position}\n{record.get('image', '')}\n{record.get('question', '')}"
+    return None
+
+
+def keyed_record(position, record):
+    """Checkpoint line holding a record together with its question_key"""
+    return {"key": question_key(record, position), "record": record}
+
+
+def image_key(record):
+    """Key a record by its image path"""
+    return record.get("image")
+
+
+# ========== Loading Previous Results ==========
+def read_records(path):
+    """Read records from a JSON array or JSONL file, returning [] if it is missing or unreadable"""
+    if not path or not os.path.exists(path):
+        return []
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            records = json.load(f)
+        if isinstance(records, list):
+            return records
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        pass
+    return list(iter_jsonl(path))
+
+
+def previous_path(checkpoint_path):
+    return f"{checkpoint_path}.prev"
+
+
+def load_completed(paths, key_fn, is_failed):
+    """Index successful records from the given files by key (later files win)"""
+    completed = {}
+    for path in paths:
+        for record in read_records(path):
+            if not isinstance(record, dict):
+                continue
+            key = key_fn(record)
+            if key is None or is_failed(record):
+                continue
+            completed[key] = record
+    return completed
+
+
+def load_for_resume(checkpoint_path, key_fn, is_failed, output_path=None, records=None):
+    """Load completed records from an interrupted run and snapshot them before the checkpoint is truncated
+
+    `records` may supply previous results that are not stored as a single file (they rank below the checkpoint).
+    """
+    completed = {}
+    for record in records or []:
+        key = key_fn(record)
+        if key is not None and not is_failed(record):
+            completed[key] = record
+    paths = [output_path, previous_path(checkpoint_path), checkpoint_path]
+    completed.update(load_completed([p for p in paths if p], key_fn, is_failed))
+
+    snapshot = previous_path(checkpoint_path)
+    tmp_path = f"{snapshot}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for record in completed.values():
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, snapshot)
+    if os.path.exists(checkpoint_path) and os.path.abspath(checkpoint_path) != os.path.abspath(output_path or ""):
+        os.remove(checkpoint_path)
+    return completed
+
+
+def load_keyed_for_resume(checkpoint_path, is_failed, output_path):
+    """load_for_resume for checkpoints of keyed_record lines, returning {question_key: record}
+
+    The previous output is a plain array in input order, so its records are keyed by their index.
+    """
+    previous = [keyed_record(position, record) for position, record in enumerate(read_records(output_path))
+                if isinstance(record, dict)]
+    completed = load_for_resume(checkpoint_path, lambda line: line.get("key"), lambda line: is_failed(line["record"]),
+                                records=previous)
+    return {key: line["record"] for key, line in completed.items()}
+
+
+def count_resumed(records, resumed, key_fn=question_key):
+    """Number of input records served from `resumed` rather than sent to the model"""
+    return sum(key_fn(record, position) in resumed for position, record in enumerate(records))
+
+
+def finish_resume(checkpoint_path):
+    """Remove the resume snapshot once the run has written its final output"""
+    snapshot = previous_path(checkpoint_path)
+    if os.path.exists(snapshot):
+        os.remove(snapshot)
@@ -0,0 +1,367 @@
+"""
+One retry policy for every model call.
+
+Retrying in several layers (the OpenAI client's ``max_retries`` under a
+tenacity decorator) multiplies the attempts per record, and during a provider
+brownout that multiplies the load exactly when the provider is struggling.
+Model clients are therefore created with ``max_retries=0`` and every call goes
+through a ``RetryPolicy``, which combines:
+
+- per-call retries with full-jitter exponential backoff, waiting at least as
+  long as a ``Retry-After`` header asks;
+- a retry budget shared by all calls of the policy: every first attempt earns
+  ``ratio`` of a retry, and a burst of at most ``reserve`` retries can be
+  saved up, so retries stay a bounded fraction of the traffic;
+- a circuit breaker that pauses dispatch for ``cooldown`` seconds once the
+  error rate over the recent calls reaches ``error_rate``, then lets a single
+  probe call through before resuming.
+
+Only transient errors are retried (connection errors, timeouts, 408, 409, 429
+and 5xx responses); other errors, including local bugs such as a ValueError,
+are raised at once and are not counted by the circuit breaker either way.
+"""
+
+import asyncio
+import contextvars
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+RETRYABLE_STATUS = (408, 409, 429)
+
+# 1-based attempt number of the call the policy is running, read by the usage tracker's callbacks
+_ATTEMPT = contextvars.ContextVar("retry_attempt", default=1)
+
+
+def current_attempt():
+    """Attempt number of the model call running in this context, 1 outside a retry policy"""
+    return _ATTEMPT.get()
+
+
+# ========== Error Classification ==========
+def status_code(exc):
+    """HTTP status of an API error, None for connection errors and other exceptions"""
+    code = getattr(exc, "status_code", None)
+    if code is None:
+        code = getattr(getattr(exc, "response", None), "status_code", None)
+    return code if isinstance(code, int) else None
+
+
+_TRANSIENT_TYPES = None
+
+
+def transient_error_types():
+    """Exception types of a request that got no response: connection errors and timeouts
+
+    The openai and httpx types are looked up on first use, so importing this module stays cheap.
+    """
+    global _TRANSIENT_TYPES
+    if _TRANSIENT_TYPES is None:
+        types = [ConnectionError, TimeoutError, asyncio.TimeoutError]
+        try:
+            import openai
+            types += [openai.APIConnectionError, openai.APITimeoutError]
+        except ImportError:
+            pass
+        try:
+            import httpx
+            types.append(httpx.TransportError)
+        except ImportError:
+            pass
+        _TRANSIENT_TYPES = tuple(types)
+    return _TRANSIENT_TYPES
+
+
+def is_retryable(exc):
+    """Whether an error is worth retrying: a connection error or timeout, 408/409/429 or a server error"""
+    code = status_code(exc)
+    if code is not None:
+        return code in RETRYABLE_STATUS or code >= 500
+    return isinstance(exc, transient_error_types())
+
+
+def retry_after(exc):
+    """Seconds the server asked to wait (retry-after-ms or Retry-After header), None if it did not say"""
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        milliseconds = headers.get("retry-after-ms")
+        if milliseconds is not None:
+            return max(0.0, float(milliseconds) / 1000)
+    except (TypeError, ValueError):
+        pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# ========== Retry Budget ==========
+class RetryBudget:
+    """Allows a retry for every 1/ratio first attempts, plus a saved-up burst of at most `reserve` retries"""
+
+    def __init__(self, ratio=0.2, reserve=10):
+        self.ratio = ratio
+        self.reserve = float(reserve)
+        self.balance = float(reserve)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        """Credit one first attempt"""
+        with self._lock:
+            self.balance = min(self.reserve, self.balance + self.ratio)
+
+    def withdraw(self):
+        """Take one retry, False when the budget is exhausted"""
+        with self._lock:
+            if self.balance < 1:
+                return False
+            self.balance -= 1
+            return True
+
+
+# ========== Circuit Breaker ==========
+class CircuitBreaker:
+    """Opens when the error rate over the last `window` calls reaches `error_rate`
+
+    While open, dispatch is paused for `cooldown` seconds; then a single probe call is let through, which closes
+    the breaker on success and reopens it on failure. ``before_call()`` hands the probe a token, and only the
+    outcome recorded with that token settles the half-open state: calls that were already in flight when the
+    breaker opened finish without touching it. A probe that never reports back is replaced after `cooldown`.
+    """
+
+    def __init__(self, error_rate=0.5, window=20, min_calls=10, cooldown=30.0):
+        self.error_rate = error_rate
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.outcomes = deque(maxlen=window)
+        self.opened_at = None
+        self.probe = None
+        self.probe_started = None
+        self.probes = 0
+        self.opens = 0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Return (seconds to wait before dispatching, probe token); dispatch now when the wait is 0
+
+        The token is None for ordinary calls and must be passed back to record() by the probe call.
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return 0.0, None
+            now = time.monotonic()
+            remaining = self.opened_at + self.cooldown - now
+            if remaining > 0:
+                return remaining, None
+            if self.probe is not None and now - self.probe_started < self.cooldown:
+                # Another call is probing, check again shortly
+                return min(1.0, self.cooldown), None
+            self.probes += 1
+            self.probe = self.probes
+            self.probe_started = now
+            return 0.0, self.probe
+
+    def record(self, failed, probe=None):
+        """Count the outcome of a call; only transient errors count as failures"""
+        with self._lock:
+            if self.opened_at is not None:
+                if probe is None or probe != self.probe:
+                    # A call dispatched before the breaker opened (or a superseded probe) says nothing about now
+                    return
+                self.probe = None
+                if failed:
+                    self.opened_at = time.monotonic()
+                    self.opens += 1
+                else:
+                    self.opened_at = None
+                    self.outcomes.clear()
+                return
+            self.outcomes.append(failed)
+            if len(self.outcomes) >= self.min_calls and sum(self.outcomes) / len(self.outcomes) >= self.error_rate:
+                self.opened_at = time.monotonic()
+                self.opens += 1
+
+    def release(self, probe):
+        """Give up a probe without an outcome, so the next call probes instead"""
+        if probe is None:
+            return
+        with self._lock:
+            if probe == self.probe:
+                self.probe = None
+
+
+# ========== Retry Policy ==========
+class RetryPolicy:
+    """Runs model calls with bounded, budgeted, jittered retries behind a circuit breaker
+
+    ``acall(fn, ...)`` awaits ``fn(...)``, ``call(fn, ...)`` is the blocking variant. Share one policy between
+    components to give them one retry budget and one breaker.
+    """
+
+    def __init__(self, max_retries=2, base_delay=1.0, max_delay=20.0, max_retry_after=60.0,
+                 budget_ratio=0.2, budget_reserve=10, breaker_error_rate=0.5, breaker_cooldown=30.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.budget = RetryBudget(budget_ratio, budget_reserve)
+        self.breaker = CircuitBreaker(error_rate=breaker_error_rate, cooldown=breaker_cooldown) \
+            if breaker_error_rate else None
+
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.failed = 0
+        self.budget_exhausted = 0
+        self.retry_after_waits = 0
+        self.paused = 0.0
+
+    def backoff(self, attempt, exc):
+        """Delay before retry number `attempt` (1-based): full jitter, at least the server's Retry-After"""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        requested = retry_after(exc)
+        if requested is not None:
+            with self._lock:
+                self.retry_after_waits += 1
+            delay = max(delay, min(requested, self.max_retry_after) + random.uniform(0, self.base_delay))
+        return delay
+
+    def _dispatch(self):
+        """(seconds to wait before the next attempt, breaker probe token)"""
+        if self.breaker is None:
+            return 0.0, None
+        delay, probe = self.breaker.before_call()
+        if delay:
+            with self._lock:
+                self.paused += delay
+        return delay, probe
+
+    def _after_failure(self, exc, attempt, probe):
+        """Delay before the next attempt, None to give up and raise"""
+        retryable = is_retryable(exc)
+        if self.breaker is not None:
+            if retryable:
+                self.breaker.record(True, probe)
+            else:
+                # Says nothing about the provider's health: neither a failure nor a successful probe
+                self.breaker.release(probe)
+        if not retryable or attempt > self.max_retries:
+            return None
+        if not self.budget.withdraw():
+            with self._lock:
+                self.budget_exhausted += 1
+            return None
+        with self._lock:
+            self.retries += 1
+        return self.backoff(attempt, exc)
+
+    def _start(self):
+        self.budget.deposit()
+        with self._lock:
+            self.calls += 1
+
+    def _succeeded(self, probe):
+        if self.breaker is not None:
+            self.breaker.record(False, probe)
+
+    def _give_up(self):
+        with self._lock:
+            self.failed += 1
+
+    async def acall(self, fn, *args, **kwargs):
+        """Await fn(*args, **kwargs) under the policy, raising the last error when retries are used up"""
+        self._start()
+        attempt = 0
+        while True:
+            delay, probe = self._dispatch()
+            while delay:
+                await asyncio.sleep(delay)
+                delay, probe = self._dispatch()
+            attempt += 1
+            context = _ATTEMPT.set(attempt)
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as exc:
+                delay = self._after_failure(exc, attempt, probe)
+                if delay is None:
+                    self._give_up()
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            finally:
+                _ATTEMPT.reset(context)
+            self._succeeded(probe)
+            return result
+
+    def call(self, fn, *args, **kwargs):
+        """Blocking variant of acall()"""
+        self._start()
+        attempt = 0
+        while True:
+            delay, probe = self._dispatch()
+            while delay:
+                time.sleep(delay)
+                delay, probe = self._dispatch()
+            attempt += 1
+            context = _ATTEMPT.set(attempt)
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as exc:
+                delay = self._after_failure(exc, attempt, probe)
+                if delay is None:
+                    self._give_up()
+                    raise
+                time.sleep(delay)
+                continue
+            finally:
+                _ATTEMPT.reset(context)
+            self._succeeded(probe)
+            return result
+
+    def stats(self):
+        """Return retry counters"""
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "retries": self.retries,
+                "retry_after_waits": self.retry_after_waits,
+                "failed": self.failed,
+                "budget_exhausted": self.budget_exhausted,
+                "breaker_opens": self.breaker.opens if self.breaker is not None else 0,
+                "paused_seconds": self.paused,
+            }
+
+    def summary(self):
+        stats = self.stats()
+        return (f"{stats['calls']} calls, {stats['retries']} retries ({stats['retry_after_waits']} honoring "
+                f"Retry-After), {stats['failed']} failed, {stats['budget_exhausted']} retries refused by the budget, "
+                f"breaker opened {stats['breaker_opens']} times, paused {stats['paused_seconds']:.1f}s")
+
+
+def add_retry_arguments(parser, max_retries=2):
+    """Register the shared retry policy options on an argparse parser"""
+    parser.add_argument("--max-retries", type=int, default=max_retries,
+                        help=f"Retries per model call for transient errors (default: {max_retries})")
+    parser.add_argument("--retry-budget", type=float, default=0.2,
+                        help="Retries allowed per call over the whole run, plus a burst of 10 (default: 0.2)")
+    parser.add_argument("--breaker-error-rate", type=float, default=0.5,
+                        help="Pause dispatch when this share of the last 20 calls failed, 0 disables (default: 0.5)")
+    parser.add_argument("--breaker-cooldown", type=float, default=30.0,
+                        help="Seconds dispatch stays paused once the breaker opens (default: 30)")
+
+
+def retry_policy_from_config(config):
+    """RetryPolicy for a stage config with max_retries, retry_budget, breaker_error_rate and breaker_cooldown"""
+    return RetryPolicy(max_retries=config.max_retries, budget_ratio=config.retry_budget,
+                       breaker_error_rate=config.breaker_error_rate, breaker_cooldown=config.breaker_cooldown)
@@ -0,0 +1,49 @@
+"""
+Registry of step 2 task profiles.
+
+A task profile bundles what distinguishes one dual-answer VQA task from
+another: the answer schema, the system prompt, the few-shot examples, the
+model settings and the generator class that runs it. Each step 2 script
+registers its profile when it is imported, so ``vqa_runner.py`` can run any
+combination of tasks over one pass of the dataset.
+"""
+
+from dataclasses import dataclass
+from typing import Any, Dict, List
+
+
+@dataclass(frozen=True)
+class TaskProfile:
+    """Everything that is specific to one step 2 task"""
+    name: str
+    description: str
+    answer_fields: Dict[str, str]      # Output schema: answer name -> description
+    system_template: str
+    human_template: str
+    examples: List[Dict[str, str]]
+    reasoning_effort: str
+    verbosity: str
+    generator_class: Any               # DualAnswerGenerator of the task's script
+    config_class: Any                  # VQAConfig of the task's script
+
+    @property
+    def output_name(self):
+        """Default output file name of the task"""
+        return f"{self.name}_vqa.json"
+
+
+TASK_PROFILES = {}
+
+
+def register_task(profile):
+    """Add a profile to the registry; registering the same name again replaces it"""
+    TASK_PROFILES[profile.name] = profile
+    return profile
+
+
+def get_task(name):
+    """Return a registered profile, ValueError for an unknown name"""
+    try:
+        return TASK_PROFILES[name]
+    except KeyError:
+        raise ValueError(f"Unknown task {name!r}, registered tasks: {', '.join(sorted(TASK_PROFILES))}") from None
@@ -0,0 +1,155 @@
+"""
+Token, latency and cost accounting: prices, aggregation and the usage report.
+
+The per-call records come from ``UsageTracker`` (``cpj_common.usage_tracker``),
+the LangChain callback that is only imported when a model is built; this module
+does not import LangChain, so the stage scripts can register the usage options
+and write the report at import time. ``write_usage_report`` aggregates the
+trackers of a run's stages into a summary JSON.
+"""
+
+import json
+import math
+
+# USD per 1M tokens: (prompt, cached prompt, completion). List prices, only used for cost estimates; models
+# are matched by the longest prefix of the model name the API reports.
+MODEL_PRICES = {
+    "gpt-3.5-turbo": (0.50, 0.50, 1.50),
+    "gpt-4": (30.00, 30.00, 60.00),
+    "gpt-4-turbo": (10.00, 10.00, 30.00),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4.1": (2.00, 0.50, 8.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1-nano": (0.10, 0.025, 0.40),
+}
+
+PERCENTILES = (50, 95, 99)
+
+
+def model_prices(model_name):
+    """(prompt, cached prompt, completion) USD per 1M tokens of a model, None for an unknown model"""
+    name = (model_name or "").lower()
+    matches = [key for key in MODEL_PRICES if name.startswith(key)]
+    return MODEL_PRICES[max(matches, key=len)] if matches else None
+
+
+def resolve_prices(prices, model_name):
+    """(prompt, cached prompt, completion) prices of a call to model_name
+
+    ``prices`` overrides the list prices; a None cached price applies the model's listed cache discount to the
+    given prompt price (no discount for an unknown model). Returns None when nothing is known.
+    """
+    listed = model_prices(model_name)
+    if prices is None:
+        return listed
+    prompt_price, cached_price, completion_price = prices
+    if cached_price is None:
+        cached_price = prompt_price * listed[1] / listed[0] if listed and listed[0] else prompt_price
+    return prompt_price, cached_price, completion_price
+
+
+def call_cost(prices, prompt_tokens, completion_tokens, cached_tokens):
+    """Estimated USD cost of one call, None without prices"""
+    if prices is None:
+        return None
+    prompt_price, cached_price, completion_price = prices
+    return ((prompt_tokens - cached_tokens) * prompt_price + cached_tokens * cached_price
+            + completion_tokens * completion_price) / 1_000_000
+
+
+def percentiles(values, points=PERCENTILES):
+    """Nearest-rank percentiles of values as {"p50": ..., ...}, None for no values"""
+    ordered = sorted(values)
+    if not ordered:
+        return {f"p{point}": None for point in points}
+    return {f"p{point}": ordered[max(0, math.ceil(point / 100 * len(ordered)) - 1)] for point in points}
+
+
+def aggregate_calls(calls, errors=0, records=None):
+    """Summary dict of per-call usage records: totals, per-call percentiles, cost and cost per record"""
+    latencies = [call["latency"] for call in calls if call["latency"] is not None]
+    costs = [call["cost"] for call in calls if call["cost"] is not None]
+    prompt_tokens = sum(call["prompt_tokens"] for call in calls)
+    completion_tokens = sum(call["completion_tokens"] for call in calls)
+    cached_tokens = sum(call["cached_tokens"] for call in calls)
+    cost = sum(costs) if costs else None
+    # Retries made by the retry policy before each successful call
+    retries = [call.get("attempts", 1) - 1 for call in calls]
+    histogram = {}
+    for count in sorted(retries):
+        histogram[str(count)] = histogram.get(str(count), 0) + 1
+    stats = {
+        "calls": len(calls),
+        "failed_attempts": errors,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "cached_tokens": cached_tokens,
+        "cached_ratio": cached_tokens / prompt_tokens if prompt_tokens else 0.0,
+        "latency_seconds": {
+            "mean": sum(latencies) / len(latencies) if latencies else None,
+            **percentiles(latencies),
+            "max": max(latencies) if latencies else None,
+            "total": sum(latencies),
+        },
+        "prompt_tokens_per_call": percentiles([call["prompt_tokens"] for call in calls]),
+        "completion_tokens_per_call": percentiles([call["completion_tokens"] for call in calls]),
+        "retries": sum(retries),
+        "retries_per_call": {"histogram": histogram, **percentiles(retries), "max": max(retries, default=None)},
+        "estimated_cost_usd": cost,
+        "unpriced_calls": len(calls) - len(costs),
+    }
+    if records is not None:
+        stats["records"] = records
+        stats["tokens_per_record"] = (prompt_tokens + completion_tokens) / records if records else None
+        stats["retries_per_record"] = sum(retries) / records if records else None
+        stats["cost_per_record_usd"] = cost / records if records and cost is not None else None
+    return stats
+
+
+# ========== Usage Report ==========
+def usage_report(stages, retry_policy=None):
+    """Aggregate {stage name: (UsageTracker, records)} into a report dict with per-stage and total usage"""
+    report = {"stages": {name: tracker.stats(records) for name, (tracker, records) in stages.items()}}
+    # A tracker shared by several stages counts once in the total
+    all_calls, all_errors = [], 0
+    for tracker in {id(tracker): tracker for tracker, _ in stages.values()}.values():
+        calls, errors = tracker.snapshot()
+        all_calls.extend(calls)
+        all_errors += errors
+    report["total"] = aggregate_calls(all_calls, all_errors)
+    if retry_policy is not None:
+        report["retries"] = retry_policy.stats()
+    return report
+
+
+def write_usage_report(path, stages, retry_policy=None):
+    """Write usage_report() as JSON to path and return it"""
+    report = usage_report(stages, retry_policy)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+
+def add_usage_arguments(parser):
+    """Register the shared usage accounting options on an argparse parser"""
+    parser.add_argument("--usage-report", type=str, default=None,
+                        help="Write per-stage tokens, latency percentiles and estimated cost as JSON to this path")
+    parser.add_argument("--price-per-mtok", type=float, nargs=2, metavar=("PROMPT", "COMPLETION"), default=None,
+                        help="USD per 1M prompt / completion tokens for the cost estimate, overriding the built-in "
+                             "list prices")
+    parser.add_argument("--cached-price-per-mtok", type=float, default=None,
+                        help="USD per 1M cached prompt tokens with --price-per-mtok (default: the model's listed "
+                             "cache discount applied to PROMPT, no discount for an unknown model)")
+
+
+def prices_from_args(args):
+    """(prompt, cached prompt, completion) tuple for --price-per-mtok, None when not given
+
+    The cached price is None unless --cached-price-per-mtok is given; resolve_prices() then applies the model's
+    listed discount.
+    """
+    if not args.price_per_mtok:
+        return None
+    prompt_price, completion_price = args.price_per_mtok
+    return prompt_price, args.cached_price_per_mtok, completion_price
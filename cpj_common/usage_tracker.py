@@ -0,0 +1,124 @@
+"""
+LangChain callback that records token usage, latency and cost per model call.
+
+``UsageTracker`` reads the ``usage`` block returned by the API (prompt,
+completion and cached prompt tokens), so a run can report how much of its
+prompt traffic hit the provider's prefix cache. It also times every model call
+and prices it from ``MODEL_PRICES`` (or an explicit price), keeping one small
+record per call so a stage can report latency and token percentiles. It lives
+apart from ``cpj_common.usage`` because it imports LangChain.
+"""
+
+import threading
+import time
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from .retry_policy import current_attempt
+from .usage import aggregate_calls, call_cost, resolve_prices
+
+
+def extract_token_usage(llm_result):
+    """Return (prompt_tokens, completion_tokens, cached_tokens) from an LLMResult"""
+    usage = (llm_result.llm_output or {}).get("token_usage") or {}
+    if not usage:
+        # Newer langchain-openai versions attach usage to the message instead
+        for generations in llm_result.generations:
+            for generation in generations:
+                metadata = getattr(getattr(generation, "message", None), "response_metadata", None) or {}
+                usage = metadata.get("token_usage") or {}
+                if usage:
+                    break
+            if usage:
+                break
+
+    details = usage.get("prompt_tokens_details") or {}
+    return (
+        usage.get("prompt_tokens", 0) or 0,
+        usage.get("completion_tokens", 0) or 0,
+        details.get("cached_tokens", 0) or 0,
+    )
+
+
+class UsageTracker(BaseCallbackHandler):
+    """Accumulate prompt/completion/cached token counts, latency and estimated cost over all model calls
+
+    ``prices`` is a (prompt, cached prompt, completion) USD-per-1M-token tuple that overrides ``MODEL_PRICES``; a
+    None cached price applies the model's listed discount. Each call also records its attempt number from the
+    retry policy, so the report can show how many retries the calls needed.
+    """
+
+    # Cheap bookkeeping: run in the event loop so latencies are not skewed by the callback thread pool
+    run_inline = True
+
+    def __init__(self, prices=None):
+        self._lock = threading.Lock()
+        self.prices = prices
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.errors = 0
+        self.call_log = []
+        self._started = {}
+
+    def _start(self, run_id):
+        attempt = current_attempt()
+        with self._lock:
+            self._started[run_id] = (time.monotonic(), attempt)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._start(run_id)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._start(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        with self._lock:
+            self._started.pop(run_id, None)
+            self.errors += 1
+
+    def on_llm_end(self, response, **kwargs):
+        prompt_tokens, completion_tokens, cached_tokens = extract_token_usage(response)
+        prices = resolve_prices(self.prices, (response.llm_output or {}).get("model_name"))
+        cost = call_cost(prices, prompt_tokens, completion_tokens, cached_tokens)
+        with self._lock:
+            started, attempt = self._started.pop(kwargs.get("run_id"), (None, current_attempt()))
+            self.calls += 1
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.cached_tokens += cached_tokens
+            self.call_log.append({
+                "latency": time.monotonic() - started if started is not None else None,
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "cached_tokens": cached_tokens,
+                "cost": cost,
+                "attempts": attempt,
+            })
+
+    def cached_ratio(self):
+        return self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+
+    def snapshot(self):
+        """(per-call records, failed attempts) so far"""
+        with self._lock:
+            return list(self.call_log), self.errors
+
+    def stats(self, records=None):
+        """Summary dict of all calls so far; with `records`, also tokens and cost per record"""
+        calls, errors = self.snapshot()
+        return aggregate_calls(calls, errors, records)
+
+    def summary(self):
+        """One-line summary of the token counts, latency and estimated cost"""
+        line = (f"{self.calls} calls, {self.prompt_tokens} prompt tokens "
+                f"({self.cached_tokens} cached, {self.cached_ratio() * 100:.1f}%), "
+                f"{self.completion_tokens} completion tokens")
+        stats = self.stats()
+        latency = stats["latency_seconds"]
+        if latency["p50"] is not None:
+            line += f", latency p50 {latency['p50']:.2f}s / p95 {latency['p95']:.2f}s"
+        if stats["estimated_cost_usd"] is not None:
+            line += f", ~${stats['estimated_cost_usd']:.4f}"
+        return line
@@ -5,52 +5,91 @@ This script generates image captions for agricultural images using Vision-Langua
 
 Usage:
     python caption_generation.py --input input.json --output output.json
+    python caption_generation.py --input input.json --output output.json --concurrency 8
+    python caption_generation.py --input input.json --output output.json --images-per-request 4
+
+Library usage (importing this module has no side effects; LangChain is imported lazily):
+    from caption_generation import CaptionConfig, CaptionGenerator
+    generator = CaptionGenerator(CaptionConfig(concurrency=8))
+    generator.run("input.json", "output.json")
 
 Features:
     - Generates descriptive captions using VLM with few-shot prompting
     - Describes visual features and disease symptoms without naming crops or diseases
     - Supports base64-encoded images with automatic error handling
+    - Asyncio engine with bounded concurrency, reports throughput in images/sec
+    - --images-per-request packs several images into one request, unparsed items fall back to single-image calls
+    - --dedup captions one image per cluster of near-identical images (perceptual hash) and fans the caption out
+    - Downsizes and re-encodes images (real MIME type, EXIF stripped) before base64 encoding
+    - Few-shot prefix rendered once so it stays byte-identical for provider-side prefix caching
+    - Persistent response cache keyed by image bytes, rendered prompt and model settings
+    - Background prefetcher reads and encodes the next images while requests are in flight
+    - Append-only JSONL checkpoint (<output>.partial.jsonl), converted to a JSON array at the end
+    - --resume reuses captions from an interrupted run and only captions missing or failed images
 """
 
 import argparse
+import asyncio
 import os
-import base64
 import json
 import time
 import re
+import sys
 from collections import OrderedDict
-from tenacity import retry, stop_after_attempt, wait_exponential
-from langchain_openai import ChatOpenAI
-from langchain.output_parsers import StructuredOutputParser, ResponseSchema
-from langchain_core.messages import HumanMessage, SystemMessage
-from langchain.prompts.chat import (
-    ChatPromptTemplate,
-    SystemMessagePromptTemplate,
-    HumanMessagePromptTemplate,
-)
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from cpj_common.image_dedup import ImageDeduplicator
+from cpj_common.image_payload import ImagePayloadOptimizer, add_image_arguments, data_uri, describe_savings
+from cpj_common.jsonl_sink import JsonlSink, jsonl_to_json
+from cpj_common.payload_store import create_image_loader
+from cpj_common.prefetch import ImagePrefetcher
+from cpj_common.response_cache import ResponseCache, hash_parts, model_fingerprint, render_messages
+from cpj_common.resume import finish_resume, image_key, load_for_resume
+from cpj_common.retry_policy import add_retry_arguments, retry_policy_from_config
+from cpj_common.usage import add_usage_arguments, prices_from_args, write_usage_report
 
 # ========== Configuration ==========
-os.environ["OPENAI_API_BASE"] = "YOUR_API_BASE_URL"
-os.environ["OPENAI_API_KEY"] = "YOUR_API_KEY"
-
-# ========== Parse Command Line Arguments ==========
-parser = argparse.ArgumentParser(description="Generate image captions for agricultural images")
-parser.add_argument("--input", type=str, required=True, help="Path to input JSON file")
-parser.add_argument("--output", type=str, required=True, help="Path to output JSON file")
-args = parser.parse_args()
-
-input_json = args.input
-output_json = args.output
+API_BASE = "YOUR_API_BASE_URL"
+API_KEY = "YOUR_API_KEY"
+
+
+@dataclass
+class CaptionConfig:
+    """Settings for CaptionGenerator (CLI flags map one-to-one onto these fields)"""
+    model_name: str = "qwen2.5-vl-72b-instruct"
+    temperature: float = 0.1           # Low temperature for deterministic output
+    max_tokens: int = 400              # Shorter output for concise precision
+    top_p: float = 0.8                 # Lower top_p to limit candidate token range
+    frequency_penalty: float = 0.3     # Increase frequency penalty to avoid repetition
+    presence_penalty: float = 0.2      # Light presence penalty to maintain topic focus
+    max_retries: int = 3               # Retries per call, made by the retry policy (the client itself does not retry)
+    retry_budget: float = 0.2          # Retries allowed per call over the whole run
+    breaker_error_rate: float = 0.5    # Error rate over recent calls that pauses dispatch, 0 disables
+    breaker_cooldown: float = 30
+    api_base: Optional[str] = None     # Defaults to the OPENAI_API_BASE environment variable
+    api_key: Optional[str] = None      # Defaults to the OPENAI_API_KEY environment variable
+    concurrency: int = 1
+    prefetch: int = 4
+    images_per_request: int = 1        # >1 packs several images into one request
+    dedup_threshold: Optional[int] = None  # Hamming distance for near-duplicate images, None disables
+    cache_dir: Optional[str] = ".caption_cache"  # None disables the response cache
+    cache_max_size_mb: float = 1024
+    cache_max_age_days: float = 30
+    max_image_edge: int = 1536
+    image_format: str = "jpeg"
+    image_quality: int = 85
+    payload_store_dir: Optional[str] = None  # shared store of encoded images, None disables
+    payload_store_max_size_mb: float = 2048
+    prices: Optional[Tuple[float, float, float]] = None  # USD per 1M prompt/cached/completion tokens
+    usage_report: Optional[str] = None  # Path of the per-stage usage summary JSON, None disables
+    output_format: str = "json"
+    fsync_every: int = 0
+    resume: bool = False
 
 # ========== Define Output Format ==========
-response_schemas = [
-    ResponseSchema(
-        name="image_caption",
-        description="Description of the plant's visual features and any disease symptoms, including morphology, color, distribution, size, and condition, without naming the plant or disease."
-    )
-]
-output_parser = StructuredOutputParser.from_response_schemas(response_schemas)
-format_instructions = output_parser.get_format_instructions()
+response_schema_description = "Description of the plant's visual features and any disease symptoms, including morphology, color, distribution, size, and condition, without naming the plant or disease."
 
 # ========== System Prompt ==========
 system_template = """You are an expert agricultural assistant specializing in describing plant conditions from images.
@@ -69,8 +108,6 @@ Describe the visual features of the plant and any disease symptoms in the image,
 ## Output Format
 {format_instructions}
 """
-system_message_prompt = SystemMessagePromptTemplate.from_template(system_template)
-
 # ========== Few-shot Examples ==========
 examples = [
     {
@@ -88,32 +125,44 @@ examples = [
 ]
 
 # ========== Build Prompt Templates ==========
-example_human = HumanMessagePromptTemplate.from_template("{input}")
-example_ai = HumanMessagePromptTemplate.from_template("{output}")  # Changed to AIMessagePromptTemplate for accuracy
-
 human_template = "Describe the visual features of the plant and any disease symptoms in the image, including morphology, color, distribution, size, etc., without identifying the plant or disease names."
-human_message_prompt = HumanMessagePromptTemplate.from_template(human_template)
-
-# Pre-build example messages (for few-shot)
-example_messages = []
-for example in examples:
-    example_messages.append(example_human.format(**example))
-    example_messages.append(example_ai.format(**example))
-
-# Build complete prompt (few-shot version)
-chat_prompt = ChatPromptTemplate.from_messages(
-    [system_message_prompt] + example_messages + [human_message_prompt]
-)
-
-# ========== Initialize VLM Model ==========
-model = ChatOpenAI(model="qwen2.5-vl-72b-instruct",
-    temperature=0.1,           # Low temperature for deterministic output
-    max_tokens=400,            # Shorter output for concise precision
-    top_p=0.8,                 # Lower top_p to limit candidate token range
-    frequency_penalty=0.3,     # Increase frequency penalty to avoid repetition
-    presence_penalty=0.2,      # Light presence penalty to maintain topic focus
-    max_retries=3
-)
+
+# Final message of a multi-image request (--images-per-request), the few-shot prefix stays the same
+batch_human_template = """Describe the visual features of the plant and any disease symptoms in each of the {count} images below, including morphology, color, distribution, size, etc., without identifying the plant or disease names.
+Return only a JSON array with one object per image, in order: [{{"index": 1, "image_caption": "..."}}, ..., {{"index": {count}, "image_caption": "..."}}]. "index" is the number shown before each image; do not skip any image."""
+
+
+def build_prompt():
+    """Build the few-shot chat prompt and output parser (imports LangChain on first use)"""
+    from langchain.output_parsers import StructuredOutputParser, ResponseSchema
+    from langchain.prompts.chat import (
+        ChatPromptTemplate,
+        SystemMessagePromptTemplate,
+        HumanMessagePromptTemplate,
+    )
+
+    response_schemas = [
+        ResponseSchema(name="image_caption", description=response_schema_description)
+    ]
+    output_parser = StructuredOutputParser.from_response_schemas(response_schemas)
+    format_instructions = output_parser.get_format_instructions()
+
+    system_message_prompt = SystemMessagePromptTemplate.from_template(system_template)
+    example_human = HumanMessagePromptTemplate.from_template("{input}")
+    example_ai = HumanMessagePromptTemplate.from_template("{output}")  # Changed to AIMessagePromptTemplate for accuracy
+    human_message_prompt = HumanMessagePromptTemplate.from_template(human_template)
+
+    # Pre-build example messages (for few-shot)
+    example_messages = []
+    for example in examples:
+        example_messages.append(example_human.format(**example))
+        example_messages.append(example_ai.format(**example))
+
+    # Build complete prompt (few-shot version)
+    chat_prompt = ChatPromptTemplate.from_messages(
+        [system_message_prompt] + example_messages + [human_message_prompt]
+    )
+    return chat_prompt, output_parser, format_instructions
 
 # ========== JSON Repair Function ==========
 def extract_and_fix_json(text):
@@ -152,88 +201,45 @@ def extract_and_fix_json(text):
     # If all attempts fail, return a simple JSON containing the original text
     return {"image_caption": text[:300] + ("..." if len(text) > 300 else "")}
 
-# ========== Retry Decorator for API Calls ==========
-@retry(
-    stop=stop_after_attempt(3),
-    wait=wait_exponential(multiplier=1, min=4, max=10)
-)
-def call_model_with_retry(model, message_content):
-    """Call the model with retry mechanism"""
-    return model.invoke(message_content)
-
-# ========== Process Answers ==========
-def process_response(response_content, idx, total, image_path):
-    """Process model response to get caption"""
-    try:
-        # Try to parse the response
-        parsed = output_parser.parse(response_content)
-        caption = parsed["image_caption"]
-        return caption
-    except Exception as e:
-        # If standard parsing fails, use the repair function
-        print(f"[WARNING] [{idx}/{total}] Standard parsing failed for {image_path}: {e}")
-        repaired_json = extract_and_fix_json(response_content)
-        return repaired_json["image_caption"]
-
-# ========== Main Processing ==========
-# Read JSON
-with open(input_json, "r", encoding="utf-8") as f:
-    data = json.load(f)
-
-results = []
-total = len(data)
-processed_count = 0
-start_time = time.time()
-
-for idx, entry in enumerate(data, start=1):
-    if "image" not in entry:
-        continue
-    image_path = entry["image"]
-
-    # Read local image and convert to base64
-    try:
-        with open(image_path, "rb") as f:
-            image_data = base64.b64encode(f.read()).decode("utf-8")
-    except Exception as e:
-        print(f"[ERROR] [{idx}/{total}] Failed to read image {image_path}: {e}")
-        entry["image_caption"] = f"Read failed: {str(e)}"
-        results.append(entry)
-        continue
-
-    # Build text messages
-    try:
-        text_messages = chat_prompt.format_messages(format_instructions=format_instructions)
-    except Exception as e:
-        error_msg = f"Failed to build prompt: {e}"
-        print(f"[ERROR] [{idx}/{total}] {error_msg}")
-        entry["image_caption"] = error_msg
-        results.append(entry)
-        continue
-
-    # Build final message (add image)
-    messages = []
-    for msg in text_messages:
-        if isinstance(msg, HumanMessage):
-            # For human messages, add image
-            messages.append(HumanMessage(
-                content=[
-                    {"type": "text", "text": str(msg.content)},
-                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_data}"}}
-                ]
-            ))
-        else:
-            messages.append(msg)
-
-    # Call model with retry mechanism
+def parse_batch_captions(text, count):
+    """Parse a multi-image response into {image number: caption}, dropping entries that are missing or invalid"""
+    if not isinstance(text, str):
+        return {}
+
+    start_idx = text.find('[')
+    end_idx = text.rfind(']')
+    if start_idx < 0 or end_idx <= start_idx:
+        return {}
+
+    json_str = text[start_idx:end_idx + 1]
     try:
-        response = call_model_with_retry(model, messages)
-        caption = process_response(response.content, idx, total, image_path)
-        processed_count += 1
-    except Exception as e:
-        caption = f"Processing failed after retries: {str(e)}"
-        print(f"[WARNING] [{idx}/{total}] Failed to process {image_path} after retries: {e}")
-
-    # Ensure "image_caption" is the second key-value pair
+        items = json.loads(json_str)
+    except json.JSONDecodeError:
+        # Quickly fix common JSON format errors
+        json_str = re.sub(r',\s*([}\]])', r'\1', json_str)
+        try:
+            items = json.loads(json_str)
+        except json.JSONDecodeError:
+            return {}
+    if not isinstance(items, list):
+        return {}
+
+    captions = {}
+    for position, item in enumerate(items, start=1):
+        if not isinstance(item, dict):
+            continue
+        try:
+            number = int(item.get("index", position))
+        except (TypeError, ValueError):
+            continue
+        caption = item.get("image_caption")
+        if 1 <= number <= count and isinstance(caption, str) and caption.strip():
+            captions[number] = caption.strip()
+    return captions
+
+# ========== Record Helpers ==========
+def insert_caption(entry, caption):
+    """Return a copy of entry with "image_caption" as the second key-value pair"""
     new_entry = OrderedDict()
     keys = list(entry.keys())
     if len(keys) > 0:
@@ -241,25 +247,467 @@ for idx, entry in enumerate(data, start=1):
     new_entry["image_caption"] = caption
     for k in keys[1:]:
         new_entry[k] = entry[k]
+    return new_entry
+
+
+def reuse_caption(entry, previous):
+    """Rebuild a record from a previous run, keeping where a fanned-out caption came from"""
+    record = insert_caption(entry, previous["image_caption"])
+    if "caption_source" in previous:
+        record["caption_source"] = previous["caption_source"]
+    return record
+
+
+def fan_out_caption(entry, caption, source):
+    """Give a near-duplicate image the caption of its cluster representative"""
+    record = insert_caption(entry, caption)
+    record["caption_source"] = source
+    return record
+
+
+FAILED_CAPTION_PREFIXES = ("Read failed:", "Failed to build prompt:", "Processing failed after retries:")
+
+
+def is_failed_caption(record):
+    """Whether a previously written record holds an error instead of a caption"""
+    caption = record.get("image_caption")
+    return not isinstance(caption, str) or caption.startswith(FAILED_CAPTION_PREFIXES)
+
+# ========== Caption Generator ==========
+class CaptionGenerator:
+    """Few-shot VLM captioning stage, reusable across runs in one process"""
+
+    def __init__(self, config=None, model=None):
+        from cpj_common.prompt_prefix import PromptPrefix
+        from cpj_common.usage_tracker import UsageTracker
+
+        self.config = config or CaptionConfig()
+        chat_prompt, self.output_parser, self.format_instructions = build_prompt()
+
+        # Render the invariant system prompt + few-shot examples once; only the last message is built per image
+        self.prompt_prefix = PromptPrefix(chat_prompt, format_instructions=self.format_instructions)
+
+        # Records prompt/cached token counts reported by the API
+        self.usage_tracker = UsageTracker(prices=self.config.prices)
+        self.invoke_config = {"callbacks": [self.usage_tracker]}
+        self.model = model if model is not None else self._create_model()
+        # The only retry layer; CaptionPipeline replaces it with one policy shared by all stages
+        self.retry_policy = retry_policy_from_config(self.config)
+        self.batch_stats = {"requests": 0, "images": 0, "fallbacks": 0}
+
+        # Image preprocessing (downsize, re-encode, strip EXIF)
+        self.image_optimizer = ImagePayloadOptimizer(max_edge=self.config.max_image_edge,
+                                                     image_format=self.config.image_format,
+                                                     quality=self.config.image_quality)
+        self.load_image, self.payload_store = create_image_loader(self.image_optimizer,
+                                                                  store_dir=self.config.payload_store_dir,
+                                                                  max_size_mb=self.config.payload_store_max_size_mb)
+
+        # Near-duplicate detection (perceptual hashes), only representatives are captioned
+        self.deduplicator = None
+        if self.config.dedup_threshold is not None:
+            self.deduplicator = ImageDeduplicator(threshold=self.config.dedup_threshold)
+        self.fanned_out = 0
+
+        # Response cache (keyed by image bytes + rendered prompt + model parameters)
+        self.cache = None
+        if self.config.cache_dir:
+            self.cache = ResponseCache(self.config.cache_dir, max_size_mb=self.config.cache_max_size_mb,
+                                       max_age_days=self.config.cache_max_age_days)
+
+    def _create_model(self):
+        from langchain_openai import ChatOpenAI
+
+        credentials = {}
+        if self.config.api_base:
+            credentials["openai_api_base"] = self.config.api_base
+        if self.config.api_key:
+            credentials["openai_api_key"] = self.config.api_key
+        return ChatOpenAI(model=self.config.model_name,
+            temperature=self.config.temperature,
+            max_tokens=self.config.max_tokens,
+            top_p=self.config.top_p,
+            frequency_penalty=self.config.frequency_penalty,
+            presence_penalty=self.config.presence_penalty,
+            max_retries=0,
+            **credentials
+        )
+
+    # ========== Process Answers ==========
+    def process_response(self, response_content, idx, total, image_path):
+        """Process model response to get caption"""
+        try:
+            # Try to parse the response
+            parsed = self.output_parser.parse(response_content)
+            caption = parsed["image_caption"]
+            return caption
+        except Exception as e:
+            # If standard parsing fails, use the repair function
+            print(f"[WARNING] [{idx}/{total}] Standard parsing failed for {image_path}: {e}")
+            repaired_json = extract_and_fix_json(response_content)
+            return repaired_json["image_caption"]
+
+    # ========== Message Helpers ==========
+    def build_messages(self, payload):
+        """Append the per-image message (text + encoded image) to the precompiled prompt prefix"""
+        from langchain_core.messages import HumanMessage
+
+        suffix = self.prompt_prefix.suffix()
+        return list(self.prompt_prefix.messages) + [HumanMessage(
+            content=[
+                {"type": "text", "text": str(suffix.content)},
+                {"type": "image_url", "image_url": {"url": data_uri(payload)}}
+            ]
+        )]
+
+    def build_batch_messages(self, payloads):
+        """Append one message holding several numbered images to the precompiled prompt prefix"""
+        from langchain_core.messages import HumanMessage
+
+        content = [{"type": "text", "text": batch_human_template.format(count=len(payloads))}]
+        for number, payload in enumerate(payloads, start=1):
+            content.append({"type": "text", "text": f"Image {number}:"})
+            content.append({"type": "image_url", "image_url": {"url": data_uri(payload)}})
+        return list(self.prompt_prefix.messages) + [HumanMessage(content=content)]
+
+    # ========== Cached Model Call ==========
+    async def call_model(self, messages, **kwargs):
+        """Return the response text for messages, from the response cache when possible"""
+        cache_key = None
+        if self.cache is not None:
+            # Call overrides (e.g. max_tokens of multi-image requests) are part of the key
+            overrides = [f"{name}={value}" for name, value in sorted(kwargs.items())]
+            cache_key = hash_parts(render_messages(messages), model_fingerprint(self.model), *overrides)
+            response_content = self.cache.get(cache_key)
+            if response_content is not None:
+                return response_content
+
+        response = await self.retry_policy.acall(self.model.ainvoke, messages, config=self.invoke_config, **kwargs)
+        response_content = response.content
+        if self.cache is not None:
+            self.cache.put(cache_key, response_content)
+        return response_content
+
+    # ========== Caption One Entry ==========
+    async def caption_entry(self, idx, total, entry, prefetched):
+        """Caption a single entry from its prefetched (payload, error), returns (result_entry, succeeded)"""
+        image_path = entry["image"]
+
+        # Image was read, optimized and base64-encoded ahead of time by the prefetcher
+        payload, load_error = prefetched
+        if load_error is not None:
+            print(f"[ERROR] [{idx}/{total}] Failed to read image {image_path}: {load_error}")
+            entry["image_caption"] = f"Read failed: {str(load_error)}"
+            return entry, False
+
+        # Build messages
+        try:
+            messages = self.build_messages(payload)
+        except Exception as e:
+            error_msg = f"Failed to build prompt: {e}"
+            print(f"[ERROR] [{idx}/{total}] {error_msg}")
+            entry["image_caption"] = error_msg
+            return entry, False
+
+        # Call model with retry mechanism
+        succeeded = False
+        try:
+            response_content = await self.call_model(messages)
+            caption = self.process_response(response_content, idx, total, image_path)
+            succeeded = True
+        except Exception as e:
+            caption = f"Processing failed after retries: {str(e)}"
+            print(f"[WARNING] [{idx}/{total}] Failed to process {image_path} after retries: {e}")
+
+        # Print progress
+        print(f"[OK] [{idx}/{total}] Processed {image_path} -> caption length: {len(caption)}, "
+              f"image {describe_savings(payload)}")
+
+        return insert_caption(entry, caption), succeeded
+
+    # ========== Caption a Group of Entries ==========
+    async def caption_group(self, total, group):
+        """Caption (idx, entry, prefetched) items with one multi-image request, returns [(result_entry, succeeded)]
+
+        Items that failed to load, or whose caption is missing from the response, go through caption_entry().
+        """
+        results = [None] * len(group)
+        batched = [slot for slot, (_, _, (_, load_error)) in enumerate(group) if load_error is None]
+
+        if len(batched) > 1:
+            captions = {}
+            try:
+                messages = self.build_batch_messages([group[slot][2][0] for slot in batched])
+                response_content = await self.call_model(messages, max_tokens=self.config.max_tokens * len(batched))
+                captions = parse_batch_captions(response_content, len(batched))
+            except Exception as e:
+                print(f"[WARNING] Request for {len(batched)} images failed, captioning them one by one: {e}")
+
+            self.batch_stats["requests"] += 1
+            for number, slot in enumerate(batched, start=1):
+                idx, entry, (payload, _) = group[slot]
+                if number not in captions:
+                    self.batch_stats["fallbacks"] += 1
+                    continue
+                self.batch_stats["images"] += 1
+                print(f"[OK] [{idx}/{total}] Processed {entry['image']} -> caption length: {len(captions[number])}, "
+                      f"image {describe_savings(payload)} (image {number}/{len(batched)} of one request)")
+                results[slot] = (insert_caption(entry, captions[number]), True)
+
+        # One request per remaining item, run one after another to keep the request slot count
+        for slot, (idx, entry, prefetched) in enumerate(group):
+            if results[slot] is None:
+                results[slot] = await self.caption_entry(idx, total, entry, prefetched)
+        return results
+
+    # ========== Concurrent Captioning Engine ==========
+    async def caption_entries(self, data, sink, resumed=None, duplicates=None):
+        """Caption all entries with at most `concurrency` requests in flight, appending results to sink in input order
+
+        `duplicates` maps near-duplicate image paths to their representative; those entries are not sent
+        to the model and get the representative's caption.
+        """
+        resumed = resumed or {}
+        duplicates = duplicates or {}
+        total = len(data)
+        group_size = max(1, self.config.images_per_request)
+        self.batch_stats = {"requests": 0, "images": 0, "fallbacks": 0}
+        semaphore = asyncio.Semaphore(max(1, self.config.concurrency))
+        counters = {"processed": 0, "completed": 0, "fanned_out": 0, "reported": 0}
+        start_time = time.time()
+
+        pending = []
+        seen_paths = set()
+        followers = {}
+        position = 0
+        for idx, entry in enumerate(data, start=1):
+            if "image" not in entry:
+                continue
+            image_path = entry["image"]
+            repeat = self.deduplicator is not None and image_path in seen_paths
+            seen_paths.add(image_path)
+            if image_path in resumed and not repeat:
+                # Already captioned by a previous run, reuse the caption without calling the model
+                sink.write_at(position, reuse_caption(entry, resumed[image_path]))
+            elif self.deduplicator is not None and (image_path in duplicates or repeat):
+                # Near-duplicate (or repeat) of an earlier image, waits for that image's caption
+                followers.setdefault(duplicates.get(image_path, image_path), []).append((position, entry))
+            else:
+                pending.append((position, idx, entry))
+            position += 1
+
+        # Entries written by this run: captioned images plus the duplicates their captions fan out to
+        to_write = len(pending) + sum(len(entries) for entries in followers.values())
+
+        def release_followers(source, caption, succeeded):
+            for follower_position, follower in followers.pop(source, ()):
+                sink.write_at(follower_position, fan_out_caption(follower, caption, source))
+                counters["fanned_out"] += 1
+                counters["completed"] += 1
+                if succeeded:
+                    counters["processed"] += 1
+
+        # Representatives captioned by a previous run release their duplicates right away
+        for source in [source for source in followers if source in resumed]:
+            release_followers(source, resumed[source]["image_caption"], True)
+
+        async def run_group(group, prefetched):
+            try:
+                results = await self.caption_group(total, [
+                    (idx, entry, loaded) for (_, idx, entry), loaded in zip(group, prefetched)
+                ])
+            finally:
+                semaphore.release()
+            for (position, _, entry), (result, succeeded) in zip(group, results):
+                sink.write_at(position, result)
+                counters["completed"] += 1
+                if succeeded:
+                    counters["processed"] += 1
+                release_followers(entry["image"], result["image_caption"], succeeded)
+
+                # Report throughput every 10 images; fanned-out duplicates can carry the count past a multiple of 10
+                if counters["completed"] // 10 > counters["reported"]:
+                    counters["reported"] = counters["completed"] // 10
+                    elapsed = time.time() - start_time
+                    throughput = counters["completed"] / elapsed if elapsed > 0 else 0
+                    print(f"[PROGRESS] {counters['completed']}/{to_write} images done, {throughput:.2f} images/sec")
+
+        # Images for the next `prefetch` entries are loaded while earlier requests are in flight
+        tasks = []
+        with ImagePrefetcher(self.load_image, [entry["image"] for _, _, entry in pending],
+                             lookahead=max(self.config.prefetch, group_size)) as prefetcher:
+            for start in range(0, len(pending), group_size):
+                group = pending[start:start + group_size]
+                await semaphore.acquire()
+                prefetched = [await prefetcher.next_async() for _ in group]
+                tasks.append(asyncio.ensure_future(run_group(group, prefetched)))
+            await asyncio.gather(*tasks)
+            print(f"[PREFETCH] {prefetcher.summary()}")
+
+        self.fanned_out = counters["fanned_out"]
+        return counters["processed"], counters["completed"]
+
+    # ========== File-to-File Run ==========
+    async def arun(self, input_json, output_json):
+        """Caption every image listed in input_json and write output_json, returns run statistics"""
+        # Read JSON
+        with open(input_json, "r", encoding="utf-8") as f:
+            data = json.load(f)
+
+        total = len(data)
+        start_time = time.time()
+        if self.cache is not None:
+            self.cache.evict()
+
+        # Every finished record is appended to the checkpoint file as soon as it is done
+        checkpoint_path = output_json if self.config.output_format == "jsonl" else f"{output_json}.partial.jsonl"
+
+        # Index captions from an interrupted run by image path
+        resumed = {}
+        if self.config.resume:
+            resumed = load_for_resume(checkpoint_path, image_key, is_failed_caption, output_path=output_json)
+            print(f"[RESUME] Reusing captions for {len(resumed)} images from the previous run")
+
+        # Cluster near-identical images (burst shots, re-uploads) before any request is sent
+        duplicates = {}
+        if self.deduplicator is not None:
+            duplicates = self.deduplicator.find_duplicates(entry["image"] for entry in data if "image" in entry)
+            print(f"[DEDUP] {self.deduplicator.summary()}")
+
+        with JsonlSink(checkpoint_path, fsync_every=self.config.fsync_every) as sink:
+            processed_count, completed = await self.caption_entries(data, sink, resumed, duplicates)
+
+        # ========== Save ==========
+        if self.config.output_format == "json":
+            jsonl_to_json(checkpoint_path, output_json, indent=2)
+            os.remove(checkpoint_path)
+        finish_resume(checkpoint_path)
+
+        # Calculate and print statistics
+        end_time = time.time()
+        total_time = end_time - start_time
+        avg_time_per_image = total_time / processed_count if processed_count > 0 else 0
+        throughput = completed / total_time if total_time > 0 else 0
+
+        print(f"[SUCCESS] Generated {output_json}, processed {processed_count}/{total} images successfully")
+        print(f"[TIME] Total time: {total_time:.2f} seconds, Average per image: {avg_time_per_image:.2f} seconds")
+        print(f"[THROUGHPUT] {throughput:.2f} images/sec with concurrency {self.config.concurrency}")
+
+        print(f"[TOKENS] {self.usage_tracker.summary()}")
+        print(f"[RETRY] {self.retry_policy.summary()}")
+        if self.config.usage_report:
+            write_usage_report(self.config.usage_report, {"caption": (self.usage_tracker, completed)}, self.retry_policy)
+            print(f"[USAGE] Per-stage tokens, latency and cost written to {self.config.usage_report}")
+        if self.config.images_per_request > 1:
+            print(f"[BATCH] {self.batch_stats['images']} images captioned by {self.batch_stats['requests']} multi-image "
+                  f"requests, {self.batch_stats['fallbacks']} retried with single-image requests")
+
+        if self.deduplicator is not None:
+            print(f"[DEDUP] {self.fanned_out} near-duplicate images reused a representative's caption, "
+                  f"saving {self.fanned_out} single-image VLM calls")
+
+        image_stats = self.image_optimizer.stats()
+        print(f"[IMAGE] {image_stats['images']} images, {image_stats['original_bytes']} -> {image_stats['payload_bytes']} bytes "
+              f"(saved {image_stats['saved_ratio'] * 100:.1f}%)")
+        if self.payload_store is not None:
+            self.payload_store.evict()
+            print(f"[STORE] {self.payload_store.summary()}")
+
+        if self.cache is not None:
+            evicted = self.cache.evict()
+            cache_stats = self.cache.stats()
+            print(f"[CACHE] {cache_stats['hits']} hits, {cache_stats['misses']} misses "
+                  f"({cache_stats['hit_rate'] * 100:.1f}% hit rate), evicted {evicted} entries")
+
+        return {
+            "total": total,
+            "processed": processed_count,
+            "completed": completed,
+            "resumed": len(resumed),
+            "fanned_out": self.fanned_out,
+            "total_time": total_time,
+            "throughput": throughput,
+        }
+
+    def run(self, input_json, output_json):
+        """Synchronous wrapper around arun()"""
+        return asyncio.run(self.arun(input_json, output_json))
+
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
+
+
+# ========== Command Line Interface ==========
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Generate image captions for agricultural images")
+    parser.add_argument("--input", type=str, required=True, help="Path to input JSON file")
+    parser.add_argument("--output", type=str, required=True, help="Path to output JSON file")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="Maximum number of concurrent VLM requests (default: 1)")
+    parser.add_argument("--cache-dir", type=str, default=".caption_cache",
+                        help="Directory of the persistent response cache (default: .caption_cache)")
+    parser.add_argument("--no-cache", action="store_true", help="Disable the persistent response cache")
+    parser.add_argument("--cache-max-size-mb", type=float, default=1024,
+                        help="Evict least-recently used cache entries beyond this size (default: 1024)")
+    parser.add_argument("--cache-max-age-days", type=float, default=30,
+                        help="Evict cache entries older than this many days (default: 30)")
+    add_image_arguments(parser)
+    parser.add_argument("--output-format", type=str, default="json", choices=["json", "jsonl"],
+                        help="Final output format; jsonl keeps the append-only checkpoint file as output (default: json)")
+    parser.add_argument("--fsync-every", type=int, default=0,
+                        help="fsync the checkpoint file every N records, 0 only flushes (default: 0)")
+    parser.add_argument("--images-per-request", type=int, default=1,
+                        help="Pack up to N images into one VLM request, failed items are retried one by one (default: 1)")
+    parser.add_argument("--dedup", action="store_true",
+                        help="Caption one image per cluster of near-identical images and reuse its caption")
+    parser.add_argument("--dedup-threshold", type=int, default=6,
+                        help="Maximum perceptual-hash Hamming distance (of 64 bits) within a cluster (default: 6)")
+    parser.add_argument("--prefetch", type=int, default=4,
+                        help="Number of images read and encoded ahead of the requests in flight (default: 4)")
+    add_retry_arguments(parser, max_retries=3)
+    add_usage_arguments(parser)
+    parser.add_argument("--resume", action="store_true",
+                        help="Reuse captions from a previous partial run and only caption missing or failed images")
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+
+    # API credentials
+    os.environ["OPENAI_API_BASE"] = API_BASE
+    os.environ["OPENAI_API_KEY"] = API_KEY
+
+    config = CaptionConfig(
+        concurrency=args.concurrency,
+        prefetch=args.prefetch,
+        images_per_request=args.images_per_request,
+        dedup_threshold=args.dedup_threshold if args.dedup else None,
+        cache_dir=None if args.no_cache else args.cache_dir,
+        cache_max_size_mb=args.cache_max_size_mb,
+        cache_max_age_days=args.cache_max_age_days,
+        max_image_edge=args.max_image_edge,
+        image_format=args.image_format,
+        image_quality=args.image_quality,
+        payload_store_dir=args.payload_store,
+        payload_store_max_size_mb=args.payload_store_max_size_mb,
+        output_format=args.output_format,
+        fsync_every=args.fsync_every,
+        max_retries=args.max_retries,
+        retry_budget=args.retry_budget,
+        breaker_error_rate=args.breaker_error_rate,
+        breaker_cooldown=args.breaker_cooldown,
+        prices=prices_from_args(args),
+        usage_report=args.usage_report,
+        resume=args.resume,
+    )
+    generator = CaptionGenerator(config)
+    try:
+        generator.run(args.input, args.output)
+    finally:
+        generator.close()
 
-    results.append(new_entry)
-
-    # Print progress
-    print(f"[OK] [{idx}/{total}] Processed {image_path} -> caption length: {len(caption)}")
-
-    # Save intermediate results every 10 images
-    if idx % 10 == 0:
-        with open(f"temp_{output_json}", "w", encoding="utf-8") as f:
-            json.dump(results, f, ensure_ascii=False, indent=2)
-
-# ========== Save ==========
-with open(output_json, "w", encoding="utf-8") as f:
-    json.dump(results, f, ensure_ascii=False, indent=2)
-
-# Calculate and print statistics
-end_time = time.time()
-total_time = end_time - start_time
-avg_time_per_image = total_time / processed_count if processed_count > 0 else 0
 
-print(f"[SUCCESS] Generated {output_json}, processed {processed_count}/{total} images successfully")
-print(f"[TIME] Total time: {total_time:.2f} seconds, Average per image: {avg_time_per_image:.2f} seconds")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -1,55 +1,85 @@
-
-
 """
 Unified Caption Generation, Evaluation, and Optimization Script
 This script performs both caption evaluation and optimization in one pass.
 
 Usage:
     python caption_judge_optimize.py --input input.json --output output.json --threshold 8
+    python caption_judge_optimize.py --input input.json --output output.json --threshold 8 --workers 8
+    python caption_judge_optimize.py --input input.json --what-if-thresholds 6,7,8,9
+
+Library usage (importing this module has no side effects; LangChain is imported lazily):
+    from caption_judge_optimize import CaptionRefiner, RefinerConfig
+    refiner = CaptionRefiner(RefinerConfig(model_name="gpt-4o", threshold=8))
+    refiner.run("captions.json", "refined.json")
 
 Features:
     - Generates initial captions using VLM with few-shot prompting
     - Evaluates captions based on accuracy, completeness, detail, relevance, and clarity
     - Automatically optimizes captions scoring below the threshold
+    - --workers N evaluates captions concurrently and optimizes low-rated ones as soon as they are scored
+    - --judge-batch-size N scores N numbered captions with one evaluation request
+    - --fused rates and rewrites a low-rated caption with one request (--fused-audit compares it with two calls)
+    - --prescreen settles generation errors, truncated captions and out-of-range word counts without a judge call
+    - Evaluations are cached by caption text, so changing --threshold does not re-run the judge
+    - --what-if-thresholds 6,7,8,9 reports from cached ratings what each threshold would optimize, without API calls
     - Supports both diagnosis and knowledge QA tasks
 """
 
 import argparse
+import asyncio
+import difflib
 import json
 import os
 import re
-from tqdm import tqdm
-from tenacity import retry, stop_after_attempt, wait_exponential
-from langchain_openai import ChatOpenAI
-from langchain.output_parsers import StructuredOutputParser, ResponseSchema
-from langchain_core.messages import HumanMessage, SystemMessage
-from langchain.prompts.chat import (
-    ChatPromptTemplate,
-    SystemMessagePromptTemplate,
-    HumanMessagePromptTemplate,
-)
+import sys
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from cpj_common.jsonl_sink import JsonlSink
+from cpj_common.response_cache import ResponseCache, hash_parts, model_fingerprint, render_messages
+from cpj_common.resume import finish_resume, image_key, load_for_resume
+from cpj_common.retry_policy import add_retry_arguments, retry_policy_from_config
+from cpj_common.usage import add_usage_arguments, call_cost, prices_from_args, resolve_prices, write_usage_report
 
 # ========== Configuration ==========
-os.environ["OPENAI_API_BASE"] = "YOUR_API_BASE_URL"
-os.environ["OPENAI_API_KEY"] = "YOUR_API_KEY"
+API_BASE = "YOUR_API_BASE_URL"
+API_KEY = "YOUR_API_KEY"
+
+
+@dataclass
+class RefinerConfig:
+    """Settings for CaptionRefiner"""
+    model_name: str = "YOUR_MODEL_NAME"  # e.g., "gpt-4", "gpt-3.5-turbo", etc.
+    temperature: float = 0
+    max_retries: int = 3               # Retries per call, made by the retry policy (the client itself does not retry)
+    retry_budget: float = 0.2          # Retries allowed per call over the whole run
+    breaker_error_rate: float = 0.5    # Error rate over recent calls that pauses dispatch, 0 disables
+    breaker_cooldown: float = 30
+    timeout: float = 30
+    api_base: Optional[str] = None     # Defaults to the OPENAI_API_BASE environment variable
+    api_key: Optional[str] = None      # Defaults to the OPENAI_API_KEY environment variable
+    threshold: int = 8                 # Captions rated below this are optimized
+    workers: int = 1                   # >1 evaluates and optimizes captions concurrently
+    judge_batch_size: int = 1          # >1 scores that many captions with one evaluation request
+    fused: bool = False                # Rate and rewrite low-rated captions with a single request
+    fused_audit: float = 0.05          # Fraction of fused evaluations re-checked with the two-call path
+    prescreen_rules: Tuple[str, ...] = ()  # Local rules checked before the judge, e.g. DEFAULT_PRESCREEN_RULES
+    min_words: int = 80                # Word range enforced by the "word_count" pre-screen rule
+    max_words: int = 120
+    cache_dir: Optional[str] = ".caption_cache"  # None disables the evaluation cache
+    cache_max_size_mb: float = 256
+    cache_max_age_days: float = 90
+    prices: Optional[Tuple[float, float, float]] = None  # USD per 1M prompt/cached/completion tokens
+    usage_report: Optional[str] = None  # Path of the per-stage usage summary JSON, None disables
+    resume: bool = False
 
 # ========== Define Output Format for Evaluation ==========
-evaluation_schemas = [
-    ResponseSchema(
-        name="rating",
-        description="Score from 1 to 10 based on caption quality"
-    ),
-    ResponseSchema(
-        name="reasoning",
-        description="Brief explanation for the rating"
-    ),
-    ResponseSchema(
-        name="suggestions",
-        description="Specific suggestions for improvement"
-    )
-]
-evaluation_parser = StructuredOutputParser.from_response_schemas(evaluation_schemas)
-evaluation_format_instructions = evaluation_parser.get_format_instructions()
+evaluation_fields = {
+    "rating": "Score from 1 to 10 based on caption quality",
+    "reasoning": "Brief explanation for the rating",
+    "suggestions": "Specific suggestions for improvement",
+}
 
 # ========== Evaluation System Prompt ==========
 evaluation_system_template = """You are an expert evaluator for agricultural image captions. Please evaluate the quality of the image caption based on the following criteria:
@@ -74,17 +104,34 @@ evaluation_system_template = """You are an expert evaluator for agricultural ima
 
 {format_instructions}
 """
-evaluation_system_message_prompt = SystemMessagePromptTemplate.from_template(evaluation_system_template)
-
 # ========== Evaluation Human Prompt ==========
 evaluation_human_template = "Please evaluate the following image caption:\n\n{caption_text}"
-evaluation_human_message_prompt = HumanMessagePromptTemplate.from_template(evaluation_human_template)
 
-# ========== Create Evaluation Prompt Template ==========
-evaluation_prompt = ChatPromptTemplate.from_messages([
-    evaluation_system_message_prompt,
-    evaluation_human_message_prompt
-])
+# Several numbered captions in one request; the reply is a JSON array instead of a single object
+batch_evaluation_human_template = """Please evaluate each of the following {count} image captions separately.
+Return only a JSON array with one object per caption, in order: [{{"index": 1, "rating": ..., "reasoning": "...", "suggestions": "..."}}, ..., {{"index": {count}, "rating": ..., "reasoning": "...", "suggestions": "..."}}]. "index" is the number shown before each caption; do not skip any caption.
+
+{captions}"""
+
+# ========== Fused Evaluation and Rewrite ==========
+# Same evaluation prompt, plus the optimization guidelines so that one response can carry the rewrite
+fused_fields = {
+    **evaluation_fields,
+    "optimized_caption": "Optimized caption if the rating is below the threshold, otherwise an empty string",
+}
+
+fused_rewrite_instructions = """## Rewriting
+If your rating is below {threshold}, also write an optimized version of the caption that is more accurate, detailed, and professional:
+1. Ensure clear identification of plant and disease/pest (or confirm health status)
+2. Include detailed symptom description (location, shape, color, extent, quantity, etc.)
+3. Assess severity and development stage
+4. Keep language concise and professional (80-120 words)
+5. Follow the style and quality of the examples above
+If your rating is {threshold} or higher, leave "optimized_caption" empty.
+
+"""
+fused_system_template = evaluation_system_template.replace(
+    "{format_instructions}", fused_rewrite_instructions + "{format_instructions}")
 
 # ========== Optimization System Prompt ==========
 optimization_system_template = """You are an expert agricultural diagnostician. Please optimize the following image caption to make it more accurate, detailed, and professional.
@@ -103,25 +150,57 @@ optimization_system_template = """You are an expert agricultural diagnostician.
 
 Please provide an optimized version of the caption:
 """
-optimization_system_message_prompt = SystemMessagePromptTemplate.from_template(optimization_system_template)
-
 # ========== Optimization Human Prompt ==========
 optimization_human_template = "Original caption: {caption_text}\n\nSuggestions for improvement: {suggestions}"
-optimization_human_message_prompt = HumanMessagePromptTemplate.from_template(optimization_human_template)
 
-# ========== Create Optimization Prompt Template ==========
-optimization_prompt = ChatPromptTemplate.from_messages([
-    optimization_system_message_prompt,
-    optimization_human_message_prompt
-])
 
-# ========== Initialize Model ==========
-model = ChatOpenAI(
-    model="YOUR_MODEL_NAME",  # e.g., "gpt-4", "gpt-3.5-turbo", etc.
-    temperature=0,
-    max_retries=3,
-    timeout=30,
-)
+# ========== Build Prompt Templates ==========
+def build_prompts():
+    """Build the evaluation parser and the prompt templates (imports LangChain on first use)"""
+    from langchain.output_parsers import StructuredOutputParser, ResponseSchema
+    from langchain.prompts.chat import (
+        ChatPromptTemplate,
+        SystemMessagePromptTemplate,
+        HumanMessagePromptTemplate,
+    )
+
+    evaluation_schemas = [ResponseSchema(name=name, description=description)
+                          for name, description in evaluation_fields.items()]
+    evaluation_parser = StructuredOutputParser.from_response_schemas(evaluation_schemas)
+
+    evaluation_prompt = ChatPromptTemplate.from_messages([
+        SystemMessagePromptTemplate.from_template(evaluation_system_template),
+        HumanMessagePromptTemplate.from_template(evaluation_human_template)
+    ])
+    batch_evaluation_prompt = ChatPromptTemplate.from_messages([
+        SystemMessagePromptTemplate.from_template(evaluation_system_template),
+        HumanMessagePromptTemplate.from_template(batch_evaluation_human_template)
+    ])
+    optimization_prompt = ChatPromptTemplate.from_messages([
+        SystemMessagePromptTemplate.from_template(optimization_system_template),
+        HumanMessagePromptTemplate.from_template(optimization_human_template)
+    ])
+    return evaluation_parser, evaluation_prompt, batch_evaluation_prompt, optimization_prompt
+
+
+def build_fused_prompt():
+    """Build the parser and prompt of the fused evaluate-and-rewrite mode (imports LangChain on first use)"""
+    from langchain.output_parsers import StructuredOutputParser, ResponseSchema
+    from langchain.prompts.chat import (
+        ChatPromptTemplate,
+        SystemMessagePromptTemplate,
+        HumanMessagePromptTemplate,
+    )
+
+    fused_schemas = [ResponseSchema(name=name, description=description)
+                     for name, description in fused_fields.items()]
+    fused_parser = StructuredOutputParser.from_response_schemas(fused_schemas)
+
+    fused_prompt = ChatPromptTemplate.from_messages([
+        SystemMessagePromptTemplate.from_template(fused_system_template),
+        HumanMessagePromptTemplate.from_template(evaluation_human_template)
+    ])
+    return fused_parser, fused_prompt
 
 
 # ========== JSON Repair Function ==========
@@ -170,66 +249,77 @@ def extract_and_fix_json(text):
     return {"rating": 0, "reasoning": "Failed to parse response", "suggestions": "Check the caption format"}
 
 
-# ========== Retry Decorator for API Calls ==========
-@retry(
-    stop=stop_after_attempt(3),
-    wait=wait_exponential(multiplier=1, min=4, max=10)
-)
-def call_model_with_retry(model, messages):
-    """Call the model with retry mechanism"""
-    return model.invoke(messages)
-
-
-# ========== Evaluate Caption ==========
-def evaluate_caption(caption_text):
-    """Evaluate the quality of a caption"""
-    try:
-        # Format the evaluation prompt
-        messages = evaluation_prompt.format_messages(
-            caption_text=caption_text,
-            format_instructions=evaluation_format_instructions
-        )
-
-        # Call the model
-        response = call_model_with_retry(model, messages)
-
-        # Parse the response
+def split_json_objects(text):
+    """Return the top-level {...} segments of text; braces inside string literals are ignored"""
+    segments = []
+    depth = 0
+    start = None
+    in_string = False
+    escaped = False
+    for pos, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == '{':
+            if depth == 0:
+                start = pos
+            depth += 1
+        elif char == '}' and depth:
+            depth -= 1
+            if depth == 0:
+                segments.append(text[start:pos + 1])
+    return segments
+
+
+def parse_batch_evaluations(text, count):
+    """Parse a multi-caption evaluation into {caption number: evaluation}, dropping entries that are missing or invalid
+
+    Each array element is repaired on its own with extract_and_fix_json, so one malformed element does not
+    lose the others.
+    """
+    if not isinstance(text, str):
+        return {}
+
+    start_idx = text.find('[')
+    end_idx = text.rfind(']')
+    if start_idx < 0 or end_idx <= start_idx:
+        return {}
+
+    evaluations = {}
+    for position, segment in enumerate(split_json_objects(text[start_idx:end_idx + 1]), start=1):
         try:
-            parsed = evaluation_parser.parse(response.content)
-            return {
-                "rating": int(parsed.get("rating", 0)),
-                "reasoning": parsed.get("reasoning", ""),
-                "suggestions": parsed.get("suggestions", "")
+            element = json.loads(segment)
+        except ValueError:
+            element = None
+        if isinstance(element, dict):
+            index = element.get("index")
+        else:
+            # Malformed element: read the index from the text, the rest is repaired by extract_and_fix_json
+            match = re.search(r'["\']?index["\']?\s*:\s*(\d+)', segment)
+            index = match.group(1) if match else None
+        try:
+            number = int(index)
+        except (TypeError, ValueError):
+            number = position
+        evaluation = extract_and_fix_json(segment)
+        try:
+            rating = int(evaluation["rating"])
+        except (TypeError, ValueError):
+            continue
+        # Rating 0 is what extract_and_fix_json returns for an unparseable element
+        if 1 <= number <= count and number not in evaluations and 1 <= rating <= 10:
+            evaluations[number] = {
+                "rating": rating,
+                "reasoning": evaluation["reasoning"],
+                "suggestions": evaluation["suggestions"]
             }
-        except Exception as e:
-            # If standard parsing fails, use the repair function
-            print(f"Evaluation parsing failed: {e}")
-            return extract_and_fix_json(response.content)
-
-    except Exception as e:
-        print(f"Evaluation failed: {e}")
-        return {"rating": 0, "reasoning": f"Evaluation error: {str(e)}", "suggestions": "Try again"}
-
-
-# ========== Optimize Caption ==========
-def optimize_caption(caption_text, suggestions):
-    """Optimize a caption based on suggestions"""
-    try:
-        # Format the optimization prompt
-        messages = optimization_prompt.format_messages(
-            caption_text=caption_text,
-            suggestions=suggestions
-        )
-
-        # Call the model
-        response = call_model_with_retry(model, messages)
-
-        # Return the optimized caption
-        return response.content.strip()
-
-    except Exception as e:
-        print(f"Optimization failed: {e}")
-        return caption_text  # Return original caption if optimization fails
+    return evaluations
 
 
 # ========== Load and Save Functions ==========
@@ -245,81 +335,866 @@ def save_image_captions(file_path, captions):
         json.dump(captions, file, indent=4, ensure_ascii=False)
 
 
-# ========== Process and Optimize Captions ==========
-def process_and_optimize_captions(captions, threshold=8):
-    """Process and optimize low-scoring image captions"""
-    for i, caption in enumerate(tqdm(captions, desc="Evaluating and optimizing captions")):
-        caption_text = caption.get("image_caption", "")
+# ========== Local Pre-screen Rules ==========
+# Each rule returns (route, reasoning, suggestions) when it fires, None otherwise. "optimize" sends the caption
+# straight to the optimization prompt, "regenerate" leaves it for caption_generation.py --resume.
+GENERATION_FAILURE_PREFIXES = ("Read failed:", "Failed to build prompt:", "Processing failed after retries:")
 
-        # Skip if no caption or already processed
-        if not caption_text or caption.get("evaluated", False):
-            continue
 
-        # Evaluate the caption
-        evaluation = evaluate_caption(caption_text)
+def screen_generation_failed(caption_text, config):
+    """Error text that caption_generation.py wrote instead of a caption"""
+    if caption_text.startswith(GENERATION_FAILURE_PREFIXES):
+        return "regenerate", "caption generation failed", ""
+    return None
 
-        # Add evaluation results to the caption
-        captions[i]["rating"] = evaluation["rating"]
-        captions[i]["reasoning"] = evaluation["reasoning"]
-        captions[i]["suggestions"] = evaluation["suggestions"]
-        captions[i]["evaluated"] = True
 
-        # Store original caption before optimization
-        if "original_caption" not in captions[i]:
-            captions[i]["original_caption"] = caption_text
-
-        # Optimize if rating is below threshold
-        if evaluation["rating"] < threshold:
-            optimized_caption = optimize_caption(caption_text, evaluation["suggestions"])
-            captions[i]["image_caption"] = optimized_caption  # Replace with optimized version
-            captions[i]["optimized"] = True
-
-            # Print progress
-            print(f"\nOptimized caption {i + 1}:")
-            print(f"  Original: {caption_text[:80]}...")
-            print(f"  Optimized: {optimized_caption[:80]}...")
-            print(f"  Rating: {evaluation['rating']}/10")
+def screen_truncated(caption_text, config):
+    """Caption cut off mid-sentence"""
+    if caption_text.rstrip().endswith(("...", "\u2026")):
+        return ("optimize", "caption is truncated",
+                "Complete the truncated description and end with a full sentence")
+    return None
+
+
+def screen_word_count(caption_text, config):
+    """Caption outside the word range the evaluation prompt demands"""
+    words = len(caption_text.split())
+    if words < config.min_words:
+        return ("optimize", f"{words} words, below the required {config.min_words}-{config.max_words}",
+                f"Expand the caption to {config.min_words}-{config.max_words} words with specific symptom details "
+                f"(location, shape, color, extent, severity)")
+    if words > config.max_words:
+        return ("optimize", f"{words} words, above the required {config.min_words}-{config.max_words}",
+                f"Condense the caption to {config.min_words}-{config.max_words} words, keeping the diagnostic details")
+    return None
+
+
+PRESCREEN_RULES = {
+    "generation_failed": screen_generation_failed,
+    "truncated": screen_truncated,
+    "word_count": screen_word_count,
+}
+DEFAULT_PRESCREEN_RULES = ("generation_failed", "truncated", "word_count")
+
+
+# ========== Resume Helpers ==========
+RESUMED_FIELDS = ("image_caption", "rating", "reasoning", "suggestions", "evaluated", "original_caption", "prescreen",
+                  "optimized")
+
+
+def is_failed_evaluation(record):
+    """Whether a checkpointed caption was not evaluated successfully"""
+    return not record.get("evaluated", False) or str(record.get("reasoning", "")).startswith("Evaluation error:")
+
+
+def apply_resumed(captions, resumed):
+    """Copy evaluation results of a previous run onto captions whose text is unchanged"""
+    applied = 0
+    for caption in captions:
+        previous = resumed.get(caption.get("image"))
+        if previous is None or caption.get("evaluated", False):
+            continue
+        if previous.get("original_caption") != caption.get("image_caption", ""):
+            continue
+        for field in RESUMED_FIELDS:
+            if field in previous:
+                caption[field] = previous[field]
+        applied += 1
+    return applied
+
+
+# ========== Caption Refiner ==========
+class CaptionRefiner:
+    """Evaluates captions and rewrites the ones rated below the threshold"""
+
+    def __init__(self, config=None, model=None):
+        from cpj_common.prompt_prefix import PromptPrefix
+        from cpj_common.usage_tracker import UsageTracker
+
+        self.config = config or RefinerConfig()
+        if self.config.fused and self.config.judge_batch_size > 1:
+            raise ValueError("fused mode rates one caption per request, set judge_batch_size to 1")
+        unknown_rules = [name for name in self.config.prescreen_rules if name not in PRESCREEN_RULES]
+        if unknown_rules:
+            raise ValueError(f"Unknown pre-screen rules {unknown_rules}, available: {sorted(PRESCREEN_RULES)}")
+        self.evaluation_parser, evaluation_prompt, batch_evaluation_prompt, optimization_prompt = build_prompts()
+
+        # The system prompts are rendered once; only the human message is built per caption
+        format_instructions = self.evaluation_parser.get_format_instructions()
+        self.evaluation_prefix = PromptPrefix(evaluation_prompt, format_instructions=format_instructions)
+        self.batch_evaluation_prefix = PromptPrefix(batch_evaluation_prompt, format_instructions=format_instructions)
+        self.optimization_prefix = PromptPrefix(optimization_prompt)
+
+        self.usage_tracker = UsageTracker(prices=self.config.prices)
+        # Evaluation and optimization calls are also counted separately for the per-stage usage report
+        self.optimization_usage = UsageTracker(prices=self.config.prices)
+        self.invoke_config = {"callbacks": [self.usage_tracker, self.optimization_usage]}
+        self.evaluation_usage = UsageTracker(prices=self.config.prices)
+        self.evaluation_config = {"callbacks": [self.usage_tracker, self.evaluation_usage]}
+        self.batch_stats = {"captions": 0, "requests": 0, "batched": 0, "fallbacks": 0}
+
+        if self.config.fused:
+            self.fused_parser, fused_prompt = build_fused_prompt()
+            self.fused_prompt = fused_prompt
+            self.fused_prefixes = {}
+            self.fused_prefix = self.fused_prefix_for(self.config.threshold)
+        self.fused_stats = {"captions": 0, "rewrites": 0, "fallbacks": 0,
+                            "audited": 0, "agreed": 0, "rating_difference": 0, "similarity": []}
+        self.prescreen_stats = {"checked": 0, "optimize": 0, "regenerate": 0,
+                                "rules": {name: 0 for name in self.config.prescreen_rules}}
+
+        # Ratings are cached per evaluation prompt: single, batched and fused requests (and any prompt edit) get
+        # separate entries, so a re-run never reuses a rating made under a different prompt
+        if self.config.fused:
+            mode, prefix = "fused", self.fused_prefix
+        elif self.config.judge_batch_size > 1:
+            mode, prefix = "batch", self.batch_evaluation_prefix
         else:
-            captions[i]["optimized"] = False
+            mode, prefix = "single", self.evaluation_prefix
+        self.evaluation_variant = hash_parts(mode, render_messages(prefix.messages))
+
+        # Evaluation cache (keyed by caption text + judge model settings), survives threshold changes
+        self.cache = None
+        if self.config.cache_dir:
+            self.cache = ResponseCache(self.config.cache_dir, max_size_mb=self.config.cache_max_size_mb,
+                                       max_age_days=self.config.cache_max_age_days, filename="evaluations.sqlite")
+        self.model = model if model is not None else self._create_model()
+        # The only retry layer; CaptionPipeline replaces it with one policy shared by all stages
+        self.retry_policy = retry_policy_from_config(self.config)
+
+    def _create_model(self):
+        from langchain_openai import ChatOpenAI
+
+        credentials = {}
+        if self.config.api_base:
+            credentials["openai_api_base"] = self.config.api_base
+        if self.config.api_key:
+            credentials["openai_api_key"] = self.config.api_key
+        return ChatOpenAI(
+            model=self.config.model_name,
+            temperature=self.config.temperature,
+            max_retries=0,
+            timeout=self.config.timeout,
+            **credentials
+        )
 
-    return captions
+    # ========== Evaluate Caption ==========
+    def evaluate_caption(self, caption_text):
+        """Evaluate the quality of a caption"""
+        try:
+            # Format the evaluation prompt
+            messages = self.evaluation_prefix.build(caption_text=caption_text)
 
+            # Call the model
+            response = self.retry_policy.call(self.model.invoke, messages, config=self.evaluation_config)
 
-# ========== Main Function ==========
-def main():
-    parser = argparse.ArgumentParser(description='Caption Judge and Optimize Script')
-    parser.add_argument('--input', '-i', required=True, help='Input JSON file path')
-    parser.add_argument('--output', '-o', required=True, help='Output JSON file path')
-    parser.add_argument('--threshold', '-t', type=int, default=8,
-                       help='Quality threshold (1-10). Captions below this will be optimized. Default: 8')
+            # Parse the response
+            return self.parse_evaluation(response.content)
+
+        except Exception as e:
+            print(f"Evaluation failed: {e}")
+            return {"rating": 0, "reasoning": f"Evaluation error: {str(e)}", "suggestions": "Try again"}
+
+    async def aevaluate_caption(self, caption_text):
+        """Evaluate the quality of a caption without blocking the event loop"""
+        try:
+            messages = self.evaluation_prefix.build(caption_text=caption_text)
+            response = await self.retry_policy.acall(self.model.ainvoke, messages, config=self.evaluation_config)
+            return self.parse_evaluation(response.content)
+        except Exception as e:
+            print(f"Evaluation failed: {e}")
+            return {"rating": 0, "reasoning": f"Evaluation error: {str(e)}", "suggestions": "Try again"}
+
+    def parse_evaluation(self, response_content):
+        """Parse an evaluation response into rating, reasoning and suggestions"""
+        try:
+            parsed = self.evaluation_parser.parse(response_content)
+            return {
+                "rating": int(parsed.get("rating", 0)),
+                "reasoning": parsed.get("reasoning", ""),
+                "suggestions": parsed.get("suggestions", "")
+            }
+        except Exception as e:
+            # If standard parsing fails, use the repair function
+            print(f"Evaluation parsing failed: {e}")
+            return extract_and_fix_json(response_content)
+
+    # ========== Evaluate Several Captions per Request ==========
+    def build_batch_messages(self, caption_texts):
+        """Append one message holding several numbered captions to the precompiled evaluation prefix"""
+        numbered = "\n\n".join(f"Caption {number}: {text}" for number, text in enumerate(caption_texts, start=1))
+        return self.batch_evaluation_prefix.build(count=len(caption_texts), captions=numbered)
+
+    def evaluate_batch(self, caption_texts, threshold=None):
+        """Evaluate captions, from the evaluation cache when possible and with one request for the others"""
+        self.batch_stats["captions"] += len(caption_texts)
+        evaluations = [self.cached_evaluation(caption_text) for caption_text in caption_texts]
+        missing = [position for position, evaluation in enumerate(evaluations) if evaluation is None]
+        if missing:
+            requested = self.request_evaluations([caption_texts[position] for position in missing], threshold)
+            for position, evaluation in zip(missing, requested):
+                evaluations[position] = evaluation
+                self.cache_evaluation(caption_texts[position], evaluation)
+        return evaluations
+
+    async def aevaluate_batch(self, caption_texts, threshold=None):
+        """Async variant of evaluate_batch"""
+        self.batch_stats["captions"] += len(caption_texts)
+        evaluations = [self.cached_evaluation(caption_text) for caption_text in caption_texts]
+        missing = [position for position, evaluation in enumerate(evaluations) if evaluation is None]
+        if missing:
+            requested = await self.arequest_evaluations([caption_texts[position] for position in missing], threshold)
+            for position, evaluation in zip(missing, requested):
+                evaluations[position] = evaluation
+                self.cache_evaluation(caption_texts[position], evaluation)
+        return evaluations
+
+    def request_evaluations(self, caption_texts, threshold=None):
+        """Evaluate captions with one request, captions missing from the reply are evaluated one by one"""
+        if len(caption_texts) == 1:
+            if self.config.fused:
+                return [self.fused_evaluate_caption(caption_texts[0], threshold)]
+            return [self.evaluate_caption(caption_texts[0])]
+
+        evaluations = {}
+        try:
+            response = self.retry_policy.call(self.model.invoke, self.build_batch_messages(caption_texts),
+                                              config=self.evaluation_config)
+            evaluations = parse_batch_evaluations(response.content, len(caption_texts))
+        except Exception as e:
+            print(f"Evaluation of {len(caption_texts)} captions failed, evaluating them one by one: {e}")
+
+        results = []
+        for number, caption_text in enumerate(caption_texts, start=1):
+            if number in evaluations:
+                results.append(evaluations[number])
+            else:
+                results.append(self.evaluate_caption(caption_text))
+        self.count_batch(evaluations, len(caption_texts))
+        return results
+
+    async def arequest_evaluations(self, caption_texts, threshold=None):
+        """Async variant of request_evaluations; missing captions are retried one after another in the same slot"""
+        if len(caption_texts) == 1:
+            if self.config.fused:
+                return [await self.afused_evaluate_caption(caption_texts[0], threshold)]
+            return [await self.aevaluate_caption(caption_texts[0])]
+
+        evaluations = {}
+        try:
+            response = await self.retry_policy.acall(self.model.ainvoke, self.build_batch_messages(caption_texts),
+                                                     config=self.evaluation_config)
+            evaluations = parse_batch_evaluations(response.content, len(caption_texts))
+        except Exception as e:
+            print(f"Evaluation of {len(caption_texts)} captions failed, evaluating them one by one: {e}")
+
+        results = []
+        for number, caption_text in enumerate(caption_texts, start=1):
+            if number in evaluations:
+                results.append(evaluations[number])
+            else:
+                results.append(await self.aevaluate_caption(caption_text))
+        self.count_batch(evaluations, len(caption_texts))
+        return results
+
+    def count_batch(self, evaluations, count):
+        """Record one multi-caption request and how many of its captions had to be re-evaluated"""
+        self.batch_stats["requests"] += 1
+        self.batch_stats["batched"] += len(evaluations)
+        self.batch_stats["fallbacks"] += count - len(evaluations)
+
+    # ========== Evaluation Cache ==========
+    def evaluation_key(self, caption_text):
+        return hash_parts(caption_text, model_fingerprint(self.model), self.evaluation_variant)
+
+    def cached_evaluation(self, caption_text):
+        """Cached {rating, reasoning, suggestions} of a caption text, None on a miss"""
+        if self.cache is None:
+            return None
+        value = self.cache.get(self.evaluation_key(caption_text))
+        return json.loads(value) if value is not None else None
+
+    def cache_evaluation(self, caption_text, evaluation):
+        """Store a successful evaluation; failed or unparseable ones are evaluated again next time"""
+        if self.cache is None or is_failed_evaluation({"evaluated": True, **evaluation}):
+            return
+        try:
+            rating = int(evaluation["rating"])
+        except (TypeError, ValueError):
+            return
+        if not 1 <= rating <= 10:
+            return
+        value = {"rating": rating, "reasoning": evaluation["reasoning"], "suggestions": evaluation["suggestions"]}
+        self.cache.put(self.evaluation_key(caption_text), json.dumps(value, ensure_ascii=False))
+
+    # ========== Local Pre-screen ==========
+    def prescreen(self, caption_text):
+        """Check the enabled rules in order, returns (route, rule, evaluation) of the first that fires, else None"""
+        if not self.config.prescreen_rules:
+            return None
+        self.prescreen_stats["checked"] += 1
+        for name in self.config.prescreen_rules:
+            verdict = PRESCREEN_RULES[name](caption_text, self.config)
+            if verdict is not None:
+                route, reasoning, suggestions = verdict
+                self.prescreen_stats[route] += 1
+                self.prescreen_stats["rules"][name] += 1
+                return route, name, {"rating": 0, "reasoning": f"Pre-screen: {reasoning}", "suggestions": suggestions}
+        return None
+
+    def apply_prescreen(self, caption, caption_text, route, rule, evaluation):
+        """Record a pre-screen verdict on the caption, returns whether it goes to optimization"""
+        if route == "optimize":
+            self.apply_evaluation(caption, caption_text, evaluation)
+        caption["prescreen"] = rule
+        return route == "optimize"
+
+    def prescreen_summary(self):
+        """One-line summary of the captions settled without a judge call"""
+        stats = self.prescreen_stats
+        settled = stats["optimize"] + stats["regenerate"]
+        avoided = settled / stats["checked"] * 100 if stats["checked"] else 0.0
+        rules = ", ".join(f"{name} {count}" for name, count in stats["rules"].items())
+        return (f"{settled} of {stats['checked']} captions settled locally ({stats['optimize']} sent to optimization, "
+                f"{stats['regenerate']} to regeneration), {avoided:.1f}% of judge evaluations avoided [{rules}]")
+
+    # ========== Threshold What-if Report ==========
+    def what_if(self, captions, thresholds):
+        """Per threshold: how many cached ratings fall below it and the estimated cost of optimizing them
+
+        Only the evaluation cache is read, no model call is made. Captions that were already optimized are
+        looked up by their original_caption, the text that was evaluated. Token counts are estimated from
+        the rendered optimization prompt at about 4 characters per token, and priced like the usage report
+        (config.prices, else the list price of the model) with no prompt tokens assumed cached.
+        """
+        prices = resolve_prices(self.config.prices, self.config.model_name)
+        rated = []
+        uncached = 0
+        for caption in captions:
+            caption_text = caption.get("original_caption", caption.get("image_caption", ""))
+            if not caption_text:
+                continue
+            evaluation = self.cached_evaluation(caption_text)
+            if evaluation is None:
+                uncached += 1
+                continue
+            messages = self.optimization_prefix.build(caption_text=caption_text, suggestions=evaluation["suggestions"])
+            prompt_tokens = sum(len(message.content) for message in messages) // 4
+            rated.append((evaluation["rating"], prompt_tokens, len(caption_text) // 4))
+
+        report = []
+        for threshold in thresholds:
+            below = [item for item in rated if item[0] < threshold]
+            report.append({
+                "threshold": threshold,
+                "optimized": len(below),
+                "share": len(below) / len(rated) if rated else 0.0,
+                "requests": len(below),
+                "prompt_tokens": sum(item[1] for item in below),
+                "completion_tokens": sum(item[2] for item in below),
+            })
+            report[-1]["cost_usd"] = call_cost(prices, report[-1]["prompt_tokens"], report[-1]["completion_tokens"], 0)
+        return {"cached": len(rated), "uncached": uncached, "priced": prices is not None, "thresholds": report}
+
+    # ========== Fused Evaluate and Rewrite ==========
+    def fused_prefix_for(self, threshold):
+        """Fused prompt prefix asking for a rewrite below `threshold`, rendered once per threshold"""
+        from cpj_common.prompt_prefix import PromptPrefix
+
+        if threshold not in self.fused_prefixes:
+            self.fused_prefixes[threshold] = PromptPrefix(
+                self.fused_prompt, threshold=threshold,
+                format_instructions=self.fused_parser.get_format_instructions())
+        return self.fused_prefixes[threshold]
+
+    def fused_evaluate_caption(self, caption_text, threshold=None):
+        """Rate a caption and, below the threshold, rewrite it with the same request"""
+        threshold = self.config.threshold if threshold is None else threshold
+        try:
+            messages = self.fused_prefix_for(threshold).build(caption_text=caption_text)
+            response = self.retry_policy.call(self.model.invoke, messages, config=self.evaluation_config)
+            evaluation = self.parse_fused(response.content)
+        except Exception as e:
+            print(f"Evaluation failed: {e}")
+            return {"rating": 0, "reasoning": f"Evaluation error: {str(e)}", "suggestions": "Try again"}
+
+        if self.audit_due():
+            reference = self.evaluate_caption(caption_text)
+            reference_rewrite = None
+            if reference["rating"] < threshold and evaluation["optimized_caption"]:
+                reference_rewrite = self.optimize_caption(caption_text, reference["suggestions"])
+            self.record_audit(evaluation, reference, reference_rewrite, threshold)
+        return evaluation
+
+    async def afused_evaluate_caption(self, caption_text, threshold=None):
+        """Async variant of fused_evaluate_caption"""
+        threshold = self.config.threshold if threshold is None else threshold
+        try:
+            messages = self.fused_prefix_for(threshold).build(caption_text=caption_text)
+            response = await self.retry_policy.acall(self.model.ainvoke, messages, config=self.evaluation_config)
+            evaluation = self.parse_fused(response.content)
+        except Exception as e:
+            print(f"Evaluation failed: {e}")
+            return {"rating": 0, "reasoning": f"Evaluation error: {str(e)}", "suggestions": "Try again"}
+
+        if self.audit_due():
+            reference = await self.aevaluate_caption(caption_text)
+            reference_rewrite = None
+            if reference["rating"] < threshold and evaluation["optimized_caption"]:
+                reference_rewrite = await self.aoptimize_caption(caption_text, reference["suggestions"])
+            self.record_audit(evaluation, reference, reference_rewrite, threshold)
+        return evaluation
+
+    def parse_fused(self, response_content):
+        """Parse a fused response into an evaluation whose "optimized_caption" is "" when there is no rewrite"""
+        evaluation = self.parse_evaluation(response_content)
+        try:
+            optimized_caption = str(self.fused_parser.parse(response_content).get("optimized_caption") or "")
+        except Exception:
+            optimized_caption = ""
+        evaluation["optimized_caption"] = optimized_caption.strip()
+        return evaluation
+
+    def take_rewrite(self, evaluation):
+        """Rewrite carried by a fused evaluation, None if the optimization prompt still has to run"""
+        if not self.config.fused:
+            return None
+        if evaluation.get("optimized_caption"):
+            self.fused_stats["rewrites"] += 1
+            return evaluation["optimized_caption"]
+        self.fused_stats["fallbacks"] += 1
+        return None
+
+    def audit_due(self):
+        """Whether this fused evaluation is also run through the two-call path, evenly spread at fused_audit"""
+        count = self.fused_stats["captions"]
+        self.fused_stats["captions"] += 1
+        return int((count + 1) * self.config.fused_audit) > int(count * self.config.fused_audit)
+
+    def record_audit(self, evaluation, reference, reference_rewrite, threshold):
+        """Compare a fused evaluation with what the two-call path decided at `threshold` for the same caption"""
+        stats = self.fused_stats
+        stats["audited"] += 1
+        stats["rating_difference"] += abs(evaluation["rating"] - reference["rating"])
+        if (evaluation["rating"] < threshold) == (reference["rating"] < threshold):
+            stats["agreed"] += 1
+        if reference_rewrite is not None:
+            matcher = difflib.SequenceMatcher(None, evaluation["optimized_caption"], reference_rewrite)
+            stats["similarity"].append(matcher.ratio())
+
+    def fused_summary(self):
+        """One-line summary of the fused mode, plus its agreement with the two-call path if audited"""
+        stats = self.fused_stats
+        summary = (f"{stats['rewrites']} captions rewritten by the judge call, "
+                   f"{stats['fallbacks']} needed the optimization prompt")
+        if stats["audited"]:
+            summary += (f"; audit of {stats['audited']} captions: same optimize decision as the two-call path for "
+                        f"{stats['agreed']} ({stats['agreed'] / stats['audited'] * 100:.1f}%), "
+                        f"mean rating difference {stats['rating_difference'] / stats['audited']:.2f}")
+            if stats["similarity"]:
+                summary += (f", mean rewrite similarity {sum(stats['similarity']) / len(stats['similarity']):.2f} "
+                            f"over {len(stats['similarity'])} rewrites")
+        return summary
+
+    # ========== Optimize Caption ==========
+    def optimize_caption(self, caption_text, suggestions):
+        """Optimize a caption based on suggestions"""
+        try:
+            # Format the optimization prompt
+            messages = self.optimization_prefix.build(caption_text=caption_text, suggestions=suggestions)
 
-    args = parser.parse_args()
+            # Call the model
+            response = self.retry_policy.call(self.model.invoke, messages, config=self.invoke_config)
 
-    # Load image captions
-    print(f"Loading captions from {args.input}...")
-    image_captions = load_image_captions(args.input)
+            # Return the optimized caption
+            return response.content.strip()
 
-    # Process and optimize captions
-    print(f"Evaluating and optimizing captions (threshold: {args.threshold})...")
-    updated_captions = process_and_optimize_captions(image_captions, args.threshold)
+        except Exception as e:
+            print(f"Optimization failed: {e}")
+            return caption_text  # Return original caption if optimization fails
+
+    async def aoptimize_caption(self, caption_text, suggestions):
+        """Optimize a caption based on suggestions without blocking the event loop"""
+        try:
+            messages = self.optimization_prefix.build(caption_text=caption_text, suggestions=suggestions)
+            response = await self.retry_policy.acall(self.model.ainvoke, messages, config=self.invoke_config)
+            return response.content.strip()
+        except Exception as e:
+            print(f"Optimization failed: {e}")
+            return caption_text  # Return original caption if optimization fails
+
+    # ========== Write Results Back ==========
+    @staticmethod
+    def apply_evaluation(caption, caption_text, evaluation):
+        """Add evaluation results to the caption"""
+        caption["rating"] = evaluation["rating"]
+        caption["reasoning"] = evaluation["reasoning"]
+        caption["suggestions"] = evaluation["suggestions"]
+        caption["evaluated"] = True
 
-    # Save the updated captions
-    print(f"Saving results to {args.output}...")
-    save_image_captions(args.output, updated_captions)
+        # Store original caption before optimization
+        if "original_caption" not in caption:
+            caption["original_caption"] = caption_text
+
+    @staticmethod
+    def apply_optimization(i, caption, caption_text, optimized_caption, rating):
+        """Replace the caption with its optimized version"""
+        caption["image_caption"] = optimized_caption
+        caption["optimized"] = True
+
+        # Print progress
+        print(f"\nOptimized caption {i + 1}:")
+        print(f"  Original: {caption_text[:80]}...")
+        print(f"  Optimized: {optimized_caption[:80]}...")
+        print(f"  Rating: {rating}/10")
+
+    # ========== Process and Optimize Captions ==========
+    def pending_groups(self, captions):
+        """Captions still to evaluate: (count, index groups of judge_batch_size, [(i, pre-screen verdict)])
+
+        Captions settled by a pre-screen rule are not part of any group.
+        """
+        # Skip if no caption or already processed
+        pending = [i for i, caption in enumerate(captions)
+                   if caption.get("image_caption", "") and not caption.get("evaluated", False)]
+        screened = []
+        to_judge = []
+        for i in pending:
+            verdict = self.prescreen(captions[i]["image_caption"])
+            if verdict is None:
+                to_judge.append(i)
+            else:
+                screened.append((i, verdict))
+        batch_size = max(1, self.config.judge_batch_size)
+        groups = [to_judge[start:start + batch_size] for start in range(0, len(to_judge), batch_size)]
+        return len(pending), groups, screened
+
+    def process_and_optimize_captions(self, captions, threshold=None, sink=None):
+        """Process and optimize low-scoring image captions"""
+        from tqdm import tqdm
+
+        threshold = self.config.threshold if threshold is None else threshold
+        pending_count, groups, screened = self.pending_groups(captions)
+        with tqdm(total=pending_count, desc="Evaluating and optimizing captions") as progress:
+            # Captions settled by the pre-screen skip the judge
+            for i, (route, rule, evaluation) in screened:
+                caption_text = captions[i]["image_caption"]
+                if self.apply_prescreen(captions[i], caption_text, route, rule, evaluation):
+                    optimized_caption = self.optimize_caption(caption_text, evaluation["suggestions"])
+                    self.apply_optimization(i, captions[i], caption_text, optimized_caption, evaluation["rating"])
+                if sink is not None:
+                    sink.write(captions[i])
+                progress.update(1)
+
+            for group in groups:
+                # Evaluate the captions
+                caption_texts = [captions[i]["image_caption"] for i in group]
+                evaluations = self.evaluate_batch(caption_texts, threshold)
+
+                for i, caption_text, evaluation in zip(group, caption_texts, evaluations):
+                    self.apply_evaluation(captions[i], caption_text, evaluation)
+
+                    # Optimize if rating is below threshold
+                    if evaluation["rating"] < threshold:
+                        optimized_caption = self.take_rewrite(evaluation)
+                        if optimized_caption is None:
+                            optimized_caption = self.optimize_caption(caption_text, evaluation["suggestions"])
+                        self.apply_optimization(i, captions[i], caption_text, optimized_caption, evaluation["rating"])
+                    else:
+                        captions[i]["optimized"] = False
+
+                    if sink is not None:
+                        sink.write(captions[i])
+                    progress.update(1)
+
+        return captions
+
+    # ========== Concurrent Evaluate/Optimize Pipeline ==========
+    async def aprocess_and_optimize_captions(self, captions, threshold=None, sink=None):
+        """Concurrent variant of process_and_optimize_captions with `workers` model calls in flight
+
+        Evaluations run concurrently; a caption rated below the threshold goes straight to the optimize
+        queue. Results are written back into `captions` by index, so the output order is unchanged.
+        """
+        from tqdm import tqdm
+
+        threshold = self.config.threshold if threshold is None else threshold
+        workers = max(1, self.config.workers)
+        semaphore = asyncio.Semaphore(workers)
+        evaluate_queue = asyncio.Queue()
+        optimize_queue = asyncio.Queue()
+
+        pending_count, groups, screened = self.pending_groups(captions)
+        for group in groups:
+            evaluate_queue.put_nowait(group)
+        progress = tqdm(total=pending_count, desc="Evaluating and optimizing captions")
+
+        def finish(i):
+            if sink is not None:
+                sink.write(captions[i])
+            progress.update(1)
+
+        def fail_evaluation(i, caption_text, error):
+            # Recorded like a failed API call, so --resume evaluates the caption again
+            print(f"Evaluation failed: {error}")
+            self.apply_evaluation(captions[i], caption_text, {"rating": 0, "reasoning": f"Evaluation error: {error}",
+                                                              "suggestions": "Try again"})
+            captions[i]["optimized"] = False
+            finish(i)
+
+        async def evaluator():
+            while True:
+                group = await evaluate_queue.get()
+                try:
+                    caption_texts = [captions[i]["image_caption"] for i in group]
+                    try:
+                        async with semaphore:
+                            evaluations = await self.aevaluate_batch(caption_texts, threshold)
+                    except Exception as e:
+                        for i, caption_text in zip(group, caption_texts):
+                            fail_evaluation(i, caption_text, e)
+                        continue
+
+                    for i, caption_text, evaluation in zip(group, caption_texts, evaluations):
+                        try:
+                            self.apply_evaluation(captions[i], caption_text, evaluation)
+                            if evaluation["rating"] < threshold:
+                                optimized_caption = self.take_rewrite(evaluation)
+                                if optimized_caption is None:
+                                    optimize_queue.put_nowait((i, caption_text, evaluation))
+                                    continue
+                                self.apply_optimization(i, captions[i], caption_text, optimized_caption,
+                                                        evaluation["rating"])
+                            else:
+                                captions[i]["optimized"] = False
+                        except Exception as e:
+                            fail_evaluation(i, caption_text, e)
+                            continue
+                        finish(i)
+                finally:
+                    evaluate_queue.task_done()
+
+        async def optimizer():
+            while True:
+                i, caption_text, evaluation = await optimize_queue.get()
+                try:
+                    try:
+                        async with semaphore:
+                            optimized_caption = await self.aoptimize_caption(caption_text, evaluation["suggestions"])
+                        self.apply_optimization(i, captions[i], caption_text, optimized_caption, evaluation["rating"])
+                    except Exception as e:
+                        # Keep the evaluated caption unchanged, like a failed optimization call
+                        print(f"Optimization failed: {e}")
+                        captions[i]["image_caption"] = caption_text
+                        captions[i]["optimized"] = False
+                    finish(i)
+                finally:
+                    optimize_queue.task_done()
+
+        async def drain():
+            # Optimizations are queued before their evaluation is marked done, so this order drains both
+            await evaluate_queue.join()
+            await optimize_queue.join()
+
+        # Captions settled by the pre-screen skip the judge
+        for i, (route, rule, evaluation) in screened:
+            caption_text = captions[i]["image_caption"]
+            if self.apply_prescreen(captions[i], caption_text, route, rule, evaluation):
+                optimize_queue.put_nowait((i, caption_text, evaluation))
+            else:
+                finish(i)
+
+        tasks = [asyncio.ensure_future(evaluator()) for _ in range(workers)]
+        tasks += [asyncio.ensure_future(optimizer()) for _ in range(workers)]
+        drained = asyncio.ensure_future(drain())
+        try:
+            # A worker that still dies (e.g. the checkpoint file cannot be written) raises here instead of
+            # leaving the queues undrained forever
+            done, _ = await asyncio.wait([drained, *tasks], return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task is not drained:
+                    task.result()
+        finally:
+            for task in [drained, *tasks]:
+                task.cancel()
+            await asyncio.gather(drained, *tasks, return_exceptions=True)
+            progress.close()
+
+        return captions
+
+    # ========== File-to-File Run ==========
+    def run(self, input_path, output_path):
+        """Evaluate and optimize the captions in input_path and save them to output_path"""
+        # Load image captions
+        print(f"Loading captions from {input_path}...")
+        image_captions = load_image_captions(input_path)
+
+        # Reuse evaluations from an interrupted run, indexed by image path
+        checkpoint_path = f"{output_path}.partial.jsonl"
+        resumed = {}
+        if self.config.resume:
+            resumed = load_for_resume(checkpoint_path, image_key, is_failed_evaluation, output_path=output_path)
+            print(f"Reusing evaluations for {apply_resumed(image_captions, resumed)} captions from the previous run")
+
+        # Process and optimize captions, appending each finished caption to the checkpoint file
+        print(f"Evaluating and optimizing captions (threshold: {self.config.threshold})...")
+        with JsonlSink(checkpoint_path) as sink:
+            if self.config.workers > 1:
+                updated_captions = asyncio.run(self.aprocess_and_optimize_captions(image_captions, sink=sink))
+            else:
+                updated_captions = self.process_and_optimize_captions(image_captions, sink=sink)
+
+        # Save the updated captions
+        print(f"Saving results to {output_path}...")
+        save_image_captions(output_path, updated_captions)
+        os.remove(checkpoint_path)
+        finish_resume(checkpoint_path)
+
+        # Calculate statistics
+        total_count = len(updated_captions)
+        evaluated_count = sum(1 for c in updated_captions if c.get("evaluated", False))
+        optimized_count = sum(1 for c in updated_captions if c.get("optimized", False))
+
+        print(f"\nProcessing complete!")
+        print(f"Total captions: {total_count}")
+        print(f"Evaluated captions: {evaluated_count}")
+        print(f"Optimized captions: {optimized_count} ({optimized_count/total_count*100:.1f}%)")
+
+        # Captions settled by the pre-screen have no judge rating
+        rated = [c.get("rating", 0) for c in updated_captions if c.get("evaluated", False) and "prescreen" not in c]
+        if rated:
+            avg_rating = sum(rated) / len(rated)
+            print(f"Average rating: {avg_rating:.2f}/10")
+        if self.config.prescreen_rules:
+            print(f"Pre-screen: {self.prescreen_summary()}")
+            if self.prescreen_stats["regenerate"]:
+                print(f"  {self.prescreen_stats['regenerate']} captions hold generation errors, re-run "
+                      f"caption_generation.py with --resume to regenerate them")
+
+        if self.config.judge_batch_size > 1:
+            print(f"Batched evaluation: {self.batch_stats['batched']} captions scored by {self.batch_stats['requests']} "
+                  f"multi-caption requests, {self.batch_stats['fallbacks']} re-evaluated individually")
+        if self.config.fused:
+            print(f"Fused evaluation: {self.fused_summary()}")
+        if self.batch_stats["captions"]:
+            print(f"Evaluation prompt tokens per caption: "
+                  f"{self.evaluation_usage.prompt_tokens / self.batch_stats['captions']:.0f}")
+        if self.cache is not None:
+            evicted = self.cache.evict()
+            cache_stats = self.cache.stats()
+            print(f"Evaluation cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses "
+                  f"({cache_stats['hit_rate'] * 100:.1f}% hit rate), evicted {evicted} entries")
+        print(f"Token usage: {self.usage_tracker.summary()}")
+        print(f"Retries: {self.retry_policy.summary()}")
+        if self.config.usage_report:
+            # Records of a stage are the captions it handled in this run, reused evaluations excluded
+            fresh = [c for c in updated_captions if image_key(c) not in resumed]
+            stages = {"judge": (self.evaluation_usage, sum(1 for c in fresh if c.get("evaluated", False))),
+                      "optimize": (self.optimization_usage, sum(1 for c in fresh if c.get("optimized", False)))}
+            write_usage_report(self.config.usage_report, stages, self.retry_policy)
+            print(f"Usage report written to {self.config.usage_report}")
+        return updated_captions
+
+    def print_what_if(self, input_path, thresholds):
+        """Print the what-if report for the captions in input_path"""
+        if self.cache is None:
+            raise ValueError("the what-if report reads the evaluation cache, set cache_dir")
+        report = self.what_if(load_image_captions(input_path), thresholds)
+        print(f"What-if report from cached ratings: {report['cached']} captions rated, "
+              f"{report['uncached']} not in the evaluation cache (no API calls made)")
+        if not report["priced"]:
+            pricing = f"no price known for {self.config.model_name}, pass --price-per-mtok for a cost"
+        else:
+            pricing = "cost from " + ("--price-per-mtok" if self.config.prices else f"{self.config.model_name} list prices")
+        print(f"Token counts are estimates at ~4 characters per token (chars/4); {pricing}")
+        print(f"{'threshold':>9} {'optimized':>10} {'share':>7} {'requests':>9} "
+              f"{'~prompt tokens':>15} {'~completion tokens':>19} {'~cost (USD)':>12}")
+        for row in report["thresholds"]:
+            cost = f"{row['cost_usd']:.4f}" if row["cost_usd"] is not None else "n/a"
+            print(f"{row['threshold']:>9} {row['optimized']:>10} {row['share'] * 100:>6.1f}% {row['requests']:>9} "
+                  f"{row['prompt_tokens']:>15} {row['completion_tokens']:>19} {cost:>12}")
+        return report
 
-    # Calculate statistics
-    total_count = len(updated_captions)
-    evaluated_count = sum(1 for c in updated_captions if c.get("evaluated", False))
-    optimized_count = sum(1 for c in updated_captions if c.get("optimized", False))
+    def close(self):
+        if self.cache is not None:
+            self.cache.close()
 
-    print(f"\nProcessing complete!")
-    print(f"Total captions: {total_count}")
-    print(f"Evaluated captions: {evaluated_count}")
-    print(f"Optimized captions: {optimized_count} ({optimized_count/total_count*100:.1f}%)")
 
-    if evaluated_count > 0:
-        avg_rating = sum(c.get("rating", 0) for c in updated_captions if c.get("evaluated", False)) / evaluated_count
-        print(f"Average rating: {avg_rating:.2f}/10")
+# ========== Main Function ==========
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Caption Judge and Optimize Script')
+    parser.add_argument('--input', '-i', required=True, help='Input JSON file path')
+    parser.add_argument('--output', '-o', help='Output JSON file path')
+    parser.add_argument('--threshold', '-t', type=int, default=8,
+                       help='Quality threshold (1-10). Captions below this will be optimized. Default: 8')
+    parser.add_argument('--workers', '-w', type=int, default=1,
+                       help='Number of concurrent evaluate/optimize requests. Default: 1 (sequential)')
+    parser.add_argument('--judge-batch-size', type=int, default=1,
+                       help='Number of captions scored by one evaluation request. Default: 1')
+    parser.add_argument('--fused', action='store_true',
+                       help='Rate each caption and rewrite low-rated ones with a single request')
+    parser.add_argument('--fused-audit', type=float, default=0.05,
+                       help='Fraction of fused evaluations also run through the two-call path to log their agreement. '
+                            'Default: 0.05, 0 disables the audit')
+    parser.add_argument('--resume', action='store_true',
+                       help='Reuse evaluations from a previous partial run and only process missing or failed captions')
+    parser.add_argument('--prescreen', action='store_true',
+                       help='Settle obvious failures with local rules before the judge: generation errors go to '
+                            'regeneration, truncated captions and captions outside --min-words/--max-words go '
+                            'straight to optimization')
+    parser.add_argument('--prescreen-rules', type=str, default=','.join(DEFAULT_PRESCREEN_RULES),
+                       help=f'Comma-separated rules used by --prescreen. Default: {",".join(DEFAULT_PRESCREEN_RULES)}')
+    parser.add_argument('--min-words', type=int, default=80, help='Lower word limit of the word_count rule. Default: 80')
+    parser.add_argument('--max-words', type=int, default=120, help='Upper word limit of the word_count rule. Default: 120')
+    parser.add_argument('--cache-dir', type=str, default='.caption_cache',
+                       help='Directory of the persistent evaluation cache. Default: .caption_cache')
+    parser.add_argument('--no-cache', action='store_true', help='Disable the persistent evaluation cache')
+    add_retry_arguments(parser, max_retries=3)
+    add_usage_arguments(parser)
+    parser.add_argument('--what-if-thresholds', type=str, default=None,
+                       help='Comma-separated thresholds, e.g. 6,7,8,9. Report from cached ratings how many captions '
+                            'each would optimize and the estimated cost, then exit without API calls')
+
+    args = parser.parse_args(argv)
+    thresholds = None
+    if args.what_if_thresholds:
+        try:
+            thresholds = [int(value) for value in args.what_if_thresholds.split(',') if value.strip()]
+        except ValueError:
+            parser.error("--what-if-thresholds expects comma-separated integers, e.g. 6,7,8,9")
+        if args.no_cache:
+            parser.error("--what-if-thresholds reads the evaluation cache and cannot be combined with --no-cache")
+    elif not args.output:
+        parser.error("the following arguments are required: --output/-o")
+    prescreen_rules = ()
+    if args.prescreen:
+        prescreen_rules = tuple(name.strip() for name in args.prescreen_rules.split(',') if name.strip())
+        unknown_rules = [name for name in prescreen_rules if name not in PRESCREEN_RULES]
+        if unknown_rules:
+            parser.error(f"unknown --prescreen-rules {unknown_rules}, available: {', '.join(PRESCREEN_RULES)}")
+    if args.fused and args.judge_batch_size > 1:
+        parser.error("--fused rates one caption per request and cannot be combined with --judge-batch-size")
+
+    os.environ["OPENAI_API_BASE"] = API_BASE
+    os.environ["OPENAI_API_KEY"] = API_KEY
+
+    refiner = CaptionRefiner(RefinerConfig(threshold=args.threshold, workers=args.workers,
+                                           judge_batch_size=args.judge_batch_size, fused=args.fused,
+                                           fused_audit=args.fused_audit, resume=args.resume,
+                                           prescreen_rules=prescreen_rules, min_words=args.min_words,
+                                           max_words=args.max_words,
+                                           cache_dir=None if args.no_cache else args.cache_dir,
+                                           max_retries=args.max_retries, retry_budget=args.retry_budget,
+                                           breaker_error_rate=args.breaker_error_rate,
+                                           breaker_cooldown=args.breaker_cooldown,
+                                           prices=prices_from_args(args), usage_report=args.usage_report))
+    try:
+        if thresholds:
+            refiner.print_what_if(args.input, thresholds)
+        else:
+            refiner.run(args.input, args.output)
+    finally:
+        refiner.close()
 
 
 if __name__ == "__main__":
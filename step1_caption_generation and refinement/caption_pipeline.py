@@ -0,0 +1,417 @@
+# coding: utf-8
+"""
+Streaming Caption Pipeline
+Runs caption generation, judging and optimization concurrently, each stage working on different images.
+
+Usage:
+    python caption_pipeline.py --input images.json --output refined.json
+    python caption_pipeline.py --input images.json --output refined.json --concurrency 8 --workers 8 --queue-size 32
+
+Library usage (importing this module has no side effects; LangChain is imported lazily):
+    from caption_generation import CaptionConfig, CaptionGenerator
+    from caption_judge_optimize import CaptionRefiner, RefinerConfig
+    from caption_pipeline import CaptionPipeline
+    pipeline = CaptionPipeline(CaptionGenerator(CaptionConfig(concurrency=8)), CaptionRefiner(RefinerConfig(workers=8)))
+    pipeline.run("images.json", "refined.json")
+
+Features:
+    - generate -> judge -> optimize connected by bounded queues; when a later stage falls behind, the earlier
+      stages wait instead of buffering captions in memory (backpressure)
+    - Refined captions are appended to <output>.partial.jsonl in input order as soon as they are final
+    - Per-stage throughput, average request time and time spent waiting on the next stage
+    - Same records as caption_generation.py followed by caption_judge_optimize.py; captions whose generation
+      failed are passed through without being judged
+    - --prescreen settles truncated or out-of-range captions locally and sends them straight to optimization
+    - Re-runs are cheap through the caption response cache and the evaluation cache (no --resume or --dedup here)
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from cpj_common.image_payload import add_image_arguments
+from cpj_common.jsonl_sink import JsonlSink, jsonl_to_json
+from cpj_common.prefetch import ImagePrefetcher
+from cpj_common.retry_policy import add_retry_arguments
+from cpj_common.usage import add_usage_arguments, prices_from_args, write_usage_report
+
+import caption_generation
+import caption_judge_optimize
+from caption_generation import CaptionConfig, CaptionGenerator
+from caption_judge_optimize import DEFAULT_PRESCREEN_RULES, CaptionRefiner, RefinerConfig
+
+
+# ========== Stage Counters ==========
+class StageStats:
+    """Captions, requests, request time and downstream waiting time of one pipeline stage"""
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.requests = 0
+        self.request_time = 0.0
+        self.blocked_time = 0.0
+        self.first_start = None
+        self.last_done = None
+
+    def start(self):
+        now = time.perf_counter()
+        if self.first_start is None:
+            self.first_start = now
+        return now
+
+    def done(self, started, items=1):
+        now = time.perf_counter()
+        self.items += items
+        self.requests += 1
+        self.request_time += now - started
+        self.last_done = now
+
+    def throughput(self):
+        """Captions per second between the stage's first request and its last result"""
+        if not self.items or self.last_done <= self.first_start:
+            return 0.0
+        return self.items / (self.last_done - self.first_start)
+
+    def summary(self):
+        average = self.request_time / self.requests if self.requests else 0.0
+        return (f"{self.name}: {self.items} captions in {self.requests} requests, {self.throughput():.2f} captions/sec, "
+                f"avg request {average:.2f}s, waited {self.blocked_time:.1f}s for room in the next queue")
+
+
+# ========== Streaming Pipeline ==========
+class CaptionPipeline:
+    """Connects a CaptionGenerator and a CaptionRefiner with bounded queues"""
+
+    def __init__(self, generator, refiner, queue_size=16):
+        if generator.config.dedup_threshold is not None or generator.config.resume:
+            raise ValueError("the streaming pipeline does not support dedup or resume, run the stages separately")
+        self.generator = generator
+        self.refiner = refiner
+        # One retry budget and one circuit breaker for all three stages
+        self.retry_policy = generator.retry_policy
+        refiner.retry_policy = self.retry_policy
+        self.queue_size = max(1, queue_size)
+        self.stats = {name: StageStats(name) for name in ("generate", "judge", "optimize")}
+        self.failed = 0
+        self.emitted = 0
+
+    @staticmethod
+    async def put(queue, item, stats):
+        """Put item on a bounded queue, counting the time spent waiting for room as backpressure"""
+        started = time.perf_counter()
+        await queue.put(item)
+        stats.blocked_time += time.perf_counter() - started
+
+    async def stream(self, data, sink):
+        """Caption, judge and optimize all entries, appending each final record to sink in input order"""
+        generator, refiner = self.generator, self.refiner
+        threshold = refiner.config.threshold
+        workers = max(1, refiner.config.workers)
+        judge_batch_size = max(1, refiner.config.judge_batch_size)
+        group_size = max(1, generator.config.images_per_request)
+
+        pending = []
+        for idx, entry in enumerate(data, start=1):
+            if "image" in entry:
+                pending.append((len(pending), idx, entry))
+        total = len(data)
+
+        judge_queue = asyncio.Queue(self.queue_size)
+        optimize_queue = asyncio.Queue(self.queue_size)
+        generate_slots = asyncio.Semaphore(max(1, generator.config.concurrency))
+        # Judge and optimize requests share the refiner's worker budget
+        model_slots = asyncio.Semaphore(workers)
+
+        def emit(position, record):
+            sink.write_at(position, record)
+            self.emitted += 1
+            if self.emitted % 10 == 0:
+                print(f"[PROGRESS] {self.emitted}/{len(pending)} captions final "
+                      f"(generated {self.stats['generate'].items}, judged {self.stats['judge'].items}, "
+                      f"optimized {self.stats['optimize'].items}), queued for judge {judge_queue.qsize()}, "
+                      f"for optimize {optimize_queue.qsize()}")
+
+        # ========== Stage 1: Generate ==========
+        async def run_group(group, prefetched):
+            stats = self.stats["generate"]
+            try:
+                started = stats.start()
+                results = await generator.caption_group(total, [
+                    (idx, entry, loaded) for (_, idx, entry), loaded in zip(group, prefetched)
+                ])
+                stats.done(started, len(group))
+                for (position, _, _), (result, succeeded) in zip(group, results):
+                    if succeeded:
+                        await self.put(judge_queue, (position, result), stats)
+                    else:
+                        self.failed += 1
+                        emit(position, result)
+            finally:
+                # The slot is held until the judge queue took the captions, so a full queue pauses generation
+                generate_slots.release()
+
+        async def generate_stage():
+            tasks = []
+            with ImagePrefetcher(generator.load_image, [entry["image"] for _, _, entry in pending],
+                                 lookahead=max(generator.config.prefetch, group_size)) as prefetcher:
+                for start in range(0, len(pending), group_size):
+                    group = pending[start:start + group_size]
+                    await generate_slots.acquire()
+                    prefetched = [await prefetcher.next_async() for _ in group]
+                    tasks.append(asyncio.ensure_future(run_group(group, prefetched)))
+                await asyncio.gather(*tasks)
+            await judge_queue.put(None)
+
+        # ========== Stage 2: Judge ==========
+        async def judge():
+            stats = self.stats["judge"]
+            while True:
+                item = await judge_queue.get()
+                if item is None:
+                    # Leave the end marker for the other judges
+                    await judge_queue.put(None)
+                    return
+                batch = [item]
+                while len(batch) < judge_batch_size and not judge_queue.empty():
+                    item = judge_queue.get_nowait()
+                    if item is None:
+                        judge_queue.put_nowait(None)
+                        break
+                    batch.append(item)
+
+                # Captions settled by the pre-screen skip the judge
+                to_judge = []
+                for position, record in batch:
+                    caption_text = record["image_caption"]
+                    verdict = refiner.prescreen(caption_text)
+                    if verdict is None:
+                        to_judge.append((position, record))
+                    elif refiner.apply_prescreen(record, caption_text, *verdict):
+                        await self.put(optimize_queue, (position, record, caption_text, verdict[2]), stats)
+                    else:
+                        emit(position, record)
+                batch = to_judge
+                if not batch:
+                    continue
+
+                caption_texts = [record["image_caption"] for _, record in batch]
+                async with model_slots:
+                    started = stats.start()
+                    evaluations = await refiner.aevaluate_batch(caption_texts, threshold)
+                    stats.done(started, len(batch))
+
+                for (position, record), caption_text, evaluation in zip(batch, caption_texts, evaluations):
+                    refiner.apply_evaluation(record, caption_text, evaluation)
+                    if evaluation["rating"] < threshold:
+                        optimized_caption = refiner.take_rewrite(evaluation)
+                        if optimized_caption is None:
+                            await self.put(optimize_queue, (position, record, caption_text, evaluation), stats)
+                            continue
+                        refiner.apply_optimization(position, record, caption_text, optimized_caption,
+                                                   evaluation["rating"])
+                    else:
+                        record["optimized"] = False
+                    emit(position, record)
+
+        async def judge_stage():
+            await asyncio.gather(*(judge() for _ in range(workers)))
+            await optimize_queue.put(None)
+
+        # ========== Stage 3: Optimize ==========
+        async def optimize():
+            stats = self.stats["optimize"]
+            while True:
+                item = await optimize_queue.get()
+                if item is None:
+                    await optimize_queue.put(None)
+                    return
+                position, record, caption_text, evaluation = item
+                async with model_slots:
+                    started = stats.start()
+                    optimized_caption = await refiner.aoptimize_caption(caption_text, evaluation["suggestions"])
+                    stats.done(started)
+                refiner.apply_optimization(position, record, caption_text, optimized_caption, evaluation["rating"])
+                emit(position, record)
+
+        async def optimize_stage():
+            await asyncio.gather(*(optimize() for _ in range(workers)))
+
+        stages = [asyncio.ensure_future(stage) for stage in (generate_stage(), judge_stage(), optimize_stage())]
+        try:
+            await asyncio.gather(*stages)
+        finally:
+            for stage in stages:
+                stage.cancel()
+            await asyncio.gather(*stages, return_exceptions=True)
+        return len(pending)
+
+    # ========== File-to-File Run ==========
+    async def arun(self, input_json, output_json):
+        """Run the three stages on every image listed in input_json and write output_json, returns run statistics"""
+        with open(input_json, "r", encoding="utf-8") as f:
+            data = json.load(f)
+
+        start_time = time.time()
+        if self.generator.cache is not None:
+            self.generator.cache.evict()
+
+        output_format = self.generator.config.output_format
+        checkpoint_path = output_json if output_format == "jsonl" else f"{output_json}.partial.jsonl"
+        with JsonlSink(checkpoint_path, fsync_every=self.generator.config.fsync_every) as sink:
+            completed = await self.stream(data, sink)
+
+        # ========== Save ==========
+        if output_format == "json":
+            jsonl_to_json(checkpoint_path, output_json, indent=4)
+            os.remove(checkpoint_path)
+
+        total_time = time.time() - start_time
+        throughput = completed / total_time if total_time > 0 else 0
+        print(f"[SUCCESS] Generated {output_json}, {completed - self.failed}/{len(data)} images captioned and judged, "
+              f"{self.failed} failed captions passed through")
+        print(f"[TIME] Total time: {total_time:.2f} seconds, {throughput:.2f} images/sec end to end")
+        for stats in self.stats.values():
+            print(f"[STAGE] {stats.summary()}")
+
+        print(f"[TOKENS] generate: {self.generator.usage_tracker.summary()}")
+        print(f"[TOKENS] judge and optimize: {self.refiner.usage_tracker.summary()}")
+        print(f"[RETRY] {self.retry_policy.summary()}")
+        usage_report = self.generator.config.usage_report
+        if usage_report:
+            stages = {"generate": (self.generator.usage_tracker, self.stats["generate"].items),
+                      "judge": (self.refiner.evaluation_usage, self.stats["judge"].items),
+                      "optimize": (self.refiner.optimization_usage, self.stats["optimize"].items)}
+            write_usage_report(usage_report, stages, self.retry_policy)
+            print(f"[USAGE] Per-stage tokens, latency and cost written to {usage_report}")
+        if self.generator.payload_store is not None:
+            self.generator.payload_store.evict()
+            print(f"[STORE] {self.generator.payload_store.summary()}")
+        if self.refiner.config.judge_batch_size > 1:
+            batch_stats = self.refiner.batch_stats
+            print(f"[BATCH] {batch_stats['batched']} captions scored by {batch_stats['requests']} multi-caption "
+                  f"requests, {batch_stats['fallbacks']} re-evaluated individually")
+        if self.refiner.config.fused:
+            print(f"[FUSED] {self.refiner.fused_summary()}")
+        if self.refiner.config.prescreen_rules:
+            print(f"[PRESCREEN] {self.refiner.prescreen_summary()}")
+        for name, cache in (("caption", self.generator.cache), ("evaluation", self.refiner.cache)):
+            if cache is not None:
+                evicted = cache.evict()
+                cache_stats = cache.stats()
+                print(f"[CACHE] {name}: {cache_stats['hits']} hits, {cache_stats['misses']} misses "
+                      f"({cache_stats['hit_rate'] * 100:.1f}% hit rate), evicted {evicted} entries")
+
+        return {
+            "total": len(data),
+            "completed": completed,
+            "failed": self.failed,
+            "total_time": total_time,
+            "throughput": throughput,
+            "stages": {name: stats.throughput() for name, stats in self.stats.items()},
+        }
+
+    def run(self, input_json, output_json):
+        """Synchronous wrapper around arun()"""
+        return asyncio.run(self.arun(input_json, output_json))
+
+    def close(self):
+        self.generator.close()
+        self.refiner.close()
+
+
+# ========== Command Line Interface ==========
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Generate, judge and optimize image captions in one streaming run")
+    parser.add_argument("--input", type=str, required=True, help="Path to input JSON file")
+    parser.add_argument("--output", type=str, required=True, help="Path to output JSON file")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="Maximum number of concurrent VLM captioning requests (default: 1)")
+    parser.add_argument("--images-per-request", type=int, default=1,
+                        help="Pack up to N images into one VLM request, failed items are retried one by one (default: 1)")
+    parser.add_argument("--prefetch", type=int, default=4,
+                        help="Number of images read and encoded ahead of the requests in flight (default: 4)")
+    add_image_arguments(parser)
+    parser.add_argument("--threshold", "-t", type=int, default=8,
+                        help="Quality threshold (1-10). Captions below this will be optimized (default: 8)")
+    parser.add_argument("--workers", "-w", type=int, default=1,
+                        help="Number of concurrent judge/optimize requests (default: 1)")
+    parser.add_argument("--judge-batch-size", type=int, default=1,
+                        help="Number of captions scored by one evaluation request (default: 1)")
+    parser.add_argument("--fused", action="store_true",
+                        help="Rate each caption and rewrite low-rated ones with a single request")
+    parser.add_argument("--fused-audit", type=float, default=0.05,
+                        help="Fraction of fused evaluations also run through the two-call path to log their "
+                             "agreement (default: 0.05, 0 disables the audit)")
+    parser.add_argument("--prescreen", action="store_true",
+                        help="Send truncated captions and captions outside 80-120 words straight to optimization "
+                             "without a judge call")
+    parser.add_argument("--queue-size", type=int, default=16,
+                        help="Capacity of the queues between stages; a full queue pauses the stage before it "
+                             "(default: 16)")
+    parser.add_argument("--cache-dir", type=str, default=".caption_cache",
+                        help="Directory of the caption response and evaluation caches (default: .caption_cache)")
+    parser.add_argument("--no-cache", action="store_true", help="Disable both persistent caches")
+    parser.add_argument("--output-format", type=str, default="json", choices=["json", "jsonl"],
+                        help="Final output format; jsonl keeps the append-only checkpoint file as output (default: json)")
+    parser.add_argument("--fsync-every", type=int, default=0,
+                        help="fsync the checkpoint file every N records, 0 only flushes (default: 0)")
+    add_retry_arguments(parser, max_retries=3)
+    add_usage_arguments(parser)
+    return parser
+
+
+def main(argv=None):
+    parser = build_arg_parser()
+    args = parser.parse_args(argv)
+    if args.fused and args.judge_batch_size > 1:
+        parser.error("--fused rates one caption per request and cannot be combined with --judge-batch-size")
+
+    cache_dir = None if args.no_cache else args.cache_dir
+    retry_settings = dict(max_retries=args.max_retries, retry_budget=args.retry_budget,
+                          breaker_error_rate=args.breaker_error_rate, breaker_cooldown=args.breaker_cooldown)
+    # Each stage keeps the API credentials configured in its own script
+    generator = CaptionGenerator(CaptionConfig(
+        concurrency=args.concurrency,
+        prefetch=args.prefetch,
+        images_per_request=args.images_per_request,
+        cache_dir=cache_dir,
+        max_image_edge=args.max_image_edge,
+        image_format=args.image_format,
+        image_quality=args.image_quality,
+        payload_store_dir=args.payload_store,
+        payload_store_max_size_mb=args.payload_store_max_size_mb,
+        output_format=args.output_format,
+        fsync_every=args.fsync_every,
+        prices=prices_from_args(args),
+        usage_report=args.usage_report,
+        api_base=caption_generation.API_BASE,
+        api_key=caption_generation.API_KEY,
+        **retry_settings,
+    ))
+    refiner = CaptionRefiner(RefinerConfig(
+        threshold=args.threshold,
+        workers=args.workers,
+        judge_batch_size=args.judge_batch_size,
+        fused=args.fused,
+        fused_audit=args.fused_audit,
+        prescreen_rules=DEFAULT_PRESCREEN_RULES if args.prescreen else (),
+        cache_dir=cache_dir,
+        prices=prices_from_args(args),
+        api_base=caption_judge_optimize.API_BASE,
+        api_key=caption_judge_optimize.API_KEY,
+        **retry_settings,
+    ))
+    pipeline = CaptionPipeline(generator, refiner, queue_size=args.queue_size)
+    try:
+        pipeline.run(args.input, args.output)
+    finally:
+        pipeline.close()
+
+
+if __name__ == "__main__":
+    main()
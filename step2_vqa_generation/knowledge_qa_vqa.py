@@ -1,37 +1,82 @@
 ### coding: utf-8
+"""
+Knowledge QA VQA Generation Script
+Generates two answers (treatment and control / disease explanation) for each knowledge question.
+
+Usage:
+    python knowledge_qa_vqa.py --input input.json --output output.json --model gpt-4
+    python knowledge_qa_vqa.py --input input.json --output output.json --modality auto
+
+Library usage (importing this module has no side effects; LangChain is imported lazily):
+    from knowledge_qa_vqa import DualAnswerGenerator, VQAConfig
+    generator = DualAnswerGenerator(VQAConfig(model_name="gpt-4"))
+    generator.run("input.json", "output.json")
+"""
 import os
+import sys
 import json
-import base64
 import re
+import time
+import asyncio
 import argparse
-from collections import OrderedDict
-from langchain_openai import ChatOpenAI
-from langchain.output_parsers import StructuredOutputParser, ResponseSchema
-from langchain_core.messages import HumanMessage, SystemMessage
-from retry import retry
-from langchain.prompts.chat import (
-    ChatPromptTemplate,
-    SystemMessagePromptTemplate,
-    AIMessagePromptTemplate,
-    HumanMessagePromptTemplate,
-)
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from cpj_common.image_payload import ImagePayloadOptimizer, add_image_arguments, data_uri, describe_savings
+from cpj_common.jsonl_sink import JsonlSink
+from cpj_common.payload_store import create_image_loader
+from cpj_common.prefetch import ImagePrefetcher
+from cpj_common.rate_limit import RateLimiter, estimate_tokens
+from cpj_common.resume import count_resumed, finish_resume, keyed_record, load_keyed_for_resume, question_key
+from cpj_common.retry_policy import add_retry_arguments, retry_policy_from_config
+from cpj_common.usage import add_usage_arguments, prices_from_args, write_usage_report
+from cpj_common.task_profiles import TaskProfile, register_task
 
 # ========== API Configuration ==========
-os.environ["OPENAI_API_BASE"] = "YOUR_API_BASE_URL"
-os.environ["OPENAI_API_KEY"] = "YOUR_API_KEY"
-
-# os.environ["OPENAI_API_BASE"] = "YOUR_ALTERNATIVE_API_BASE_URL"  # Alternative API base (optional)
-# os.environ["OPENAI_API_KEY"] = "YOUR_ALTERNATIVE_API_KEY"  # Alternative API key (optional)
+API_BASE = "YOUR_API_BASE_URL"
+API_KEY = "YOUR_API_KEY"
+# API_BASE = "YOUR_ALTERNATIVE_API_BASE_URL"  # Alternative API base (optional)
+# API_KEY = "YOUR_ALTERNATIVE_API_KEY"  # Alternative API key (optional)
+
+
+@dataclass
+class VQAConfig:
+    """Settings for DualAnswerGenerator"""
+    model_name: str = "gpt-4"
+    reasoning_effort: str = "medium"
+    verbosity: str = "medium"
+    max_retries: int = 2               # Retries per call, made by the retry policy (the client itself does not retry)
+    retry_budget: float = 0.2          # Retries allowed per call over the whole run
+    breaker_error_rate: float = 0.5    # Error rate over recent calls that pauses dispatch, 0 disables
+    breaker_cooldown: float = 30
+    timeout: float = 30
+    api_base: Optional[str] = None     # Defaults to the OPENAI_API_BASE environment variable
+    api_key: Optional[str] = None      # Defaults to the OPENAI_API_KEY environment variable
+    prefetch: int = 4
+    concurrency: int = 1
+    requests_per_minute: Optional[float] = None   # Provider quotas, None disables the limit
+    tokens_per_minute: Optional[float] = None
+    max_prompt_tokens: Optional[int] = None  # Per-record prompt cap; few-shot examples are dropped to fit, None disables
+    completion_tokens: int = 400       # Expected completion tokens per question, counted against tokens_per_minute
+    max_image_edge: int = 1536
+    image_format: str = "jpeg"
+    image_quality: int = 85
+    payload_store_dir: Optional[str] = None  # Shared store of encoded images, None disables
+    payload_store_max_size_mb: float = 2048
+    prices: Optional[Tuple[float, float, float]] = None  # USD per 1M prompt/cached/completion tokens
+    usage_report: Optional[str] = None  # Path of the per-stage usage summary JSON, None disables
+    modality: str = "image"            # "text", "image", or "auto" (image only when the caption is not enough)
+    min_caption_words: int = 20        # auto: shorter captions get the image
+    min_caption_rating: int = 8        # auto: captions the judge rated lower and did not rewrite get the image
+    resume: bool = False
 
 # ========== Define Output Format ==========
-response_schemas = [
-    ResponseSchema(name="answer1",
-                   description="Detailed treatment, prevention and control measures for the disease, including specific methods and recommendations."),
-    ResponseSchema(name="answer2",
-                   description="Comprehensive explanation of the disease, including symptoms, causes, and disease cycle.")
-]
-output_parser = StructuredOutputParser.from_response_schemas(response_schemas)
-format_instructions = output_parser.get_format_instructions()
+answer_fields = {
+    "answer1": "Detailed treatment, prevention and control measures for the disease, including specific methods and recommendations.",
+    "answer2": "Comprehensive explanation of the disease, including symptoms, causes, and disease cycle.",
+}
 
 # ========== System Prompt ==========
 system_template = """You are an agricultural expert specializing in plant disease diagnosis and management. Based on the provided background information about a crop and its disease, you provide comprehensive, professional answers to open-ended questions about disease explanation, treatment, prevention, and control measures.
@@ -73,8 +118,6 @@ Scope
 {format_instructions}
 """
 
-system_message_prompt = SystemMessagePromptTemplate.from_template(system_template)
-
 # ========== Examples ==========
 
 
@@ -102,30 +145,46 @@ examples = [
 ]
 
 # ========== Build Prompt Template ==========
-example_human = HumanMessagePromptTemplate.from_template("{input}")
-example_ai = AIMessagePromptTemplate.from_template("{output}")
-
 human_template = "Background(image_caption): {image_caption}\nQuestion: {question}"
-human_message_prompt = HumanMessagePromptTemplate.from_template(human_template)
-
-# Pre-build example messages (for few-shot)
-example_messages = []
-for example in examples:
-    example_messages.append(example_human.format(**example))
-    example_messages.append(example_ai.format(**example))
-
-# Build complete prompt (few-shot version)
-chat_prompt = ChatPromptTemplate.from_messages(
-    [system_message_prompt]+ example_messages+[human_message_prompt]
-)
-#+ example_messages
-# Build zero-shot prompt template (backup)
-zero_shot_chat_prompt = ChatPromptTemplate.from_messages(
-    [system_message_prompt, human_message_prompt]
-)
-
-# ========== Model variable will be initialized in main function ==========
-model = None
+
+
+def build_prompt():
+    """Build the few-shot and zero-shot prompts and the output parser (imports LangChain on first use)"""
+    from langchain.output_parsers import StructuredOutputParser, ResponseSchema
+    from langchain.prompts.chat import (
+        ChatPromptTemplate,
+        SystemMessagePromptTemplate,
+        AIMessagePromptTemplate,
+        HumanMessagePromptTemplate,
+    )
+
+    response_schemas = [ResponseSchema(name=name, description=description)
+                        for name, description in answer_fields.items()]
+    output_parser = StructuredOutputParser.from_response_schemas(response_schemas)
+    format_instructions = output_parser.get_format_instructions()
+
+    system_message_prompt = SystemMessagePromptTemplate.from_template(system_template)
+    example_human = HumanMessagePromptTemplate.from_template("{input}")
+    example_ai = AIMessagePromptTemplate.from_template("{output}")
+    human_message_prompt = HumanMessagePromptTemplate.from_template(human_template)
+
+    # Pre-build example messages (for few-shot)
+    example_messages = []
+    for example in examples:
+        example_messages.append(example_human.format(**example))
+        example_messages.append(example_ai.format(**example))
+
+    # Build complete prompt (few-shot version)
+    chat_prompt = ChatPromptTemplate.from_messages(
+        [system_message_prompt] + example_messages + [human_message_prompt]
+    )
+
+    # Build zero-shot prompt template (backup)
+    zero_shot_chat_prompt = ChatPromptTemplate.from_messages(
+        [system_message_prompt, human_message_prompt]
+    )
+    return chat_prompt, zero_shot_chat_prompt, output_parser, format_instructions
+
 
 # ========== JSON Repair Function ==========
 def extract_and_fix_json(text):
@@ -174,155 +233,410 @@ def extract_and_fix_json(text):
     }
 
 
-# ========== API Call Function with Retry ==========
-@retry(exceptions=Exception, tries=2, delay=1)
-def get_model_response(messages):
-    """Call model and process response"""
-    try:
-        response = model.invoke(messages)
-        return str(response.content) if response.content else ""
-    except Exception as e:
-        print(f"API call failed: {str(e)}")
-        raise
-
+# ========== Checkpoint and Resume Helpers ==========
+FAILED_ANSWER_PREFIXES = ("API call failed:", "Failed to read image", "Failed to build prompt:")
+
+
+def is_failed_answer(record):
+    """Whether a previously written record holds an error instead of answers"""
+    answer1 = record.get("generation_answer1")
+    if not isinstance(answer1, str):
+        return True
+    return answer1 == "No response generated" or answer1.startswith(FAILED_ANSWER_PREFIXES)
+
+
+def has_required_fields(entry):
+    return "image" in entry and "question" in entry and "image_caption" in entry
+
+
+# ========== Modality Selection ==========
+MODALITIES = ("text", "image", "auto")
+
+
+def image_reason(entry, min_words, min_rating):
+    """Why the caption alone is not enough context for a record, None if it is"""
+    caption = entry.get("image_caption")
+    if not isinstance(caption, str) or not caption.strip():
+        return "no caption"
+    if len(caption.split()) < min_words:
+        return "short caption"
+    # Step 1 pre-screen verdicts and low ratings that were not followed by a rewrite
+    if entry.get("prescreen"):
+        return "flagged by caption judge"
+    rating = entry.get("rating")
+    if entry.get("evaluated") and not entry.get("optimized") and isinstance(rating, (int, float)) and rating < min_rating:
+        return "flagged by caption judge"
+    return None
+
+
+def store_result(results, sink, position, record):
+    """Keep a finished record and append it to the checkpoint file in input order"""
+    results[position] = record
+    sink.write_at(position, keyed_record(position, record))
+
+
+def with_answers(entry, answer1, answer2, prompt_variant=None):
+    """Keep original fields unchanged, add two answer fields (and the prompt variant used, if given)"""
+    new_entry = OrderedDict(entry)
+    new_entry["generation_answer1"] = answer1
+    new_entry["generation_answer2"] = answer2
+    if prompt_variant is not None:
+        new_entry["prompt_variant"] = prompt_variant
+    return new_entry
+
+
+# ========== Dual Answer Generator ==========
+class DualAnswerGenerator:
+    """Answers each knowledge question twice: treatment and control (answer1) and disease explanation (answer2)"""
+
+    def __init__(self, config=None, model=None):
+        from cpj_common.prompt_budget import PromptBudget
+        from cpj_common.usage_tracker import UsageTracker
+
+        self.config = config or VQAConfig()
+        chat_prompt, self.zero_shot_chat_prompt, self.output_parser, self.format_instructions = build_prompt()
+
+        # Render the invariant system prompt + few-shot examples once, in every size down to zero-shot; only the
+        # last message is built per record, and the full prompt is sent unless max_prompt_tokens is set
+        self.prompt_budget = PromptBudget(chat_prompt, self.zero_shot_chat_prompt,
+                                          max_prompt_tokens=self.config.max_prompt_tokens,
+                                          format_instructions=self.format_instructions)
+        self.prompt_prefix = self.prompt_budget.full
+
+        self.usage_tracker = UsageTracker(prices=self.config.prices)
+        self.invoke_config = {"callbacks": [self.usage_tracker]}
+        self.model = model if model is not None else self._create_model()
+        self.limiter = RateLimiter(self.config.requests_per_minute, self.config.tokens_per_minute)
+        self.retry_policy = retry_policy_from_config(self.config)
+        if self.config.modality not in MODALITIES:
+            raise ValueError(f"modality must be one of {', '.join(MODALITIES)}, got {self.config.modality!r}")
+        self.modality_stats = Counter()
+
+        # Image preprocessing (downsize, re-encode, strip EXIF)
+        self.image_optimizer = ImagePayloadOptimizer(max_edge=self.config.max_image_edge,
+                                                     image_format=self.config.image_format,
+                                                     quality=self.config.image_quality)
+        self.load_image, self.payload_store = create_image_loader(self.image_optimizer,
+                                                                  store_dir=self.config.payload_store_dir,
+                                                                  max_size_mb=self.config.payload_store_max_size_mb)
+
+    def _create_model(self):
+        from langchain_openai import ChatOpenAI
+
+        credentials = {}
+        if self.config.api_base:
+            credentials["openai_api_base"] = self.config.api_base
+        if self.config.api_key:
+            credentials["openai_api_key"] = self.config.api_key
+        return ChatOpenAI(
+            model=self.config.model_name,
+            reasoning_effort=self.config.reasoning_effort,
+            verbosity=self.config.verbosity,
+            max_retries=0,
+            timeout=self.config.timeout,
+            **credentials
+        )
+
+    # ========== API Call Function with Retry ==========
+    async def get_model_response(self, messages):
+        """Call model through the retry policy, every attempt admitted by the rate limiter first"""
+        tokens = estimate_tokens(messages, self.config.completion_tokens)
+
+        async def attempt():
+            await self.limiter.acquire(tokens)
+            return await self.model.ainvoke(messages, config=self.invoke_config)
 
-# ========== Process Answers ==========
-def process_answers(messages, idx, total, image_path):
-    """Process model response and get two answers"""
-    try:
-        response_content = get_model_response(messages)
-
-        # Check if response is empty
-        if not response_content or response_content.strip() == "":
-            return "No response generated", "No response generated"
-
-        # Try to parse response
         try:
-            parsed = output_parser.parse(response_content)
-            answer1 = str(parsed.get("answer1", ""))
-            answer2 = str(parsed.get("answer2", ""))
-            return answer1, answer2
+            response = await self.retry_policy.acall(attempt)
+            return str(response.content) if response.content else ""
         except Exception as e:
-            # If standard parsing fails, use repair function
-            repaired_json = extract_and_fix_json(response_content)
-            return repaired_json["answer1"], repaired_json["answer2"]
-    except Exception as e:
-        error_msg = f"API call failed: {str(e)}"
-        print(f"[ERROR] [{idx}/{total}] {error_msg}")
-        return error_msg, error_msg
-
+            print(f"API call failed: {str(e)}")
+            raise
 
-# ========== Main Processing Flow ==========
-def main():
-    # Parse command-line arguments
-    parser = argparse.ArgumentParser(description="Generate dual-answer VQA for knowledge QA")
-    parser.add_argument("--input", type=str, required=True, help="Input JSON file path")
-    parser.add_argument("--output", type=str, required=True, help="Output JSON file path")
-    parser.add_argument("--model", type=str, default="gpt-4", help="Model name to use (default: gpt-4)")
-    args = parser.parse_args()
-
-    input_json = args.input
-    output_json = args.output
-    model_name = args.model
-
-    # Update model configuration
-    global model
-    model = ChatOpenAI(
-        model=model_name,
-        reasoning_effort="medium",
-        verbosity="medium",
-        max_retries=2,
-        timeout=30,
-    )
-
-    # Read JSON
-    try:
-        with open(input_json, "r", encoding="utf-8") as f:
-            data = json.load(f)
-    except Exception as e:
-        print(f"[ERROR] Failed to read input file: {e}")
-        return
-
-    results = []
-    total = len(data)
-
-    for idx, entry in enumerate(data, start=1):
-        if "image" not in entry or "question" not in entry or "image_caption" not in entry:
+    # ========== Process Answers ==========
+    async def process_answers(self, messages, idx, total, image_path):
+        """Process model response and get two answers"""
+        try:
+            response_content = await self.get_model_response(messages)
+
+            # Check if response is empty
+            if not response_content or response_content.strip() == "":
+                return "No response generated", "No response generated"
+
+            # Try to parse response
+            try:
+                parsed = self.output_parser.parse(response_content)
+                answer1 = str(parsed.get("answer1", ""))
+                answer2 = str(parsed.get("answer2", ""))
+                return answer1, answer2
+            except Exception as e:
+                # If standard parsing fails, use repair function
+                repaired_json = extract_and_fix_json(response_content)
+                return repaired_json["answer1"], repaired_json["answer2"]
+        except Exception as e:
+            error_msg = f"API call failed: {str(e)}"
+            print(f"[ERROR] [{idx}/{total}] {error_msg}")
+            return error_msg, error_msg
+
+    # ========== Message Helpers ==========
+    def build_messages(self, image_caption, question, payload):
+        """Return (prompt variant, messages): byte-identical few-shot prefix + the question with the encoded image
+        (text only when payload is None)"""
+        from langchain_core.messages import HumanMessage
+
+        suffix = self.prompt_prefix.suffix(image_caption=image_caption, question=question)
+        if payload is None:
+            return self.prompt_budget.fit(suffix)
+        return self.prompt_budget.fit(HumanMessage(
+            content=[
+                {"type": "text", "text": str(suffix.content)},
+                {"type": "image_url", "image_url": {"url": data_uri(payload)}}
+            ]
+        ))
+
+    def uses_image(self, entry):
+        """Whether the record is sent with its image under the configured modality"""
+        if self.config.modality != "auto":
+            return self.config.modality == "image"
+        return image_reason(entry, self.config.min_caption_words, self.config.min_caption_rating) is not None
+
+    def count_modality(self, entry):
+        if not self.uses_image(entry):
+            self.modality_stats["text"] += 1
+            return
+        self.modality_stats["image"] += 1
+        if self.config.modality == "auto":
+            self.modality_stats[image_reason(entry, self.config.min_caption_words, self.config.min_caption_rating)] += 1
+
+    def modality_summary(self):
+        stats = self.modality_stats
+        sent = stats["text"] + stats["image"]
+        reasons = ", ".join(f"{reason} {stats[reason]}" for reason in ("no caption", "short caption",
+                                                                        "flagged by caption judge") if stats[reason])
+        return (f"{stats['text']} text-only, {stats['image']} with image{f' ({reasons})' if reasons else ''}; "
+                f"image upload avoided for {stats['text'] / sent * 100 if sent else 0.0:.1f}% of requests")
+
+    # ========== Answering ==========
+    async def answer_record(self, entry, prefetched, idx, total):
+        """Answer one record and return the record to write"""
+        if not has_required_fields(entry):
             # Keep original entry but add answer fields
             entry["generation_answer1"] = "Missing required fields"
             entry["generation_answer2"] = "Missing required fields"
-            results.append(entry)
             print(f"[WARNING] [{idx}/{total}] Skipped, missing required fields")
-            continue
+            return entry
 
         image_path = entry["image"]
         question = str(entry["question"])
         image_caption = str(entry["image_caption"])
+        self.count_modality(entry)
 
-        # Read local image and convert to base64
-        try:
-            with open(image_path, "rb") as f:
-                image_data = base64.b64encode(f.read()).decode("utf-8")
-        except Exception as e:
-            error_msg = f"Failed to read image {image_path}: {e}"
+        # Image was read, optimized and base64-encoded ahead of time by the prefetcher
+        payload, load_error = prefetched if self.uses_image(entry) else (None, None)
+        if load_error is not None:
+            error_msg = f"Failed to read image {image_path}: {load_error}"
             print(f"[ERROR] [{idx}/{total}] {error_msg}")
             entry["generation_answer1"] = error_msg
             entry["generation_answer2"] = error_msg
-            results.append(entry)
-            continue
+            return entry
 
-        # Build text messages (using few-shot version)
+        # Build the per-record message (the few-shot prefix is precompiled)
         try:
-            text_messages = chat_prompt.format_messages(
-                image_caption=image_caption,
-                question=question,
-                format_instructions=format_instructions
-            )
+            prompt_variant, messages = self.build_messages(image_caption, question, payload)
         except Exception as e:
             error_msg = f"Failed to build prompt: {e}"
             print(f"[ERROR] [{idx}/{total}] {error_msg}")
             entry["generation_answer1"] = error_msg
             entry["generation_answer2"] = error_msg
-            results.append(entry)
-            continue
-
-        # Build final messages (add image)
-        messages = []
-        for msg in text_messages:
-            if isinstance(msg, HumanMessage):
-                # For human messages, add image
-                messages.append(HumanMessage(
-                    content=[
-                        {"type": "text", "text": str(msg.content)},
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_data}"}}
-                    ]
-                ))
-            else:
-                messages.append(msg)
+            return entry
 
         # Call API to get two answers
-        answer1, answer2 = process_answers(messages, idx, total, image_path)
-
-        # Keep original fields unchanged, add two answer fields
-        new_entry = OrderedDict(entry)
-        new_entry["generation_answer1"] = answer1
-        new_entry["generation_answer2"] = answer2
-        results.append(new_entry)
-
-        print(f"[SUCCESS] [{idx}/{total}] {os.path.basename(image_path)}")
+        answer1, answer2 = await self.process_answers(messages, idx, total, image_path)
+        self.report_answers(idx, total, image_path, payload, answer1, answer2)
+        return with_answers(entry, answer1, answer2, prompt_variant if self.prompt_budget.enabled else None)
+
+    @staticmethod
+    def report_answers(idx, total, image_path, payload, answer1, answer2):
+        image_note = f"image {describe_savings(payload)}" if payload is not None else "text only"
+        print(f"[SUCCESS] [{idx}/{total}] {os.path.basename(image_path)} ({image_note})")
         if answer1:
             print(f"   Answer 1: {answer1[:80]}{'...' if len(answer1) > 80 else ''}")
         if answer2:
             print(f"   Answer 2: {answer2[:80]}{'...' if len(answer2) > 80 else ''}")
 
-    # ========== Save Final Results ==========
-    try:
-        with open(output_json, "w", encoding="utf-8") as f:
-            json.dump(results, f, ensure_ascii=False, indent=2)
-        print(f"[SUCCESS] Generated {output_json}, processed {len(results)}  records")
-    except Exception as e:
-        print(f"[ERROR] Failed to save results: {e}")
+    # ========== Concurrent Answering Engine ==========
+    async def answer_entries(self, data, resumed, results, sink):
+        """Answer all records with at most `concurrency` requests in flight, storing records by input position"""
+        total = len(data)
+        semaphore = asyncio.Semaphore(max(1, self.config.concurrency))
+
+        async def run_entry(position, prefetched):
+            try:
+                record = await self.answer_record(data[position], prefetched, position + 1, total)
+            finally:
+                semaphore.release()
+            store_result(results, sink, position, record)
+
+        # Images for the next records are read and encoded in the background while requests are in flight
+        image_paths = [
+            entry["image"] if has_required_fields(entry) and question_key(entry, position) not in resumed
+            and self.uses_image(entry) else None
+            for position, entry in enumerate(data)
+        ]
+
+        tasks = []
+        with ImagePrefetcher(self.load_image, image_paths,
+                             lookahead=max(self.config.prefetch, self.config.concurrency)) as prefetcher:
+            for position, entry in enumerate(data):
+                key = question_key(entry, position)
+                if key in resumed:
+                    await prefetcher.next_async()
+                    store_result(results, sink, position, resumed[key])
+                    continue
+                await semaphore.acquire()
+                prefetched = await prefetcher.next_async()
+                tasks.append(asyncio.ensure_future(run_entry(position, prefetched)))
+            await asyncio.gather(*tasks)
+        return prefetcher
+
+    # ========== Main Processing Flow ==========
+    async def arun(self, input_json, output_json):
+        """Generate two answers for every record in input_json and write them to output_json"""
+        # Read JSON
+        try:
+            with open(input_json, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"[ERROR] Failed to read input file: {e}")
+            return None
+
+        # Index answers from an interrupted run by question_id (input position, image and question without one)
+        checkpoint_path = f"{output_json}.partial.jsonl"
+        resumed = {}
+        if self.config.resume:
+            resumed = load_keyed_for_resume(checkpoint_path, is_failed_answer, output_json)
+            print(f"[RESUME] Reusing answers for {len(resumed)} records from the previous run")
+
+        # Every finished record is appended to the checkpoint file as soon as every earlier record is done
+        start_time = time.time()
+        results = [None] * len(data)
+        with JsonlSink(checkpoint_path) as sink:
+            prefetcher = await self.answer_entries(data, resumed, results, sink)
+        total_time = time.time() - start_time
+
+        # ========== Save Final Results ==========
+        try:
+            with open(output_json, "w", encoding="utf-8") as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+            os.remove(checkpoint_path)
+            finish_resume(checkpoint_path)
+            print(f"[SUCCESS] Generated {output_json}, processed {len(results)}  records")
+        except Exception as e:
+            print(f"[ERROR] Failed to save results: {e}")
+
+        throughput = len(results) / total_time if total_time > 0 else 0
+        print(f"[THROUGHPUT] {throughput:.2f} records/sec in {total_time:.2f} seconds with concurrency {self.config.concurrency}")
+        print(f"[TOKENS] {self.usage_tracker.summary()}")
+        if self.limiter.enabled:
+            print(f"[RATE] {self.limiter.summary()}")
+        print(f"[RETRY] {self.retry_policy.summary()}")
+        if self.config.usage_report:
+            stages = {"knowledge_qa": (self.usage_tracker, len(results) - count_resumed(data, resumed))}
+            write_usage_report(self.config.usage_report, stages, self.retry_policy)
+            print(f"[USAGE] Per-stage tokens, latency and cost written to {self.config.usage_report}")
+        if self.prompt_budget.enabled:
+            print(f"[PROMPT] {self.prompt_budget.summary()}")
+        print(f"[PREFETCH] {prefetcher.summary()}")
+        print(f"[MODALITY] {self.modality_summary()}")
+
+        image_stats = self.image_optimizer.stats()
+        print(f"[IMAGE] {image_stats['images']} images, {image_stats['original_bytes']} -> {image_stats['payload_bytes']} bytes "
+              f"(saved {image_stats['saved_ratio'] * 100:.1f}%)")
+        if self.payload_store is not None:
+            self.payload_store.evict()
+            print(f"[STORE] {self.payload_store.summary()}")
+        return results
+
+    def run(self, input_json, output_json):
+        """Synchronous wrapper around arun()"""
+        return asyncio.run(self.arun(input_json, output_json))
+
+
+# ========== Task Profile ==========
+TASK_PROFILE = register_task(TaskProfile(
+    name="knowledge_qa",
+    description="Knowledge QA: treatment and control, and disease explanation answers",
+    answer_fields=answer_fields,
+    system_template=system_template,
+    human_template=human_template,
+    examples=examples,
+    reasoning_effort=VQAConfig.reasoning_effort,
+    verbosity=VQAConfig.verbosity,
+    generator_class=DualAnswerGenerator,
+    config_class=VQAConfig,
+))
+
+
+# ========== Command Line Interface ==========
+def main(argv=None):
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser(description="Generate dual-answer VQA for knowledge QA")
+    parser.add_argument("--input", type=str, required=True, help="Input JSON file path")
+    parser.add_argument("--output", type=str, required=True, help="Output JSON file path")
+    parser.add_argument("--model", type=str, default="gpt-4", help="Model name to use (default: gpt-4)")
+    add_image_arguments(parser)
+    parser.add_argument("--prefetch", type=int, default=4,
+                        help="Number of images read and encoded ahead of the current request (default: 4)")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="Maximum number of requests in flight (default: 1)")
+    parser.add_argument("--rpm", type=float, default=None,
+                        help="Requests-per-minute quota to stay within (default: unlimited)")
+    parser.add_argument("--tpm", type=float, default=None,
+                        help="Tokens-per-minute quota to stay within, image tokens included (default: unlimited)")
+    parser.add_argument("--max-prompt-tokens", type=int, default=None,
+                        help="Per-record prompt token cap: drop few-shot examples, then fall back to zero-shot, "
+                             "to fit (default: always the full few-shot prompt)")
+    add_retry_arguments(parser)
+    add_usage_arguments(parser)
+    parser.add_argument("--modality", type=str, default="image", choices=MODALITIES,
+                        help="Send the image with every question (image), never (text), or only when the caption is "
+                             "missing, short or flagged by the caption judge (auto). Default: image")
+    parser.add_argument("--min-caption-words", type=int, default=20,
+                        help="auto: captions with fewer words get the image (default: 20)")
+    parser.add_argument("--min-caption-rating", type=int, default=8,
+                        help="auto: captions rated below this and not rewritten get the image (default: 8)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Reuse answers from a previous partial run and only process missing or failed records")
+    args = parser.parse_args(argv)
+
+    os.environ["OPENAI_API_BASE"] = API_BASE
+    os.environ["OPENAI_API_KEY"] = API_KEY
+
+    config = VQAConfig(
+        model_name=args.model,
+        prefetch=args.prefetch,
+        concurrency=args.concurrency,
+        requests_per_minute=args.rpm,
+        tokens_per_minute=args.tpm,
+        max_prompt_tokens=args.max_prompt_tokens,
+        prices=prices_from_args(args),
+        usage_report=args.usage_report,
+        max_retries=args.max_retries,
+        retry_budget=args.retry_budget,
+        breaker_error_rate=args.breaker_error_rate,
+        breaker_cooldown=args.breaker_cooldown,
+        max_image_edge=args.max_image_edge,
+        image_format=args.image_format,
+        image_quality=args.image_quality,
+        payload_store_dir=args.payload_store,
+        payload_store_max_size_mb=args.payload_store_max_size_mb,
+        modality=args.modality,
+        min_caption_words=args.min_caption_words,
+        min_caption_rating=args.min_caption_rating,
+        resume=args.resume,
+    )
+    DualAnswerGenerator(config).run(args.input, args.output)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,286 @@
+# coding: utf-8
+"""
+Multi-task VQA Runner
+Runs several step 2 tasks (disease diagnosis, knowledge QA) over one pass of the input. Every image is read and
+encoded once for all tasks, all requests share one HTTP client and one rate limiter, and each task writes its
+own output file.
+
+Usage:
+    python vqa_runner.py --input input.json --output-dir outputs/
+    python vqa_runner.py --input input.json --output-dir outputs/ --tasks diagnosis --concurrency 8 --rpm 500
+
+Library usage (importing this module has no side effects; LangChain is imported lazily):
+    from vqa_runner import MultiTaskRunner, RunnerConfig
+    runner = MultiTaskRunner(RunnerConfig(tasks=("diagnosis", "knowledge_qa")))
+    runner.run("input.json", "outputs/")
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from cpj_common.image_payload import ImagePayloadOptimizer, add_image_arguments
+from cpj_common.jsonl_sink import JsonlSink
+from cpj_common.payload_store import create_image_loader
+from cpj_common.prefetch import ImagePrefetcher
+from cpj_common.rate_limit import RateLimiter
+from cpj_common.resume import count_resumed, finish_resume, load_keyed_for_resume, question_key
+from cpj_common.retry_policy import add_retry_arguments, retry_policy_from_config
+from cpj_common.task_profiles import TASK_PROFILES, get_task
+from cpj_common.usage import add_usage_arguments, prices_from_args, write_usage_report
+
+# Importing the task scripts registers their profiles; the record format is the same for every task
+from diagnosis_vqa import has_required_fields, is_failed_answer, store_result
+import knowledge_qa_vqa  # noqa: F401
+
+# ========== API Configuration ==========
+API_BASE = "YOUR_API_BASE_URL"
+API_KEY = "YOUR_API_KEY"
+
+
+@dataclass
+class RunnerConfig:
+    """Settings for MultiTaskRunner; model and image settings are shared by all tasks"""
+    tasks: Tuple[str, ...] = ("diagnosis", "knowledge_qa")
+    model_name: str = "gpt-4"
+    max_retries: int = 2               # Retries per call, made by the shared retry policy
+    retry_budget: float = 0.2
+    breaker_error_rate: float = 0.5
+    breaker_cooldown: float = 30
+    timeout: float = 30
+    api_base: Optional[str] = None     # Defaults to the OPENAI_API_BASE environment variable
+    api_key: Optional[str] = None      # Defaults to the OPENAI_API_KEY environment variable
+    prefetch: int = 4
+    concurrency: int = 1               # Requests in flight over all tasks
+    requests_per_minute: Optional[float] = None
+    tokens_per_minute: Optional[float] = None
+    max_prompt_tokens: Optional[int] = None  # Per-record prompt cap of every task, None sends the full prompts
+    max_image_edge: int = 1536
+    image_format: str = "jpeg"
+    image_quality: int = 85
+    payload_store_dir: Optional[str] = None
+    payload_store_max_size_mb: float = 2048
+    prices: Optional[Tuple[float, float, float]] = None  # USD per 1M prompt/cached/completion tokens
+    usage_report: Optional[str] = None  # Path of the per-task usage summary JSON, None disables
+    resume: bool = False
+
+
+# ========== Multi-task Runner ==========
+class MultiTaskRunner:
+    """Answers every record once per task, sharing image loading, the HTTP client and the rate limiter"""
+
+    def __init__(self, config=None, model=None):
+        self.config = config or RunnerConfig()
+        self.profiles = [get_task(name) for name in dict.fromkeys(self.config.tasks)]
+        self.model = model if model is not None else self._create_model()
+        self.limiter = RateLimiter(self.config.requests_per_minute, self.config.tokens_per_minute)
+        self.retry_policy = retry_policy_from_config(self.config)
+
+        # One image pipeline for all tasks
+        self.image_optimizer = ImagePayloadOptimizer(max_edge=self.config.max_image_edge,
+                                                     image_format=self.config.image_format,
+                                                     quality=self.config.image_quality)
+        self.load_image, self.payload_store = create_image_loader(self.image_optimizer,
+                                                                  store_dir=self.config.payload_store_dir,
+                                                                  max_size_mb=self.config.payload_store_max_size_mb)
+
+        # Each task keeps its prompts, parser and token counts; its model is the shared client with the task's settings
+        self.generators = {}
+        for profile in self.profiles:
+            task_config = profile.config_class(model_name=self.config.model_name,
+                                               reasoning_effort=profile.reasoning_effort,
+                                               verbosity=profile.verbosity,
+                                               max_prompt_tokens=self.config.max_prompt_tokens,
+                                               prices=self.config.prices)
+            task_model = self.model.bind(reasoning_effort=profile.reasoning_effort, verbosity=profile.verbosity)
+            generator = profile.generator_class(task_config, model=task_model)
+            generator.limiter = self.limiter
+            generator.retry_policy = self.retry_policy
+            self.generators[profile.name] = generator
+
+    def _create_model(self):
+        from langchain_openai import ChatOpenAI
+
+        credentials = {}
+        if self.config.api_base:
+            credentials["openai_api_base"] = self.config.api_base
+        if self.config.api_key:
+            credentials["openai_api_key"] = self.config.api_key
+        return ChatOpenAI(
+            model=self.config.model_name,
+            max_retries=0,
+            timeout=self.config.timeout,
+            **credentials
+        )
+
+    # ========== Concurrent Answering Engine ==========
+    async def answer_all(self, data, tasks):
+        """Answer every record for every task with at most `concurrency` requests in flight"""
+        total = len(data)
+        semaphore = asyncio.Semaphore(max(1, self.config.concurrency))
+
+        async def run_task(task, position, entry, prefetched):
+            try:
+                # Each task gets its own copy, error paths write into the entry
+                record = await self.generators[task["name"]].answer_record(dict(entry), prefetched, position + 1, total)
+            finally:
+                semaphore.release()
+            store_result(task["results"], task["sink"], position, record)
+
+        # A record's image is loaded once if at least one task still has to answer it
+        image_paths = [
+            entry["image"] if has_required_fields(entry) and any(
+                question_key(entry, position) not in task["resumed"] for task in tasks) else None
+            for position, entry in enumerate(data)
+        ]
+
+        pending = []
+        with ImagePrefetcher(self.load_image, image_paths,
+                             lookahead=max(self.config.prefetch, self.config.concurrency)) as prefetcher:
+            for position, entry in enumerate(data):
+                prefetched = await prefetcher.next_async()
+                key = question_key(entry, position)
+                for task in tasks:
+                    if key in task["resumed"]:
+                        store_result(task["results"], task["sink"], position, task["resumed"][key])
+                        continue
+                    await semaphore.acquire()
+                    pending.append(asyncio.ensure_future(run_task(task, position, entry, prefetched)))
+            await asyncio.gather(*pending)
+        return prefetcher
+
+    # ========== Main Processing Flow ==========
+    async def arun(self, input_json, output_dir):
+        """Run every task over input_json and write <output_dir>/<task>_vqa.json per task"""
+        try:
+            with open(input_json, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"[ERROR] Failed to read input file: {e}")
+            return None
+
+        tasks = []
+        for profile in self.profiles:
+            output_json = os.path.join(output_dir, profile.output_name)
+            checkpoint_path = f"{output_json}.partial.jsonl"
+            resumed = {}
+            if self.config.resume:
+                resumed = load_keyed_for_resume(checkpoint_path, is_failed_answer, output_json)
+                print(f"[RESUME] {profile.name}: reusing answers for {len(resumed)} records from the previous run")
+            tasks.append({"name": profile.name, "output": output_json, "checkpoint": checkpoint_path,
+                          "resumed": resumed, "results": [None] * len(data), "sink": JsonlSink(checkpoint_path)})
+
+        start_time = time.time()
+        try:
+            prefetcher = await self.answer_all(data, tasks)
+        finally:
+            for task in tasks:
+                task["sink"].close()
+        total_time = time.time() - start_time
+
+        # ========== Save Final Results ==========
+        for task in tasks:
+            try:
+                with open(task["output"], "w", encoding="utf-8") as f:
+                    json.dump(task["results"], f, ensure_ascii=False, indent=2)
+                os.remove(task["checkpoint"])
+                finish_resume(task["checkpoint"])
+                print(f"[SUCCESS] {task['name']}: generated {task['output']}, processed {len(task['results'])} records")
+            except Exception as e:
+                print(f"[ERROR] {task['name']}: failed to save results: {e}")
+
+        requests = sum(len(task["results"]) - count_resumed(data, task["resumed"]) for task in tasks)
+        throughput = requests / total_time if total_time > 0 else 0
+        print(f"[THROUGHPUT] {throughput:.2f} answered records/sec over {len(tasks)} tasks in {total_time:.2f} seconds "
+              f"with concurrency {self.config.concurrency}")
+        for task in tasks:
+            print(f"[TOKENS] {task['name']}: {self.generators[task['name']].usage_tracker.summary()}")
+        if self.limiter.enabled:
+            print(f"[RATE] {self.limiter.summary()}")
+        print(f"[RETRY] {self.retry_policy.summary()}")
+        if self.config.usage_report:
+            stages = {task["name"]: (self.generators[task["name"]].usage_tracker,
+                                     len(task["results"]) - count_resumed(data, task["resumed"])) for task in tasks}
+            write_usage_report(self.config.usage_report, stages, self.retry_policy)
+            print(f"[USAGE] Per-task tokens, latency and cost written to {self.config.usage_report}")
+        if self.config.max_prompt_tokens:
+            for task in tasks:
+                print(f"[PROMPT] {task['name']}: {self.generators[task['name']].prompt_budget.summary()}")
+        print(f"[PREFETCH] {prefetcher.summary()}")
+
+        image_stats = self.image_optimizer.stats()
+        print(f"[IMAGE] {image_stats['images']} images loaded once for {len(tasks)} tasks, "
+              f"{image_stats['original_bytes']} -> {image_stats['payload_bytes']} bytes "
+              f"(saved {image_stats['saved_ratio'] * 100:.1f}%)")
+        if self.payload_store is not None:
+            self.payload_store.evict()
+            print(f"[STORE] {self.payload_store.summary()}")
+        return {task["name"]: task["results"] for task in tasks}
+
+    def run(self, input_json, output_dir):
+        """Synchronous wrapper around arun()"""
+        return asyncio.run(self.arun(input_json, output_dir))
+
+
+# ========== Command Line Interface ==========
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run several step 2 VQA tasks over one pass of the input")
+    parser.add_argument("--input", type=str, required=True, help="Input JSON file path")
+    parser.add_argument("--output-dir", type=str, default=".",
+                        help="Directory of the per-task outputs, <task>_vqa.json (default: current directory)")
+    parser.add_argument("--tasks", type=str, nargs="+", default=list(TASK_PROFILES), choices=sorted(TASK_PROFILES),
+                        help="Tasks to run (default: all registered tasks)")
+    parser.add_argument("--model", type=str, default="gpt-4", help="Model name to use (default: gpt-4)")
+    add_image_arguments(parser)
+    parser.add_argument("--prefetch", type=int, default=4,
+                        help="Number of images read and encoded ahead of the current request (default: 4)")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="Maximum number of requests in flight over all tasks (default: 1)")
+    parser.add_argument("--rpm", type=float, default=None,
+                        help="Requests-per-minute quota to stay within (default: unlimited)")
+    parser.add_argument("--tpm", type=float, default=None,
+                        help="Tokens-per-minute quota to stay within, image tokens included (default: unlimited)")
+    parser.add_argument("--max-prompt-tokens", type=int, default=None,
+                        help="Per-record prompt token cap of every task: drop few-shot examples, then fall back to "
+                             "zero-shot, to fit (default: always the full few-shot prompts)")
+    add_retry_arguments(parser)
+    add_usage_arguments(parser)
+    parser.add_argument("--resume", action="store_true",
+                        help="Reuse answers from a previous partial run and only process missing or failed records")
+    args = parser.parse_args(argv)
+
+    os.environ["OPENAI_API_BASE"] = API_BASE
+    os.environ["OPENAI_API_KEY"] = API_KEY
+
+    config = RunnerConfig(
+        tasks=tuple(args.tasks),
+        model_name=args.model,
+        prefetch=args.prefetch,
+        concurrency=args.concurrency,
+        requests_per_minute=args.rpm,
+        tokens_per_minute=args.tpm,
+        max_prompt_tokens=args.max_prompt_tokens,
+        prices=prices_from_args(args),
+        usage_report=args.usage_report,
+        max_retries=args.max_retries,
+        retry_budget=args.retry_budget,
+        breaker_error_rate=args.breaker_error_rate,
+        breaker_cooldown=args.breaker_cooldown,
+        max_image_edge=args.max_image_edge,
+        image_format=args.image_format,
+        image_quality=args.image_quality,
+        payload_store_dir=args.payload_store,
+        payload_store_max_size_mb=args.payload_store_max_size_mb,
+        resume=args.resume,
+    )
+    os.makedirs(args.output_dir, exist_ok=True)
+    MultiTaskRunner(config).run(args.input, args.output_dir)
+
+
+if __name__ == "__main__":
+    main()
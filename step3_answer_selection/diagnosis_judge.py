@@ -1,25 +1,54 @@
+"""
+Disease Diagnosis Answer Selection Script
+Judges the two generated answers of each record and keeps the better one.
+
+Usage:
+    python diagnosis_judge.py --input answers.json --output selected.json --evaluation-output evaluation.json
+    python diagnosis_judge.py --input answers.json --output selected.json --pre-judge --pre-judge-threshold 0.9
+
+Library usage (importing this module has no side effects; LangChain is imported lazily):
+    from diagnosis_judge import AnswerJudge, JudgeConfig
+    judge = AnswerJudge(JudgeConfig(model_name="gpt-4"))
+    judge.run("answers.json", "selected.json", "evaluation.json")
+"""
 import json
 import time
 import re
 import os
+import sys
 import argparse
-import aiohttp
 import asyncio
-from tqdm import tqdm
-from tenacity import retry, stop_after_attempt, wait_exponential
-from langchain_openai import ChatOpenAI
-from langchain.chains import LLMChain
-from langchain.prompts.chat import (
-    ChatPromptTemplate,
-    SystemMessagePromptTemplate,
-    HumanMessagePromptTemplate,
-)
-from langchain.schema import HumanMessage, AIMessage
-from langchain_core.output_parsers import StrOutputParser
-
-# Set environment variables
-os.environ["OPENAI_API_BASE"] = "YOUR_API_BASE_URL"
-os.environ["OPENAI_API_KEY"] = "YOUR_API_KEY"
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from cpj_common.jsonl_sink import JsonlSink
+from cpj_common.pre_judge import PreJudge
+from cpj_common.resume import count_resumed, finish_resume, load_for_resume, question_key, read_records
+from cpj_common.retry_policy import add_retry_arguments, retry_policy_from_config
+from cpj_common.usage import add_usage_arguments, prices_from_args, write_usage_report
+
+# API credentials, exported by main()
+API_BASE = "YOUR_API_BASE_URL"
+API_KEY = "YOUR_API_KEY"
+
+
+@dataclass
+class JudgeConfig:
+    """Settings for AnswerJudge"""
+    model_name: str = "gpt-4"
+    temperature: float = 0
+    api_base: Optional[str] = None     # Defaults to the OPENAI_API_BASE environment variable
+    api_key: Optional[str] = None      # Defaults to the OPENAI_API_KEY environment variable
+    batch_size: int = 5
+    max_retries: int = 2               # Retries per call, made by the retry policy (the client itself does not retry)
+    retry_budget: float = 0.2          # Retries allowed per call over the whole run
+    breaker_error_rate: float = 0.5    # Error rate over recent calls that pauses dispatch, 0 disables
+    breaker_cooldown: float = 30
+    pre_judge_threshold: Optional[float] = None  # Similarity at which answer 1 is selected without a judge call, None disables
+    prices: Optional[Tuple[float, float, float]] = None  # USD per 1M prompt/cached/completion tokens
+    usage_report: Optional[str] = None  # Path of the usage summary JSON, None disables
+    resume: bool = False
 
 # System prompt template
 system_template = """You are an agricultural expert evaluating two answers to a question about plant disease diagnosis.
@@ -59,7 +88,6 @@ Provide your response in JSON format with the following structure:
   }}
 }}
 """
-system_message_prompt = SystemMessagePromptTemplate.from_template(system_template)
 
 # Few-shot examples
 examples = [
@@ -77,28 +105,38 @@ examples = [
     }
 ]
 
-# Build example messages
-example_messages = []
-for example in examples:
-    example_messages.append(HumanMessage(content=example["input"]))
-    example_messages.append(AIMessage(content=example["output"]))
-
 # Template for current evaluation input
 human_template = """Question: {question}
 Image Caption: {image_caption}
 Answer 1: {answer1}
 Answer 2: {answer2}"""
-human_message_prompt = HumanMessagePromptTemplate.from_template(human_template)
 
-# Build complete prompt
-chat_prompt = ChatPromptTemplate.from_messages(
-    [system_message_prompt] +
-    example_messages +
-    [human_message_prompt]
-)
 
-# ========== Chain variable will be initialized in main function ==========
-chain = None
+def build_prompt():
+    """Build the few-shot judging prompt (imports LangChain on first use)"""
+    from langchain.prompts.chat import (
+        ChatPromptTemplate,
+        SystemMessagePromptTemplate,
+        HumanMessagePromptTemplate,
+    )
+    from langchain.schema import HumanMessage, AIMessage
+
+    system_message_prompt = SystemMessagePromptTemplate.from_template(system_template)
+
+    # Build example messages
+    example_messages = []
+    for example in examples:
+        example_messages.append(HumanMessage(content=example["input"]))
+        example_messages.append(AIMessage(content=example["output"]))
+
+    human_message_prompt = HumanMessagePromptTemplate.from_template(human_template)
+
+    # Build complete prompt
+    return ChatPromptTemplate.from_messages(
+        [system_message_prompt] +
+        example_messages +
+        [human_message_prompt]
+    )
 
 
 def load_data(file_path):
@@ -107,20 +145,21 @@ def load_data(file_path):
         return json.load(file)
 
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-async def evaluate_answers_batch(batch_data):
-    """Batch evaluate answers"""
-    tasks = []
-    for data in batch_data:
-        task = chain.ainvoke({
-            "question": data["question"],
-            "image_caption": data["image_caption"],
-            "answer1": data["answer1"],
-            "answer2": data["answer2"]
-        })
-        tasks.append(task)
+def is_failed_judgment(record):
+    """Whether a checkpointed judgment came from a failed API call"""
+    return str(record["evaluation"].get("reason", "")).startswith("Error:")
+
 
-    return await asyncio.gather(*tasks, return_exceptions=True)
+def load_previous_judgments(output_file, evaluation_file):
+    """Pair a previous run's output and evaluation files into checkpoint-style records"""
+    items = read_records(output_file)
+    evaluations = read_records(evaluation_file)
+    if not items or len(items) != len(evaluations):
+        return []
+    return [
+        {"key": question_key(item, position), "item": item, "evaluation": evaluation}
+        for position, (item, evaluation) in enumerate(zip(items, evaluations))
+    ]
 
 
 def parse_evaluation_response(response):
@@ -151,7 +190,7 @@ def parse_evaluation_response(response):
         pass
 
     # Try to extract JSON part
-    choice_match = re.search(r'(?i)choice.*?[12]|(?i)select.*?[12]|[12](?=\D*$)', response)
+    choice_match = re.search(r'choice.*?[12]|select.*?[12]|[12](?=\D*$)', response, re.IGNORECASE)
     if choice_match:
         choice_text = choice_match.group()
         if '1' in choice_text:
@@ -163,98 +202,228 @@ def parse_evaluation_response(response):
     return 1, "Default selection - could not determine choice", 0, 0
 
 
-async def process_data_async(input_data, batch_size=5):
-    """Process data asynchronously and select best answer"""
-    processed_data = []
-    evaluation_results = []
-
-    # Prepare batch data
-    batched_data = []
-    for i, item in enumerate(input_data):
-        answer1 = item.get("generation_answer1", "")
-        answer2 = item.get("generation_answer2", "")
-
-        if isinstance(answer1, dict):
-            answer1 = json.dumps(answer1, ensure_ascii=False)
-        if isinstance(answer2, dict):
-            answer2 = json.dumps(answer2, ensure_ascii=False)
-
-        batched_data.append({
-            "index": i,
-            "question": item.get("question", ""),
-            "image_caption": item.get("image_caption", ""),
-            "answer1": answer1,
-            "answer2": answer2,
-            "original_item": item
-        })
-
-    # Process data
-    for i in tqdm(range(0, len(batched_data), batch_size), desc="Processing batches"):
-        batch = batched_data[i:i + batch_size]
-
-        responses = await evaluate_answers_batch(batch)
-
-        for j, response in enumerate(responses):
-            data_index = i + j
-            if data_index >= len(batched_data):
-                break
-
-            data = batched_data[data_index]
-            original_item = data["original_item"]
-
-            if isinstance(response, Exception):
-                print(f"API call error: {response}")
-                choice, reason, score1, score2 = 1, f"Error: {str(response)}", 0, 0
-            else:
-                choice, reason, score1, score2 = parse_evaluation_response(response)
-
-            # Record evaluation result
-            eval_result = {
-                "id": original_item.get("id", len(evaluation_results)),
-                "question": original_item.get("question", ""),
-                "choice": choice,
-                "reason": reason,
-                "answer1_score": score1,
-                "answer2_score": score2,
-                "answer1_preview": data["answer1"][:200] + "..." if len(data["answer1"]) > 200 else data["answer1"],
-                "answer2_preview": data["answer2"][:200] + "..." if len(data["answer2"]) > 200 else data["answer2"]
+class AnswerJudge:
+    """Few-shot LLM judge that picks the better of two answers per record"""
+
+    def __init__(self, config=None, chain=None):
+        from cpj_common.prompt_prefix import PromptPrefix
+        from cpj_common.usage_tracker import UsageTracker
+
+        self.config = config or JudgeConfig()
+
+        # Render the invariant system prompt + few-shot examples once; only the last message is built per record
+        self.prompt_prefix = PromptPrefix(build_prompt())
+
+        self.usage_tracker = UsageTracker(prices=self.config.prices)
+        self.invoke_config = {"callbacks": [self.usage_tracker]}
+        self.chain = chain if chain is not None else self._create_chain()
+        self.retry_policy = retry_policy_from_config(self.config)
+        self.pre_judge = PreJudge(self.config.pre_judge_threshold) if self.config.pre_judge_threshold else None
+
+    def _create_chain(self):
+        from langchain_openai import ChatOpenAI
+        from langchain_core.output_parsers import StrOutputParser
+
+        credentials = {}
+        if self.config.api_base:
+            credentials["openai_api_base"] = self.config.api_base
+        if self.config.api_key:
+            credentials["openai_api_key"] = self.config.api_key
+        return ChatOpenAI(model=self.config.model_name, temperature=self.config.temperature,
+                          max_retries=0, **credentials) | StrOutputParser()
+
+    async def evaluate_answers_batch(self, batch_data):
+        """Batch evaluate answers"""
+        tasks = []
+        for data in batch_data:
+            task = self.retry_policy.acall(self.chain.ainvoke, self.prompt_prefix.build(
+                question=data["question"],
+                image_caption=data["image_caption"],
+                answer1=data["answer1"],
+                answer2=data["answer2"]
+            ), config=self.invoke_config)
+            tasks.append(task)
+
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    @staticmethod
+    def build_judgment(data, choice, reason, score1, score2):
+        """Return (evaluation record, output item) for a judged or pre-judged answer pair"""
+        original_item = data["original_item"]
+        # Record evaluation result
+        eval_result = {
+            "id": original_item.get("id", data["index"]),
+            "question": original_item.get("question", ""),
+            "choice": choice,
+            "reason": reason,
+            "answer1_score": score1,
+            "answer2_score": score2,
+            "answer1_preview": data["answer1"][:200] + "..." if len(data["answer1"]) > 200 else data["answer1"],
+            "answer2_preview": data["answer2"][:200] + "..." if len(data["answer2"]) > 200 else data["answer2"]
+        }
+
+        # Create new item, keep original fields
+        new_item = original_item.copy()
+
+        # Set selected answer and score
+        if choice == 1:
+            new_item["generation_answer"] = data["answer1"]
+            new_item["selected_answer"] = "answer1"
+            new_item["selected_score"] = score1
+            new_item["unselected_score"] = score2
+        else:
+            new_item["generation_answer"] = data["answer2"]
+            new_item["selected_answer"] = "answer2"
+            new_item["selected_score"] = score2
+            new_item["unselected_score"] = score1
+
+        # Keep evaluation reason
+        new_item["evaluation_reason"] = reason
+
+        # Delete original two answer fields
+        if "generation_answer1" in new_item:
+            del new_item["generation_answer1"]
+        if "generation_answer2" in new_item:
+            del new_item["generation_answer2"]
+        return eval_result, new_item
+
+    async def process_data_async(self, input_data, batch_size=None, sink=None, resumed=None):
+        """Process data asynchronously and select best answer"""
+        from tqdm import tqdm
+
+        batch_size = batch_size or self.config.batch_size
+        resumed = resumed or {}
+        processed_data = [None] * len(input_data)
+        evaluation_results = [None] * len(input_data)
+
+        # Prepare batch data
+        batched_data = []
+        for i, item in enumerate(input_data):
+            key = question_key(item, i)
+            if key in resumed:
+                # Already judged by a previous run
+                processed_data[i] = resumed[key]["item"]
+                evaluation_results[i] = resumed[key]["evaluation"]
+                continue
+
+            answer1 = item.get("generation_answer1", "")
+            answer2 = item.get("generation_answer2", "")
+
+            if isinstance(answer1, dict):
+                answer1 = json.dumps(answer1, ensure_ascii=False)
+            if isinstance(answer2, dict):
+                answer2 = json.dumps(answer2, ensure_ascii=False)
+
+            data = {
+                "index": i,
+                "key": key,
+                "question": item.get("question", ""),
+                "image_caption": item.get("image_caption", ""),
+                "answer1": answer1,
+                "answer2": answer2,
+                "original_item": item
             }
-            evaluation_results.append(eval_result)
-
-            # Create new item, keep original fields
-            new_item = original_item.copy()
-
-            # Set selected answer and score
-            if choice == 1:
-                new_item["generation_answer"] = data["answer1"]
-                new_item["selected_answer"] = "answer1"
-                new_item["selected_score"] = score1
-                new_item["unselected_score"] = score2
-            else:
-                new_item["generation_answer"] = data["answer2"]
-                new_item["selected_answer"] = "answer2"
-                new_item["selected_score"] = score2
-                new_item["unselected_score"] = score1
-
-            # Keep evaluation reason
-            new_item["evaluation_reason"] = reason
 
-            # Delete original two answer fields
-            if "generation_answer1" in new_item:
-                del new_item["generation_answer1"]
-            if "generation_answer2" in new_item:
-                del new_item["generation_answer2"]
-
-            processed_data.append(new_item)
-
-        # Add delay between batches to avoid API limits
-        await asyncio.sleep(1)
-
-    return processed_data, evaluation_results
+            # Identical or near-identical answers are settled locally, without a judge call
+            similarity = self.pre_judge.check(answer1, answer2) if self.pre_judge is not None else None
+            if similarity is not None:
+                eval_result, new_item = self.build_judgment(data, 1, PreJudge.reason(similarity), 0, 0)
+                eval_result["auto_selected"] = True
+                eval_result["similarity"] = round(similarity, 4)
+                evaluation_results[i] = eval_result
+                processed_data[i] = new_item
+                if sink is not None:
+                    sink.write({"key": key, "item": new_item, "evaluation": eval_result})
+                continue
+
+            batched_data.append(data)
+
+        # Process data
+        for i in tqdm(range(0, len(batched_data), batch_size), desc="Processing batches"):
+            batch = batched_data[i:i + batch_size]
+
+            responses = await self.evaluate_answers_batch(batch)
+
+            for j, response in enumerate(responses):
+                data_index = i + j
+                if data_index >= len(batched_data):
+                    break
+
+                data = batched_data[data_index]
+
+                if isinstance(response, Exception):
+                    print(f"API call error: {response}")
+                    choice, reason, score1, score2 = 1, f"Error: {str(response)}", 0, 0
+                else:
+                    choice, reason, score1, score2 = parse_evaluation_response(response)
+
+                eval_result, new_item = self.build_judgment(data, choice, reason, score1, score2)
+                evaluation_results[data["index"]] = eval_result
+                processed_data[data["index"]] = new_item
+                if sink is not None:
+                    sink.write({"key": data["key"], "item": new_item, "evaluation": eval_result})
+
+            # Add delay between batches to avoid API limits
+            await asyncio.sleep(1)
+
+        return processed_data, evaluation_results
+
+    async def arun(self, input_file, output_file, evaluation_file="evaluation_results.json"):
+        """Judge every record of input_file, writing selected answers and evaluation details"""
+        # Load data
+        data = load_data(input_file)
+
+        # Index judgments from an interrupted run by question_id
+        checkpoint_path = f"{output_file}.partial.jsonl"
+        resumed = {}
+        if self.config.resume:
+            resumed = load_for_resume(checkpoint_path, lambda r: r.get("key"), is_failed_judgment,
+                                      records=load_previous_judgments(output_file, evaluation_file))
+            print(f"Reusing judgments for {len(resumed)} records from the previous run")
+
+        # Process data asynchronously, appending every judgment to the checkpoint file
+        with JsonlSink(checkpoint_path) as sink:
+            processed_data, evaluation_results = await self.process_data_async(data, sink=sink, resumed=resumed)
+
+        # Save results
+        with open(output_file, 'w', encoding='utf-8') as f:
+            json.dump(processed_data, f, indent=4, ensure_ascii=False)
+
+        with open(evaluation_file, 'w', encoding='utf-8') as f:
+            json.dump(evaluation_results, f, indent=4, ensure_ascii=False)
+
+        os.remove(checkpoint_path)
+        finish_resume(checkpoint_path)
+
+        print(f"Processing complete! Results saved to {output_file}")
+        print(f"Evaluation details saved to {evaluation_file}")
+
+        # Print statistics
+        choices = [result["choice"] for result in evaluation_results]
+        choice1_count = choices.count(1)
+        choice2_count = choices.count(2)
+
+        print(f"\nEvaluation Statistics:")
+        print(f"Selected Answer 1: {choice1_count}  times ({choice1_count / len(choices) * 100:.1f}%)")
+        print(f"Selected Answer 2: {choice2_count}  times ({choice2_count / len(choices) * 100:.1f}%)")
+        print(f"Token usage: {self.usage_tracker.summary()}")
+        print(f"Retries: {self.retry_policy.summary()}")
+        if self.pre_judge is not None:
+            print(f"Pre-judge: {self.pre_judge.summary()}")
+        if self.config.usage_report:
+            # Pre-judged records count as judged records, so the pre-judge lowers the cost per record
+            stages = {"judge": (self.usage_tracker, len(evaluation_results) - count_resumed(data, resumed))}
+            write_usage_report(self.config.usage_report, stages, self.retry_policy)
+            print(f"Usage report written to {self.config.usage_report}")
+        return processed_data, evaluation_results
+
+    def run(self, input_file, output_file, evaluation_file="evaluation_results.json"):
+        """Synchronous wrapper around arun()"""
+        return asyncio.run(self.arun(input_file, output_file, evaluation_file))
 
 
 # Main function
-async def main():
+async def main(argv=None):
     # Parse command-line arguments
     parser = argparse.ArgumentParser(description="Judge and select best answer for disease diagnosis")
     parser.add_argument("--input", type=str, required=True, help="Input JSON file path")
@@ -262,42 +431,28 @@ async def main():
     parser.add_argument("--evaluation-output", type=str, default="evaluation_results.json",
                        help="Evaluation results output file path")
     parser.add_argument("--model", type=str, default="gpt-4", help="Model name to use (default: gpt-4)")
-    args = parser.parse_args()
-
-    input_file = args.input
-    output_file = args.output
-    evaluation_file = args.evaluation_output
-    model_name = args.model
-
-    # Initialize chain
-    global chain
-    chain = chat_prompt | ChatOpenAI(model=model_name, temperature=0) | StrOutputParser()
-
-    # Load data
-    data = load_data(input_file)
-
-    # Process data asynchronously
-    processed_data, evaluation_results = await process_data_async(data)
-
-    # Save results
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(processed_data, f, indent=4, ensure_ascii=False)
-
-    with open(evaluation_file, 'w', encoding='utf-8') as f:
-        json.dump(evaluation_results, f, indent=4, ensure_ascii=False)
-
-    print(f"Processing complete! Results saved to {output_file}")
-    print(f"Evaluation details saved to {evaluation_file}")
-
-    # Print statistics
-    choices = [result["choice"] for result in evaluation_results]
-    choice1_count = choices.count(1)
-    choice2_count = choices.count(2)
-
-    print(f"\nEvaluation Statistics:")
-    print(f"Selected Answer 1: {choice1_count}  times ({choice1_count / len(choices) * 100:.1f}%)")
-    print(f"Selected Answer 2: {choice2_count}  times ({choice2_count / len(choices) * 100:.1f}%)")
+    parser.add_argument("--pre-judge", action="store_true",
+                        help="Select answer 1 without a judge call when both answers are identical or near-identical")
+    parser.add_argument("--pre-judge-threshold", type=float, default=0.9,
+                        help="Word-shingle Jaccard similarity at which --pre-judge selects answer 1 (default: 0.9)")
+    add_retry_arguments(parser)
+    add_usage_arguments(parser)
+    parser.add_argument("--resume", action="store_true",
+                        help="Reuse judgments from a previous partial run and only judge missing or failed records")
+    args = parser.parse_args(argv)
+
+    os.environ["OPENAI_API_BASE"] = API_BASE
+    os.environ["OPENAI_API_KEY"] = API_KEY
+
+    judge = AnswerJudge(JudgeConfig(model_name=args.model,
+                                    pre_judge_threshold=args.pre_judge_threshold if args.pre_judge else None,
+                                    max_retries=args.max_retries, retry_budget=args.retry_budget,
+                                    breaker_error_rate=args.breaker_error_rate,
+                                    breaker_cooldown=args.breaker_cooldown,
+                                    prices=prices_from_args(args), usage_report=args.usage_report,
+                                    resume=args.resume))
+    await judge.arun(args.input, args.output, args.evaluation_output)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
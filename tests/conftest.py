@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The stage scripts import each other by module name, as when they are run from their own directory
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+for directory in ("step1_caption_generation and refinement", "step2_vqa_generation", "step3_answer_selection"):
+    sys.path.insert(0, os.path.join(REPO_ROOT, directory))
@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+
+from caption_judge_optimize import CaptionRefiner, RefinerConfig, parse_batch_evaluations, split_json_objects
+
+
+def make_refiner(workers=2):
+    return CaptionRefiner(RefinerConfig(workers=workers, cache_dir=None), model=object())
+
+
+def captions(count):
+    return [{"image": f"img{i}.jpg", "image_caption": f"caption {i}"} for i in range(count)]
+
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, timeout=10))
+
+
+def test_worker_errors_are_recorded_per_caption():
+    refiner = make_refiner()
+
+    async def evaluate_batch(caption_texts, threshold=None):
+        if caption_texts == ["caption 1"]:
+            raise RuntimeError("cache is locked")
+        return [{"rating": 5 if text == "caption 2" else 9, "reasoning": "ok", "suggestions": "more detail"}
+                for text in caption_texts]
+
+    async def optimize_caption(caption_text, suggestions):
+        raise RuntimeError("optimizer broke")
+
+    refiner.aevaluate_batch = evaluate_batch
+    refiner.aoptimize_caption = optimize_caption
+    result = run(refiner.aprocess_and_optimize_captions(captions(4)))
+
+    assert result[1]["reasoning"] == "Evaluation error: cache is locked"
+    assert result[1]["evaluated"] and not result[1]["optimized"]
+    assert result[2]["image_caption"] == "caption 2" and not result[2]["optimized"]
+    assert [c["rating"] for c in result] == [9, 0, 5, 9]
+
+
+def test_dead_worker_raises_instead_of_hanging():
+    refiner = make_refiner()
+
+    async def evaluate_batch(caption_texts, threshold=None):
+        return [{"rating": 9, "reasoning": "ok", "suggestions": ""} for _ in caption_texts]
+
+    class BrokenSink:
+        def write(self, record):
+            raise OSError("disk full")
+
+    refiner.aevaluate_batch = evaluate_batch
+    with pytest.raises(OSError):
+        run(refiner.aprocess_and_optimize_captions(captions(3), sink=BrokenSink()))
+
+
+def test_evaluation_cache_key_depends_on_the_prompt_variant():
+    single = make_refiner()
+    batched = CaptionRefiner(RefinerConfig(judge_batch_size=4, cache_dir=None), model=object())
+    fused = CaptionRefiner(RefinerConfig(fused=True, cache_dir=None), model=object())
+    keys = {refiner.evaluation_key("caption") for refiner in (single, batched, fused)}
+    assert len(keys) == 3
+    assert make_refiner(workers=4).evaluation_key("caption") == single.evaluation_key("caption")
+
+
+def test_fused_audit_uses_the_threshold_of_the_run():
+    refiner = CaptionRefiner(RefinerConfig(fused=True, fused_audit=1.0, threshold=8, cache_dir=None), model=object())
+    assert refiner.audit_due()
+    evaluation = {"rating": 6, "optimized_caption": "rewrite"}
+    # Both ratings are below the default threshold but straddle the one passed to this run
+    refiner.record_audit(evaluation, {"rating": 7}, None, threshold=7)
+    assert refiner.fused_stats["agreed"] == 0
+    assert refiner.fused_prefix_for(7) is not refiner.fused_prefix
+    assert "7" in refiner.fused_prefix_for(7).messages[0].content
+
+
+def test_split_json_objects_ignores_braces_in_strings():
+    text = '[{"index": 1, "reasoning": "uses {braces} and \\"quotes\\""}, {"index": 2, "nested": {"a": 1}}]'
+    assert split_json_objects(text) == ['{"index": 1, "reasoning": "uses {braces} and \\"quotes\\""}',
+                                        '{"index": 2, "nested": {"a": 1}}']
+    assert split_json_objects("no objects") == []
+
+
+def test_batch_evaluations_are_matched_by_index():
+    reply = """Here are the ratings:
+    [
+      {"reasoning": "repeats index: 3 of the prompt", "index": 2, "rating": 9, "suggestions": ""},
+      {"index": 1, "rating": 5, "reasoning": "vague", "suggestions": "name the lesion colour"},
+      {index: 3, rating: 7, reasoning: 'unquoted keys', suggestions: 'none'},
+      {"index": 4, "rating": "n/a"},
+      {"index": 9, "rating": 6}
+    ]"""
+    evaluations = parse_batch_evaluations(reply, 4)
+    assert sorted(evaluations) == [1, 2, 3]
+    assert evaluations[1]["rating"] == 5 and evaluations[1]["suggestions"] == "name the lesion colour"
+    assert evaluations[2]["rating"] == 9
+    assert evaluations[3]["rating"] == 7
+    assert parse_batch_evaluations("no array here", 2) == {}
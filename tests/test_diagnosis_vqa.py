@@ -0,0 +1,28 @@
+from diagnosis_vqa import parse_group_answers, split_json_objects
+
+
+def test_group_answers_are_matched_by_index():
+    reply = """Answers:
+    [
+      {"index": 2, "answer1": "Leaf spot {fungal}", "answer2": "Septoria leaf spot"},
+      {"index": 1, "answer1": "Healthy", "answer2": "No disease visible",},
+      {"index": 3, "answer1": "", "answer2": "Rust"},
+      {"index": 4, "answer1": "Blight", "answer2": "Late blight"},
+      {"index": 1, "answer1": "Duplicate", "answer2": "Duplicate"},
+      {"index": 7, "answer1": "Out of range", "answer2": "Out of range"},
+      {"index": 5, "answer1": "broken
+    ]"""
+    answers = parse_group_answers(reply, 5)
+    assert answers == {
+        1: ("Healthy", "No disease visible"),
+        2: ("Leaf spot {fungal}", "Septoria leaf spot"),
+        4: ("Blight", "Late blight"),
+    }
+
+
+def test_missing_index_falls_back_to_the_element_position():
+    reply = '[{"answer1": "A", "answer2": "B"}, {"answer1": "C", "answer2": "D"}]'
+    assert parse_group_answers(reply, 2) == {1: ("A", "B"), 2: ("C", "D")}
+    assert parse_group_answers("I cannot answer these questions.", 2) == {}
+    assert parse_group_answers(None, 2) == {}
+    assert split_json_objects('[{"a": "}"}, {"b": {"c": 1}}]') == ['{"a": "}"}', '{"b": {"c": 1}}']
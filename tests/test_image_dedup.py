@@ -0,0 +1,58 @@
+import random
+
+import pytest
+from PIL import Image, ImageFilter
+
+import cpj_common.image_dedup as image_dedup
+from cpj_common.image_dedup import ImageDeduplicator, hamming
+
+
+def leaf(size=(320, 240)):
+    """Smooth random texture, so recompression and resizing keep its low DCT frequencies"""
+    noise = Image.effect_noise((size[0] // 8, size[1] // 8), 80).resize(size, Image.BICUBIC)
+    return noise.filter(ImageFilter.GaussianBlur(2)).convert("RGB")
+
+
+def test_recompressed_and_resized_copies_join_their_original(tmp_path):
+    original = leaf()
+    original.save(tmp_path / "a.jpg", quality=95)
+    original.save(tmp_path / "a_low.jpg", quality=40)
+    original.resize((160, 120)).save(tmp_path / "a_small.png")
+    Image.effect_noise((320, 240), 90).convert("RGB").save(tmp_path / "b.jpg")
+    (tmp_path / "broken.jpg").write_bytes(b"not an image")
+
+    paths = [str(tmp_path / name) for name in ("a.jpg", "b.jpg", "a_low.jpg", "broken.jpg", "a_small.png", "a.jpg")]
+    deduplicator = ImageDeduplicator(threshold=6, workers=2)
+    duplicates = deduplicator.find_duplicates(paths)
+
+    assert duplicates == {paths[2]: paths[0], paths[4]: paths[0]}
+    assert (deduplicator.images, deduplicator.clusters, deduplicator.unreadable) == (5, 2, 1)
+
+
+def test_banded_lookup_matches_a_full_scan(monkeypatch):
+    rng = random.Random(7)
+    bases = [rng.getrandbits(64) for _ in range(20)]
+    hashes = {}
+    for n in range(300):
+        value = rng.choice(bases)
+        for bit in rng.sample(range(64), rng.randint(0, 9)):
+            value ^= 1 << bit
+        hashes[f"img{n}.jpg"] = value
+    monkeypatch.setattr(image_dedup, "hash_file", hashes.get)
+
+    threshold = 5
+    expected = {}
+    leaders = []
+    for path, value in hashes.items():
+        match = next((leader for leader in leaders if hamming(value, hashes[leader]) <= threshold), None)
+        if match is None:
+            leaders.append(path)
+        else:
+            expected[path] = match
+
+    assert ImageDeduplicator(threshold=threshold).find_duplicates(list(hashes)) == expected
+
+
+def test_threshold_is_validated():
+    with pytest.raises(ValueError):
+        ImageDeduplicator(threshold=64)
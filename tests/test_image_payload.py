@@ -0,0 +1,50 @@
+import io
+
+from PIL import Image
+
+from cpj_common.image_payload import ImagePayloadOptimizer, strip_jpeg_metadata
+
+
+def field_photo(size=(800, 600)):
+    """Noisy RGB image, hard to compress like a real field photo"""
+    noise = Image.effect_noise(size, 60)
+    return Image.merge("RGB", [noise, noise.transpose(Image.FLIP_LEFT_RIGHT), noise.transpose(Image.FLIP_TOP_BOTTOM)])
+
+
+def jpeg_bytes(img, quality, exif=None):
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=quality, **({"exif": exif} if exif is not None else {}))
+    return buffer.getvalue()
+
+
+def test_low_quality_jpeg_never_grows():
+    exif = Image.Exif()
+    exif[0x010F] = "FieldCam"
+    for quality in (40, 60, 75):
+        original = jpeg_bytes(field_photo(), quality, exif)
+        payload, mime = ImagePayloadOptimizer(quality=85).optimize(original)
+        assert len(payload) <= len(original)
+        assert mime == "image/jpeg"
+        with Image.open(io.BytesIO(payload)) as img:
+            assert img.size == (800, 600)
+            assert 0x010F not in img.getexif()
+
+
+def test_oversized_image_is_downsized():
+    original = jpeg_bytes(field_photo((3000, 2000)), 60)
+    payload, mime = ImagePayloadOptimizer(max_edge=1536).optimize(original)
+    with Image.open(io.BytesIO(payload)) as img:
+        assert img.size == (1536, 1024)
+    assert mime == "image/jpeg"
+
+
+def test_strip_jpeg_metadata_keeps_pixels():
+    exif = Image.Exif()
+    exif[0x010F] = "FieldCam"
+    original = jpeg_bytes(field_photo((64, 48)), 90, exif)
+    stripped = strip_jpeg_metadata(original)
+    assert len(stripped) < len(original)
+    with Image.open(io.BytesIO(original)) as before, Image.open(io.BytesIO(stripped)) as after:
+        assert 0x010F not in after.getexif()
+        assert before.tobytes() == after.tobytes()
+    assert strip_jpeg_metadata(b"not a jpeg") == b"not a jpeg"
@@ -0,0 +1,47 @@
+import json
+
+from cpj_common.jsonl_sink import JsonlSink, iter_jsonl, jsonl_to_json
+
+
+def test_write_at_keeps_input_order(tmp_path):
+    path = str(tmp_path / "out.partial.jsonl")
+    with JsonlSink(path) as sink:
+        sink.write_at(2, {"n": 2})
+        sink.write_at(1, {"n": 1})
+        assert sink.written == 0
+        sink.write_at(0, {"n": 0})
+        assert sink.written == 3
+        sink.write_at(3, {"n": 3})
+    assert [record["n"] for record in iter_jsonl(path)] == [0, 1, 2, 3]
+
+
+def test_close_flushes_records_held_behind_a_gap(tmp_path):
+    path = str(tmp_path / "out.partial.jsonl")
+    sink = JsonlSink(path)
+    sink.write_at(0, {"n": 0})
+    sink.write_at(3, {"n": 3})
+    sink.write_at(2, {"n": 2})
+    sink.close()
+    assert [record["n"] for record in iter_jsonl(path)] == [0, 2, 3]
+
+
+def test_truncated_line_is_skipped_and_conversion_matches_json_dump(tmp_path):
+    path = str(tmp_path / "out.partial.jsonl")
+    with JsonlSink(path) as sink:
+        sink.write({"caption": "ä leaf", "rating": 9})
+        sink.write({"caption": "stem", "rating": 7})
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"caption": "cut o')
+
+    json_path = str(tmp_path / "out.json")
+    assert jsonl_to_json(path, json_path) == 2
+    with open(json_path, encoding="utf-8") as f:
+        text = f.read()
+    records = [{"caption": "ä leaf", "rating": 9}, {"caption": "stem", "rating": 7}]
+    assert text == json.dumps(records, ensure_ascii=False, indent=2)
+
+    empty = tmp_path / "empty.jsonl"
+    empty.write_text("")
+    assert jsonl_to_json(str(empty), json_path) == 0
+    with open(json_path, encoding="utf-8") as f:
+        assert json.load(f) == []
@@ -0,0 +1,55 @@
+import os
+import shutil
+
+from PIL import Image
+
+from cpj_common.image_payload import ImagePayloadOptimizer
+from cpj_common.payload_store import PayloadStore
+
+
+def save_images(directory, count):
+    paths = []
+    for n in range(count):
+        path = str(directory / f"leaf{n}.png")
+        Image.effect_noise((96, 96), 40 + 10 * n).convert("RGB").save(path)
+        paths.append(path)
+    return paths
+
+
+def test_hits_by_path_and_by_content(tmp_path):
+    (first,) = save_images(tmp_path, 1)
+    store = PayloadStore(str(tmp_path / "store"), ImagePayloadOptimizer())
+    payload = store.load(first)
+    copy = str(tmp_path / "copy.png")
+    shutil.copyfile(first, copy)
+
+    assert store.load(first) == payload
+    assert store.load(copy) == payload
+    assert store.stats()["hits"] == 2 and store.stats()["path_hits"] == 1 and store.stats()["misses"] == 1
+    # Another process sharing the directory finds the payload without encoding
+    assert PayloadStore(str(tmp_path / "store"), ImagePayloadOptimizer()).load(first) == payload
+
+
+def test_eviction_removes_least_recently_used_payloads(tmp_path):
+    paths = save_images(tmp_path, 3)
+    store = PayloadStore(str(tmp_path / "store"), ImagePayloadOptimizer(), max_size_mb=None)
+    stored = []
+    for age, path in enumerate(paths):
+        known = {item[2] for item in store._payload_files()}
+        store.load(path)
+        (payload_path,) = {item[2] for item in store._payload_files()} - known
+        os.utime(payload_path, (1_000_000 + age, 1_000_000 + age))
+        stored.append(payload_path)
+    assert store.evict() == 0
+
+    # Reading the oldest payload marks it as recently used, so the second one goes first
+    store.load(paths[0])
+    store.max_bytes = store.size() - 1
+    assert store.evict() == 1
+    assert {item[2] for item in store._payload_files()} == {stored[0], stored[2]}
+    assert store.evicted == 1
+
+    misses = store.misses
+    for path in paths:
+        store.load(path)
+    assert store.misses == misses + 1
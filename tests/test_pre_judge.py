@@ -0,0 +1,30 @@
+from cpj_common.pre_judge import PreJudge, answer_similarity, is_unusable_answer
+
+
+def test_near_identical_answers_are_auto_selected():
+    pre_judge = PreJudge(0.9)
+    assert pre_judge.check("Tomato leaf with early blight.", "tomato leaf with early blight") == 1.0
+    assert pre_judge.check("The leaf is healthy.", "The leaf is not healthy.") is None
+    assert pre_judge.selected == 1 and pre_judge.identical == 1
+
+
+def test_similarity_keeps_negation_apart():
+    assert answer_similarity("The leaf is healthy", "The leaf is not healthy") < 0.9
+
+
+def test_empty_and_failed_answers_go_to_the_judge():
+    pre_judge = PreJudge(0.9)
+    assert pre_judge.check("", "") is None
+    assert pre_judge.check("  ...  ", "...") is None
+    assert pre_judge.check("API call failed: timeout", "API call failed: timeout") is None
+    assert pre_judge.check("No response generated", "No response generated") is None
+    assert pre_judge.check("Early blight.", "") is None
+    assert pre_judge.selected == 0
+    assert pre_judge.unusable == 5
+    assert pre_judge.checked == 5
+
+
+def test_is_unusable_answer():
+    assert is_unusable_answer("")
+    assert is_unusable_answer("Failed to read image: missing.jpg")
+    assert not is_unusable_answer("Early blight caused by Alternaria solani.")
@@ -0,0 +1,44 @@
+from langchain.prompts.chat import ChatPromptTemplate
+from langchain_core.messages import HumanMessage
+
+from cpj_common.prompt_budget import PromptBudget
+
+EXAMPLE = "x" * 400   # ~100 tokens per example message
+
+
+def few_shot_prompt(examples=3):
+    messages = [("system", "You answer questions about {crop} leaves.")]
+    for _ in range(examples):
+        messages += [("human", EXAMPLE), ("ai", EXAMPLE)]
+    messages.append(("human", "{question}"))
+    return ChatPromptTemplate.from_messages(messages)
+
+
+def test_variants_run_from_full_to_zero_shot():
+    budget = PromptBudget(few_shot_prompt(), crop="tomato")
+    assert [name for name, _ in budget.variants] == ["few_shot", "few_shot_2", "few_shot_1", "zero_shot"]
+    assert budget.prefix_tokens == sorted(budget.prefix_tokens, reverse=True)
+    assert "tomato" in budget.full.messages[0].content
+
+
+def test_fit_picks_the_largest_variant_under_the_cap():
+    budget = PromptBudget(few_shot_prompt(), max_prompt_tokens=500, crop="tomato")
+    short, long = HumanMessage(content="q" * 40), HumanMessage(content="q" * 1200)
+
+    name, messages = budget.fit(short)
+    assert name == "few_shot_2"
+    assert messages[-1] is short and len(messages) == 1 + 4 + 1
+
+    assert budget.fit(long)[0] == "zero_shot"
+    assert budget.over_budget == 0
+    assert budget.fit(HumanMessage(content="q" * 4000))[0] == "zero_shot"
+    assert budget.over_budget == 1
+    assert budget.saved_tokens == (budget.prefix_tokens[0] - budget.prefix_tokens[1]
+                                   + 2 * (budget.prefix_tokens[0] - budget.prefix_tokens[-1]))
+
+
+def test_without_a_cap_the_full_prompt_is_used():
+    budget = PromptBudget(few_shot_prompt(), crop="tomato")
+    name, messages = budget.fit(HumanMessage(content="q" * 4000))
+    assert name == "few_shot" and len(messages) == 1 + 6 + 1
+    assert budget.saved_tokens == 0 and budget.used == {"few_shot": 1}
@@ -0,0 +1,46 @@
+import asyncio
+import base64
+import io
+
+import pytest
+from PIL import Image
+
+from cpj_common.rate_limit import RateLimiter, TokenBucket, data_uri_tokens, image_tokens
+
+
+def test_bucket_refills_at_its_per_minute_rate():
+    bucket = TokenBucket(per_minute=600)
+    bucket.take(600)
+    bucket.updated -= 1.0
+    # One second refills 10 units, the next 5 are ready and 15 more take half a second
+    assert bucket.wait_time(5) == 0.0
+    assert bucket.wait_time(25) == pytest.approx(1.5, abs=0.01)
+    # A request above capacity waits for a full bucket instead of forever
+    bucket.take(10)
+    assert bucket.wait_time(10_000) == pytest.approx(60.0, abs=0.01)
+
+
+def test_image_tokens_follow_the_tiling_rule():
+    assert image_tokens(512, 512) == 85 + 170
+    assert image_tokens(1024, 1024) == 85 + 170 * 4
+    assert image_tokens(4096, 2048) == image_tokens(2048, 1024)
+    buffer = io.BytesIO()
+    Image.new("RGB", (1024, 1024)).save(buffer, format="PNG")
+    assert data_uri_tokens("data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode()) == 85 + 170 * 4
+    assert data_uri_tokens("data:image/png;base64,broken") == image_tokens(2048, 2048)
+
+
+def test_limiter_waits_for_the_slower_bucket():
+    limiter = RateLimiter(requests_per_minute=6000, tokens_per_minute=60000)
+    assert limiter.enabled and not RateLimiter().enabled
+    limiter.tokens.take(60000)
+
+    async def run():
+        await limiter.acquire(tokens=50)
+        await limiter.acquire(tokens=0)
+
+    asyncio.run(run())
+    # 50 tokens refill in 0.05 s at 1000 tokens/s; the request bucket never runs low
+    assert limiter.acquired == 2 and limiter.estimated_tokens == 50
+    assert limiter.waits == 1
+    assert 0.04 <= limiter.wait_time < 0.5
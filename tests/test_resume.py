@@ -0,0 +1,65 @@
+import json
+import os
+
+from cpj_common.resume import (count_resumed, finish_resume, image_key, keyed_record, load_for_resume,
+                               load_keyed_for_resume, question_key)
+
+
+def is_failed(record):
+    return record.get("caption") is None
+
+
+def write_jsonl(path, records):
+    with open(path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+def test_prev_snapshot_survives_a_crash_during_the_resumed_run(tmp_path):
+    checkpoint = str(tmp_path / "out.json.partial.jsonl")
+    write_jsonl(checkpoint, [{"image": "a.jpg", "caption": "A"}, {"image": "b.jpg", "caption": None}])
+
+    completed = load_for_resume(checkpoint, image_key, is_failed)
+    assert list(completed) == ["a.jpg"]
+    assert not os.path.exists(checkpoint)
+    assert os.path.exists(f"{checkpoint}.prev")
+
+    # The resumed run crashes after writing one more record; the first run's record is still in the snapshot
+    write_jsonl(checkpoint, [{"image": "b.jpg", "caption": "B"}])
+    with open(checkpoint, "a", encoding="utf-8") as f:
+        f.write('{"image": "c.jpg", "capt')
+    completed = load_for_resume(checkpoint, image_key, is_failed)
+    assert completed == {"a.jpg": {"image": "a.jpg", "caption": "A"}, "b.jpg": {"image": "b.jpg", "caption": "B"}}
+
+    finish_resume(checkpoint)
+    assert not os.path.exists(f"{checkpoint}.prev")
+
+
+def test_later_files_win_over_the_previous_output(tmp_path):
+    output = str(tmp_path / "out.json")
+    checkpoint = f"{output}.partial.jsonl"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump([{"image": "a.jpg", "caption": "old"}, {"image": "b.jpg", "caption": "B"}], f)
+    write_jsonl(checkpoint, [{"image": "a.jpg", "caption": "new"}])
+
+    completed = load_for_resume(checkpoint, image_key, is_failed, output_path=output)
+    assert completed["a.jpg"]["caption"] == "new"
+    assert completed["b.jpg"]["caption"] == "B"
+
+
+def test_repeated_questions_without_question_id_are_kept_apart(tmp_path):
+    data = [{"image": "leaf.jpg", "question": "Is it diseased?"}, {"image": "leaf.jpg", "question": "Is it diseased?"}]
+    assert question_key(data[0], 0) != question_key(data[1], 1)
+    assert question_key({"question_id": 7, "image": "leaf.jpg"}, 3) == "7"
+
+    output = str(tmp_path / "answers.json")
+    checkpoint = f"{output}.partial.jsonl"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump([dict(data[0], caption=None), dict(data[1], caption="second")], f)
+    write_jsonl(checkpoint, [keyed_record(0, dict(data[0], caption="first"))])
+
+    resumed = load_keyed_for_resume(checkpoint, is_failed, output)
+    assert resumed[question_key(data[0], 0)]["caption"] == "first"
+    assert resumed[question_key(data[1], 1)]["caption"] == "second"
+    assert count_resumed(data, resumed) == 2
+    assert count_resumed(data + [data[0]], resumed) == 2
@@ -0,0 +1,118 @@
+import time
+
+import httpx
+import openai
+import pytest
+
+from cpj_common.retry_policy import CircuitBreaker, RetryPolicy, is_retryable
+
+COOLDOWN = 0.05
+
+
+def open_breaker():
+    breaker = CircuitBreaker(error_rate=0.5, window=4, min_calls=4, cooldown=COOLDOWN)
+    for _ in range(4):
+        breaker.record(True)
+    assert breaker.opened_at is not None
+    return breaker
+
+
+def start_probe(breaker):
+    time.sleep(COOLDOWN * 1.2)
+    delay, probe = breaker.before_call()
+    assert delay == 0.0 and probe is not None
+    return probe
+
+
+def test_stale_outcomes_do_not_settle_the_probe():
+    breaker = open_breaker()
+    probe = start_probe(breaker)
+
+    # Calls dispatched before the breaker opened finish while the probe is in flight
+    breaker.record(False)
+    breaker.record(True)
+    assert breaker.opened_at is not None
+    assert breaker.opens == 1
+    delay, other = breaker.before_call()
+    assert delay > 0 and other is None
+
+    breaker.record(False, probe)
+    assert breaker.opened_at is None
+    assert breaker.before_call() == (0.0, None)
+
+
+def test_failed_probe_reopens_after_stale_success():
+    breaker = open_breaker()
+    probe = start_probe(breaker)
+
+    breaker.record(False)
+    assert breaker.opened_at is not None
+
+    breaker.record(True, probe)
+    assert breaker.opens == 2
+    delay, token = breaker.before_call()
+    assert delay > 0 and token is None
+
+
+def test_superseded_probe_is_ignored():
+    breaker = open_breaker()
+    first = start_probe(breaker)
+    # The first probe never reports back; after another cooldown a new probe is let through
+    second = start_probe(breaker)
+    assert second != first
+
+    breaker.record(False, first)
+    assert breaker.opened_at is not None
+    breaker.record(False, second)
+    assert breaker.opened_at is None
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+def test_transient_errors_are_retryable():
+    request = httpx.Request("POST", "http://api.test/v1/chat/completions")
+    assert is_retryable(openai.APIConnectionError(request=request))
+    assert is_retryable(openai.APITimeoutError(request=request))
+    assert is_retryable(httpx.ConnectError("refused"))
+    assert is_retryable(TimeoutError())
+    assert is_retryable(StatusError(429))
+    assert is_retryable(StatusError(503))
+    assert not is_retryable(StatusError(400))
+    assert not is_retryable(ValueError("bad parse"))
+    assert not is_retryable(KeyError("content"))
+
+
+def test_local_bug_is_not_retried_and_does_not_trip_the_breaker():
+    policy = RetryPolicy(max_retries=3, base_delay=0, breaker_error_rate=0.5)
+    attempts = []
+
+    def broken():
+        attempts.append(1)
+        raise ValueError("parser bug")
+
+    for _ in range(20):
+        with pytest.raises(ValueError):
+            policy.call(broken)
+    assert len(attempts) == 20
+    assert policy.retries == 0
+    assert policy.breaker.opened_at is None
+    assert not any(policy.breaker.outcomes)
+
+
+def test_probe_with_client_error_does_not_close_the_breaker():
+    breaker = open_breaker()
+    probe = start_probe(breaker)
+    policy = RetryPolicy(max_retries=0)
+    policy.breaker = breaker
+
+    # The probe was already dispatched; it fails with a 400
+    assert policy._after_failure(StatusError(400), 1, probe) is None
+    assert breaker.opened_at is not None
+    assert breaker.opens == 1
+    # The next call probes instead
+    delay, next_probe = breaker.before_call()
+    assert delay == 0.0 and next_probe not in (None, probe)
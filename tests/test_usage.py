@@ -0,0 +1,26 @@
+from cpj_common.usage import aggregate_calls, call_cost, resolve_prices
+
+
+def call(attempts=1, prompt_tokens=1000, cached_tokens=0):
+    return {"latency": 0.1, "prompt_tokens": prompt_tokens, "completion_tokens": 100,
+            "cached_tokens": cached_tokens, "cost": None, "attempts": attempts}
+
+
+def test_explicit_prices_keep_the_model_cache_discount():
+    assert resolve_prices((2.0, None, 8.0), "gpt-4o-2024-08-06") == (2.0, 1.0, 8.0)
+    assert resolve_prices((2.0, None, 8.0), "unknown-model") == (2.0, 2.0, 8.0)
+    assert resolve_prices((2.0, 0.2, 8.0), "gpt-4o") == (2.0, 0.2, 8.0)
+    assert resolve_prices(None, "unknown-model") is None
+
+
+def test_cached_tokens_are_cheaper():
+    prices = resolve_prices((2.0, None, 8.0), "gpt-4o")
+    assert call_cost(prices, 1000, 0, 800) < call_cost(prices, 1000, 0, 0)
+
+
+def test_retry_distribution_per_call_and_record():
+    stats = aggregate_calls([call(), call(), call(attempts=2), call(attempts=3)], errors=3, records=2)
+    assert stats["retries"] == 3
+    assert stats["retries_per_call"]["histogram"] == {"0": 2, "1": 1, "2": 1}
+    assert stats["retries_per_call"]["max"] == 2
+    assert stats["retries_per_record"] == 1.5